@@ -0,0 +1,28 @@
+from .wfs import WFSImporter
+
+
+class MunicipalityImporter(WFSImporter):
+    id = 'stat_fi_municipalities'
+    name = 'Stat.fi municipalities WFS'
+    wfs_url = 'https://geo.stat.fi/geoserver/tilastointialueet/wfs'
+
+    area_types = {
+        'fi:kunta': dict(
+            name='Kunnat',
+            name_en='Municipalities',
+            layer='tilastointialueet:kunta1000k',
+        ),
+    }
+
+    def get_area_types(self):
+        return self.area_types
+
+    def read_area_type(self, identifier) -> dict:
+        conf = self.area_types[identifier]
+        d = self.read_wfs_layer(conf['layer'])
+        areas = []
+        for feat in d['features']:
+            props = feat['properties']
+            areas.append(dict(identifier=props['kunta'], name=props['nimi'], geometry=feat['geometry']))
+
+        return dict(identifier=identifier, name=conf['name'], name_en=conf.get('name_en'), areas=areas)
@@ -1,6 +1,7 @@
 from django.core.management.base import BaseCommand
 from analytics.areas.tampere import TampereImporter, TamperePaavoImporter
 from analytics.areas.paavo import PaavoImporter
+from analytics.areas.municipalities import MunicipalityImporter
 from analytics.areas.tampere_poi import TamperePOIImporter
 
 
@@ -9,6 +10,7 @@ area_importers = [
     TamperePaavoImporter(),
     PaavoImporter(),
     TamperePOIImporter(),
+    MunicipalityImporter(),
 ]
 
 
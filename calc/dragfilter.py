@@ -1,3 +1,4 @@
+from functools import lru_cache
 import numpy as np
 import matplotlib.pyplot as plt
 import numba
@@ -77,6 +78,28 @@ def Fd(dt, force, drag):
     Ft = np.array([[1, 0, 1/drag - exp(-drag*dt)/drag, 0], [0, 1, 0, 1/drag - exp(-drag*dt)/drag], [0, 0, exp(-drag*dt), 0], [0, 0, 0, exp(-drag*dt)]])
     return Ft
 
+# Hack to avoid over/underflows: cap "effective" dt to 300 seconds
+MAX_PREDICT_DT = 300
+
+# Sample intervals are heavily quantised (e.g. locationUpdateInterval of 5 s),
+# so the discretised models are looked up from a bounded dt-keyed cache.
+DISCRETIZATION_CACHE_SIZE = 4096
+
+
+@lru_cache(maxsize=DISCRETIZATION_CACHE_SIZE)
+def discretize(dt, force, drag):
+    """Return Fd and Qd for a time step of dt seconds.
+
+    The returned arrays are shared between callers, so they are read-only.
+    """
+    dt = min(dt, MAX_PREDICT_DT)
+    F = Fd(dt, force, drag)
+    Q = Qd(dt, force, drag)
+    F.setflags(write=False)
+    Q.setflags(write=False)
+    return F, Q
+
+
 @njit(cache=True)
 def predict(dt, m, S, Fd, Qd):
     m = Fd@m
@@ -147,10 +170,7 @@ class DragFilter:
         self.likelihood = 1.0
 
     def predict(self, dt):
-        # Hack to avoid over/underflows: cap "effective" dt to 300 seconds
-        dt = min(dt, 300)
-        Q = Qd(dt, self.force, self.drag)
-        F = Fd(dt, self.force, self.drag)
+        F, Q = discretize(float(dt), self.force, self.drag)
         self.x, self.P = predict(dt, self.x, self.P, F, Q)
 
     def update(self, z, R):
@@ -1,7 +1,9 @@
+from collections import namedtuple
+from functools import lru_cache
 import numpy as np
-from .dragfilter import DragFilter
+from .dragfilter import DragFilter, discretize
 from .IMM import IMMEstimator
-from scipy.linalg import expm
+from .immbank import run_filter_bank, run_imm_smoother, viterbi_decode
 import numba
 import logging
 
@@ -48,6 +50,17 @@ filters = {
 
 filter_idx = {k: i for i, k in enumerate(filters)}
 
+# The compiled engine needs the filter parameters as plain arrays
+_filter_instances = [f() for f in filters.values()]
+filter_forces = np.array([f.force for f in _filter_instances])
+filter_drags = np.array([f.drag for f in _filter_instances])
+del _filter_instances
+
+# 'numba' runs the whole filter bank in a single compiled loop (see immbank.py),
+# 'python' runs the reference IMMEstimator implementation sample by sample.
+ENGINES = ('numba', 'python')
+DEFAULT_ENGINE = 'numba'
+
 N_states = len(filters)
 
 # Just a rough guess of how long a "leg" lasts on average to
@@ -59,23 +72,41 @@ mean_state_duration = 5*60
 transition_rate = np.zeros((N_states, N_states)) + (1/mean_state_duration)/(N_states - 1)
 transition_rate[np.diag_indices(N_states)] = -1/mean_state_duration
 
-def filter_trajectory(traj, initial_state_prob_ests=None):
-    # TODO: Smoothing!
+# The rate matrix is symmetric, so expm(transition_rate*dt) has a closed form
+# through its eigendecomposition and no Padé approximation is needed per step.
+assert np.allclose(transition_rate, transition_rate.T)
+_rate_eigvals, _rate_eigvecs = np.linalg.eigh(transition_rate)
+
+TRANSITION_CACHE_SIZE = 4096
+
+
+def mode_transition_matrix(dt):
+    M = (_rate_eigvecs * np.exp(_rate_eigvals*dt)) @ _rate_eigvecs.T
+    # Clip the rounding errors so that the rows remain proper distributions
+    return np.clip(M, 0.0, 1.0)
+
+filter_names = list(filters.keys())
+
+TrajectorySample = namedtuple(
+    'TrajectorySample', ['time', 'x', 'y', 'location_std', 'atype', 'aconf', 'vehicle_way_distance']
+)
+
+
+def iter_trajectory_samples(time, x, y, location_std, atype, aconf, vehicle_way_distance):
+    """Adapt the columnar inputs of filter_trajectory_arrays to the per-sample
+    interface of filter_trajectory."""
+    atype_names = [filter_names[i] if i >= 0 else None for i in atype]
+    return map(TrajectorySample, time, x, y, location_std, atype_names, aconf, vehicle_way_distance)
+
+
+def filter_trajectory(traj, initial_state_prob_ests=None, smooth=False):
     filts = [f() for f in filters.values()]
     # TODO: Could use some global average. Probably doesn't matter
     state_probs = np.ones(N_states)
     state_probs /= np.sum(state_probs)
 
     initial_state_probs = np.copy(state_probs)
-    # The trellis with a less confusing name.
-    # Note that state_probs is different from path_probs.
-    # The latter refers to sort of "maximum likelihood attainable by selecting
-    # this state at this step". More or less standard Viterbi, but with the
-    # IMM observation probs. Breaking quite a few assumptions here probably, so
-    # not strictly optimal but probably works relatively well; IMM breaks them all already anyway.
-    path_probs = np.copy(state_probs)
-    most_likely_transitions = []
-    
+
     imm = IMMEstimator(filts, state_probs)
     #imm = filts[-1] # HACK!
     
@@ -83,8 +114,10 @@ def filter_trajectory(traj, initial_state_prob_ests=None):
     Ss = []
     state_probs = []
 
+    times = []
     prev_time = None
     for z in traj:
+        times.append(z.time)
         if prev_time is None:
             prev_time = z.time
         dt = z.time - prev_time
@@ -93,7 +126,7 @@ def filter_trajectory(traj, initial_state_prob_ests=None):
         # this in the update step. I think it would be more logical in the prediction
         # step as this can be computed without any measurements. TODO: Verify FilterPy
         # implementation.
-        M = expm(transition_rate*dt)
+        M = discretized_bank(float(dt))[0]
         
         with np.errstate(all="raise"):
             # Qd(dt) overflows when the dt is too high. Currently the Kalman filters
@@ -158,77 +191,169 @@ def filter_trajectory(traj, initial_state_prob_ests=None):
         Ss.append(np.copy(imm.P))
         state_probs.append(np.copy(imm.mu))
 
-        # Compute the most likely path stuff
-        path_probs_new = np.empty_like(path_probs)
-        new_transitions = []
-        for new_mode_i in range(N_states):
-            best_prev_i = None
-            best_new_prob = -1
-            for prev_mode_i in range(len(filters)):
-                obs_lik = filts[new_mode_i].likelihood
-                new_prob = path_probs[prev_mode_i]*obs_lik*M[prev_mode_i,new_mode_i]
-                if new_prob > best_new_prob:
-                    best_new_prob = new_prob
-                    best_prev_i = prev_mode_i
-            path_probs_new[new_mode_i] = best_new_prob
-            new_transitions.append(best_prev_i)
-        path_probs = path_probs_new
-        path_probs /= np.sum(path_probs)
-        most_likely_transitions.append(new_transitions)
-    
+    times = np.array(times, dtype=float)
     state_probs = np.array(state_probs)
+    ms = np.array(ms)
+    Ss = np.array(Ss)
+    if smooth:
+        ms, Ss, state_probs = smooth_trajectory(times, ms, Ss, state_probs)
 
-    most_likely_state = np.argmax(path_probs)
-    most_likely_path = [most_likely_state]
-    for states in most_likely_transitions[::-1]:
-        most_likely_state = states[most_likely_state]
-        most_likely_path.append(most_likely_state)
-    
-    # TODO FIXME: This seems to be broken ATM! Fix or remove the duplicate viterbi-attempt
-    most_likely_path = most_likely_path[::-1][1:]
+    # Most likely path decoding with the IMM state probabilities as the emissions
+    # and the transition matrices of the actual sample intervals.
+    Ms, _, _, model_idx = discretized_models(np.diff(times, prepend=times[:1]))
+    most_likely_path = viterbi_decode(initial_state_probs, Ms, model_idx, state_probs)
 
-    # TODO FIXME: Temporary hack as the viterbi is a bit buggy ATM
-    #most_likely_path = np.argmax(state_probs, axis=1)
-    
-    # TODO FIXME: Hack to do "most likely path decoding" with IMM state probs. Theoretically HIDEOUS!
-    # TODO FIXME: Known to cause problems that time-variant transition probs will fix easily!
-    HACK_FIXED_DT_TRANSITIONS = expm(transition_rate*5)
-    most_likely_path = viterbi(initial_state_probs, HACK_FIXED_DT_TRANSITIONS, state_probs)
-    most_likely_path = np.array(most_likely_path)
-    
-    return np.array(ms), np.array(Ss), state_probs, most_likely_path, imm.total_loglikelihood
+    return ms, Ss, state_probs, most_likely_path, imm.total_loglikelihood
 
 
-def safelog(x):
-    return np.log(np.clip(x, 1e-9, None))
+@lru_cache(maxsize=TRANSITION_CACHE_SIZE)
+def discretized_bank(dt):
+    """Return the mode transition matrix and the stacked Fd and Qd of all
+    the filters for a time step of dt seconds.
 
-def viterbi(initial_probs, transition_probs, emissions):
-    # TODO: Online mode
-    # TODO: Variable dt transitions!!
-    n_states = len(initial_probs)
-    emissions = iter(emissions)
-    emission = next(emissions)
-    transition_probs = safelog(transition_probs)
-    probs = safelog(emission) + safelog(initial_probs)
-    state_stack = []
-    
-    for i, emission in enumerate(emissions):
-        total_prob = np.sum(emission)
-        if total_prob > 1e-9:
-            emission /= total_prob
-        else:
-            emission[:] = 1/len(emission)
-        trans_probs = transition_probs + np.row_stack(probs)
-        most_likely_states = np.argmax(trans_probs, axis=0)
-        probs = safelog(emission) + trans_probs[most_likely_states, np.arange(n_states)]
-        state_stack.append(most_likely_states)
-    
-    state_seq = [np.argmax(probs)]
+    The returned arrays are shared between callers, so they are read-only.
+    """
+    M = mode_transition_matrix(dt)
+    F, Q = zip(*(discretize(dt, force, drag) for force, drag in zip(filter_forces, filter_drags)))
+    F = np.array(F)
+    Q = np.array(Q)
+    for arr in (M, F, Q):
+        arr.setflags(write=False)
+    return M, F, Q
+
+
+def discretized_models(dts):
+    # Sample intervals are heavily quantised, so look up the models only once
+    # for each distinct dt and index them per sample.
+    unique_dts, idx = np.unique(dts, return_inverse=True)
+    banks = [discretized_bank(float(dt)) for dt in unique_dts]
+    Ms = np.array([b[0] for b in banks]).reshape((-1, N_states, N_states))
+    Fs = np.array([b[1] for b in banks]).reshape((-1, N_states, len(m0), len(m0)))
+    Qs = np.array([b[2] for b in banks]).reshape((-1, N_states, len(m0), len(m0)))
+    return Ms, Fs, Qs, idx.astype(np.int64)
+
+
+def transition_cache_info():
+    """Hit statistics of the dt-keyed model caches."""
+    out = {}
+    for name, func in (('bank', discretized_bank), ('filter', discretize)):
+        info = func.cache_info()
+        total = info.hits + info.misses
+        out[name] = dict(
+            hits=info.hits, misses=info.misses, size=info.currsize,
+            hit_rate=info.hits / total if total else 0.0,
+        )
+    return out
+
+
+def smooth_trajectory(time, ms, Ss, state_probs):
+    """Run the backward smoothing pass over the output of the filter."""
+    dts = np.diff(time, prepend=time[:1])
+    Ms, Fs, Qs, model_idx = discretized_models(dts)
+    return run_imm_smoother(
+        np.ascontiguousarray(ms, dtype=np.float64), np.ascontiguousarray(Ss, dtype=np.float64),
+        np.ascontiguousarray(state_probs, dtype=np.float64), Ms, Fs, Qs, model_idx,
+    )
+
+
+# Checkpoint of the compiled filter bank after the sample at `time` (in epoch seconds)
+FilterBankState = namedtuple(
+    'FilterBankState', ['time', 'xs', 'Ps', 'mu', 'omega', 'cbar', 'path_probs', 'initial_ests']
+)
+_STATE_ARRAYS = FilterBankState._fields[1:]
+
+
+def filter_bank_state_to_dict(state: FilterBankState) -> dict:
+    out = {key: np.asarray(getattr(state, key)).tolist() for key in _STATE_ARRAYS}
+    out['time'] = float(state.time)
+    return out
+
+
+def filter_bank_state_from_dict(data: dict):
+    """Restore a FilterBankState, or return None if it doesn't fit the current filter bank."""
+    try:
+        state = FilterBankState(
+            time=float(data['time']), **{key: np.array(data[key], dtype=np.float64) for key in _STATE_ARRAYS}
+        )
+    except (KeyError, TypeError, ValueError):
+        return None
+    if state.xs.shape != (N_states, len(m0)) or state.Ps.shape != (N_states, len(m0), len(m0)):
+        return None
+    if state.mu.shape != (N_states,) or state.omega.shape != (N_states, N_states):
+        return None
+    return state
+
+
+def filter_trajectory_arrays(
+    time, x, y, location_std, atype, aconf, vehicle_way_distance, initial_state_prob_ests=None, smooth=False,
+    state=None, return_state=False,
+):
+    """Compiled equivalent of filter_trajectory working on columnar inputs.
+
+    `atype` is the index of the filter in `filters` (or -1 if unknown) and all
+    the other inputs are float arrays of the same length. With `smooth`, the
+    filtered estimates are refined with a backward smoothing pass and the
+    most likely path is decoded from the smoothed state probabilities.
+
+    If a FilterBankState from an earlier run is given in `state`, filtering
+    continues from it instead of the uninformative prior. All the samples must
+    be newer than the state. With `return_state`, the state after the last
+    sample is returned as the last element of the result tuple.
+    """
+    time = np.ascontiguousarray(time, dtype=np.float64)
+    initial_state_probs = np.ones(N_states) / N_states
+
+    if state is not None:
+        if len(time) and time[0] <= state.time:
+            raise ValueError('Samples must be newer than the filter state')
+        dts = np.diff(time, prepend=state.time)
+        # Continue with the state probability estimates of the earlier run
+        # (they decay over the trajectory), unless it had none.
+        if len(state.initial_ests) or initial_state_prob_ests is None:
+            initial_state_prob_ests = state.initial_ests
+    else:
+        dts = np.diff(time, prepend=time[:1])
+        # The first mixing is done with an identity transition matrix
+        state = FilterBankState(
+            time=None,
+            xs=np.tile(m0, (N_states, 1)),
+            Ps=np.tile(S0, (N_states, 1, 1)),
+            mu=initial_state_probs.copy(),
+            omega=np.eye(N_states),
+            cbar=initial_state_probs.copy(),
+            path_probs=np.log(np.clip(initial_state_probs, 1e-9, None)),
+            initial_ests=None,
+        )
+    resumed = state.time is not None
+    Ms, Fs, Qs, model_idx = discretized_models(dts)
+
+    if initial_state_prob_ests is None:
+        initial_state_prob_ests = np.empty(0)
 
-    while state_stack:
-        most_likely_states = state_stack.pop()
-        state_seq.append(most_likely_states[state_seq[-1]])
+    ms, Ss, state_probs, most_likely_path, total_loglikelihood, end_state = run_filter_bank(
+        np.ascontiguousarray(x, dtype=np.float64),
+        np.ascontiguousarray(y, dtype=np.float64),
+        np.ascontiguousarray(location_std, dtype=np.float64),
+        np.ascontiguousarray(atype, dtype=np.int64),
+        np.ascontiguousarray(aconf, dtype=np.float64),
+        np.ascontiguousarray(vehicle_way_distance, dtype=np.float64),
+        np.ascontiguousarray(state.xs, dtype=np.float64),
+        np.ascontiguousarray(state.Ps, dtype=np.float64),
+        np.ascontiguousarray(state.mu, dtype=np.float64),
+        np.ascontiguousarray(state.omega, dtype=np.float64),
+        np.ascontiguousarray(state.cbar, dtype=np.float64),
+        np.ascontiguousarray(state.path_probs, dtype=np.float64),
+        np.array(initial_state_prob_ests, dtype=np.float64),
+        resumed,
+        Ms, Fs, Qs, model_idx,
+    )
+    if smooth:
+        ms, Ss, state_probs = run_imm_smoother(ms, Ss, state_probs, Ms, Fs, Qs, model_idx)
+        most_likely_path = viterbi_decode(initial_state_probs, Ms, model_idx, state_probs)
 
-    state_seq.reverse()
+    if return_state:
+        end_time = time[-1] if len(time) else state.time
+        end_state = FilterBankState(end_time, *end_state)
+        return ms, Ss, state_probs, most_likely_path, total_loglikelihood, end_state
+    return ms, Ss, state_probs, most_likely_path, total_loglikelihood
 
-    return state_seq
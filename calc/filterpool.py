@@ -0,0 +1,68 @@
+import logging
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import numpy as np
+
+from .trips import filter_trip_columns
+
+
+logger = logging.getLogger(__name__)
+
+
+def warm_up_filter():
+    # Load the compiled kernels from the numba cache (or compile them) before
+    # the first real trip arrives, so the first trips don't pay for it.
+    n = 3
+    cols = dict(
+        time=np.arange(n, dtype=np.float64),
+        x=np.zeros(n), y=np.zeros(n), location_std=np.ones(n),
+        atype=np.full(n, -1, dtype=np.int64), aconf=np.zeros(n),
+        vehicle_way_distance=np.full(n, np.nan),
+    )
+    filter_trip_columns(cols, smooth=True)
+
+
+class TripFilterPool:
+    """Runs the per-trip filtering in a pool of worker processes.
+
+    Only NumPy arrays are passed to and from the workers. The workers are
+    spawned instead of forked, so they don't inherit the database
+    connections of the parent. With less than two workers, trips are
+    filtered in the calling process.
+    """
+
+    def __init__(self, workers=1):
+        self.workers = workers
+        self.executor = None
+
+    def start(self):
+        if self.workers < 2 or self.executor is not None:
+            return
+        logger.info('Starting %d filter workers' % self.workers)
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+            initializer=warm_up_filter,
+        )
+
+    def submit(self, cols: dict, initial_state_prob_ests=None, smooth=False, filter_state=None) -> Future:
+        """Schedule a trip for filtering. The result is that of filter_trip_columns."""
+        self.start()
+        if self.executor is not None:
+            return self.executor.submit(
+                filter_trip_columns, cols, initial_state_prob_ests, smooth=smooth, filter_state=filter_state,
+            )
+
+        fut = Future()
+        try:
+            fut.set_result(filter_trip_columns(
+                cols, initial_state_prob_ests, smooth=smooth, filter_state=filter_state,
+            ))
+        except Exception as e:
+            fut.set_exception(e)
+        return fut
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
@@ -0,0 +1,301 @@
+import numpy as np
+from numba import njit
+
+from .dragfilter import mvnormlogpdf, float_eps
+
+# A fully compiled version of the IMMEstimator + DragFilter combination
+# used in dragimm.filter_trajectory. The whole filter bank is kept as
+# fixed-shape arrays (a row per filter) and a trajectory is run through
+# it in a single compiled loop, so no per-sample allocations of
+# Python objects happen. The numerics follow IMM.py and dragfilter.py
+# step by step, so the results should match the Python engine up to
+# floating point rounding.
+
+VEHICLE_GIS_PROB_FACTOR = 2
+INITIAL_STATE_PROB_FACTOR = 0.2
+# Default measurement std for samples with a non-positive location_std
+DEFAULT_LOCATION_STD = 100.0
+
+
+@njit(cache=True)
+def safelog(x):
+    return np.log(np.maximum(x, 1e-9))
+
+
+@njit(cache=True)
+def viterbi_step(path_probs, log_transitions, emission, backpointers):
+    # Advance the path log probabilities by one step in place and
+    # store the best predecessor of each state in backpointers.
+    n_states = len(path_probs)
+    emission = emission.copy()
+    total_prob = np.sum(emission)
+    if total_prob > 1e-9:
+        emission /= total_prob
+    else:
+        emission[:] = 1 / n_states
+    log_emission = safelog(emission)
+    new_path_probs = np.empty(n_states)
+    for j in range(n_states):
+        best_i = 0
+        best_prob = path_probs[0] + log_transitions[0, j]
+        for i in range(1, n_states):
+            prob = path_probs[i] + log_transitions[i, j]
+            if prob > best_prob:
+                best_prob = prob
+                best_i = i
+        backpointers[j] = best_i
+        new_path_probs[j] = log_emission[j] + best_prob
+    path_probs[:] = new_path_probs
+
+
+@njit(cache=True)
+def viterbi_backtrack(path_probs, backpointers):
+    n = len(backpointers)
+    path = np.zeros(n, dtype=np.int64)
+    if n:
+        path[-1] = np.argmax(path_probs)
+        for k in range(n - 1, 0, -1):
+            path[k - 1] = backpointers[k, path[k]]
+    return path
+
+
+@njit(cache=True)
+def viterbi_decode(initial_probs, transitions, model_idx, emissions):
+    # Most likely state sequence with the transition matrix
+    # transitions[model_idx[k]] from step k - 1 to step k.
+    n, n_states = emissions.shape
+    log_transitions = safelog(transitions)
+    path_probs = safelog(initial_probs)
+    backpointers = np.zeros((n, n_states), dtype=np.int64)
+    for k in range(n):
+        if k == 0:
+            path_probs += safelog(emissions[0])
+        else:
+            viterbi_step(path_probs, log_transitions[model_idx[k]], emissions[k], backpointers[k])
+    return viterbi_backtrack(path_probs, backpointers)
+
+
+@njit(cache=True)
+def kalman_update(x, P, z, R, H):
+    # Same as dragfilter.update, but without the (unused) log likelihood
+    y = z - H @ x
+    S = H @ P @ H.T + R
+    K = P @ H.T @ np.linalg.inv(S)
+    x = x + K @ y
+
+    # P = (I-KH)P(I-KH)' + KRK'
+    I_KH = np.eye(P.shape[0]) - K @ H
+    P = I_KH @ P @ I_KH.T + K @ R @ K.T
+    return x, P
+
+
+@njit(cache=True)
+def state_prob_ests(n_states, atype, aconf, vehicle_way_distance, location_std, initial_ests, has_initial):
+    # See dragimm.filter_trajectory for the rationale of these.
+    # Note that initial_ests is modified in place, just like the
+    # Python engine does.
+    ests = np.ones(n_states)
+    if atype >= 0:
+        leftover_prob = (1 - aconf) / (n_states - 1)
+        ests[:] = leftover_prob
+        ests[atype] = aconf
+
+    if vehicle_way_distance < location_std ** 2:
+        ests[-1] *= VEHICLE_GIS_PROB_FACTOR
+        if has_initial:
+            ests[-1] += initial_ests[-1] * INITIAL_STATE_PROB_FACTOR
+    else:
+        ests[-1] /= VEHICLE_GIS_PROB_FACTOR
+        if has_initial:
+            initial_ests[-1] /= VEHICLE_GIS_PROB_FACTOR
+            ests += initial_ests * INITIAL_STATE_PROB_FACTOR
+
+    ests /= np.sum(ests)
+    return ests
+
+
+@njit(cache=True)
+def run_filter_bank(
+    x, y, location_std, atype, aconf, vehicle_way_distance,
+    xs, Ps, mu, omega, cbar, path_probs, initial_ests, resumed,
+    transitions, Fs, Qs, model_idx,
+):
+    # The mode transition matrices and the discretised filter models are
+    # computed outside for each distinct dt, model_idx maps samples to them.
+    #
+    # The filter bank state (xs, Ps, mu, omega, cbar, path_probs and
+    # initial_ests) is either the initial one or a state returned by a
+    # previous run, in which case `resumed` is set and the trajectory
+    # continues from it. The final state is returned along with the results.
+    n = len(x)
+    n_states, dim = xs.shape
+
+    H = np.zeros((2, dim))
+    H[0, 0] = 1.0
+    H[1, 1] = 1.0
+
+    # Filter bank state
+    xs = xs.copy()
+    Ps = Ps.copy()
+    mu = mu.copy()
+    omega = omega.copy()
+    cbar = cbar.copy()
+    path_probs = path_probs.copy()
+    x_mixed = np.empty((n_states, dim))
+    P_mixed = np.empty((n_states, dim, dim))
+    likelihood = np.empty(n_states)
+
+    total_loglikelihood = 0.0
+
+    initial_ests = initial_ests.copy()
+    has_initial = len(initial_ests) > 0
+
+    ms = np.empty((n, dim))
+    Ss = np.empty((n, dim, dim))
+    state_probs = np.empty((n, n_states))
+
+    # Viterbi bookkeeping over the IMM state probabilities
+    log_transitions = safelog(transitions)
+    backpointers = np.zeros((n, n_states), dtype=np.int64)
+
+    z = np.empty(2)
+    R = np.zeros((2, 2))
+
+    for k in range(n):
+        M = transitions[model_idx[k]]
+        F = Fs[model_idx[k]]
+        Q = Qs[model_idx[k]]
+
+        # Mixed initial conditions for each filter
+        for j in range(n_states):
+            x_mixed[j] = 0.0
+            for i in range(n_states):
+                x_mixed[j] += xs[i] * omega[i, j]
+            P_mixed[j] = 0.0
+            for i in range(n_states):
+                d = xs[i] - x_mixed[j]
+                P_mixed[j] += omega[i, j] * (np.outer(d, d) + Ps[i])
+
+        # Predict
+        for j in range(n_states):
+            xs[j] = F[j] @ x_mixed[j]
+            Ps[j] = F[j] @ P_mixed[j] @ F[j].T + Q[j]
+
+        ests = state_prob_ests(
+            n_states, atype[k], aconf[k], vehicle_way_distance[k], location_std[k],
+            initial_ests, has_initial,
+        )
+        cbar *= ests
+
+        # Update
+        r = location_std[k]
+        if r <= 0:
+            r = DEFAULT_LOCATION_STD
+        R[0, 0] = r ** 2
+        R[1, 1] = r ** 2
+        z[0] = x[k]
+        z[1] = y[k]
+        for i in range(n_states):
+            z_cov = H @ Ps[i] @ H.T + R
+            residual = z - H @ xs[i]
+            lik = np.exp(mvnormlogpdf(residual, np.zeros(2), z_cov))
+            likelihood[i] = max(lik, float_eps)
+            xs[i], Ps[i] = kalman_update(xs[i], Ps[i], z, R, H)
+
+        mu = cbar * likelihood
+        weighted_likelihood = np.sum(mu)
+        mu /= weighted_likelihood
+        total_loglikelihood += np.log(weighted_likelihood)
+
+        # Mixing probabilities for the next step
+        cbar = mu @ M
+        for i in range(n_states):
+            for j in range(n_states):
+                omega[i, j] = (M[i, j] * mu[i]) / cbar[j]
+
+        # Combined state estimate
+        m = np.zeros(dim)
+        for i in range(n_states):
+            m += xs[i] * mu[i]
+        S = np.zeros((dim, dim))
+        for i in range(n_states):
+            d = xs[i] - m
+            S += mu[i] * (np.outer(d, d) + Ps[i])
+        ms[k] = m
+        Ss[k] = S
+        state_probs[k] = mu
+
+        # Most likely path, with the state probabilities as emissions
+        if k == 0 and not resumed:
+            path_probs += safelog(mu)
+        else:
+            viterbi_step(path_probs, log_transitions[model_idx[k]], mu, backpointers[k])
+
+    most_likely_path = viterbi_backtrack(path_probs, backpointers)
+    state = (xs, Ps, mu, omega, cbar, path_probs, initial_ests)
+
+    return ms, Ss, state_probs, most_likely_path, total_loglikelihood, state
+
+
+@njit(cache=True)
+def run_imm_smoother(ms, Ss, state_probs, transitions, Fs, Qs, model_idx):
+    """Backward Rauch-Tung-Striebel pass over the filter bank output.
+
+    The mode probabilities are smoothed exactly as in a discrete HMM with the
+    filtered probabilities as the forward pass. The states are smoothed with
+    a Gaussian approximation of the mode mixture dynamics, weighting the
+    filter models with the smoothed mode probabilities of the next step.
+    """
+    n, dim = ms.shape
+    n_states = state_probs.shape[1]
+
+    ms_s = ms.copy()
+    Ss_s = Ss.copy()
+    probs_s = state_probs.copy()
+
+    m_pred = np.empty(dim)
+    C = np.empty((dim, dim))
+    P_pred = np.empty((dim, dim))
+    Fm = np.empty((n_states, dim))
+
+    for k in range(n - 2, -1, -1):
+        idx = model_idx[k + 1]
+        M = transitions[idx]
+        F = Fs[idx]
+        Q = Qs[idx]
+        mu = state_probs[k]
+        m = ms[k]
+        S = Ss[k]
+
+        # Mode probabilities
+        mode_pred = mu @ M
+        for j in range(n_states):
+            acc = 0.0
+            for i in range(n_states):
+                if mode_pred[i] > 0:
+                    acc += M[j, i] * probs_s[k + 1, i] / mode_pred[i]
+            probs_s[k, j] = mu[j] * acc
+        total = np.sum(probs_s[k])
+        if total > 0:
+            probs_s[k] /= total
+        else:
+            probs_s[k] = mu
+
+        # States
+        w = probs_s[k + 1]
+        m_pred[:] = 0.0
+        C[:] = 0.0
+        P_pred[:] = 0.0
+        for j in range(n_states):
+            Fm[j] = F[j] @ m
+            m_pred += w[j] * Fm[j]
+            C += w[j] * (S @ F[j].T)
+        for j in range(n_states):
+            d = Fm[j] - m_pred
+            P_pred += w[j] * (F[j] @ S @ F[j].T + Q[j] + np.outer(d, d))
+
+        G = np.linalg.solve(P_pred, C.T).T
+        ms_s[k] = m + G @ (ms_s[k + 1] - m_pred)
+        Ss_s[k] = S + G @ (Ss_s[k + 1] - P_pred) @ G.T
+
+    return ms_s, Ss_s, probs_s
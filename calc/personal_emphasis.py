@@ -1,10 +1,17 @@
+import math
 import typing
+from collections import defaultdict
 
+from django.contrib.gis.db.models.functions import Transform
 from django.contrib.gis.geos import Point
 from django.db.models import Count, QuerySet
 from django.contrib.gis.measure import D
 
-from trips.models import Leg, TransportMode
+from calc.trips import LOCAL_2D_CRS
+from trips.models import DeviceModeCounts, Leg, TransportMode
+
+# Legs are similar if both their start and end points are this close (in meters)
+SIMILAR_LEG_DISTANCE = 100
 
 mode_to_atype = {
     "walk": ["walking", "on_foot", "running"],
@@ -53,16 +60,22 @@ def similar_legs_by_location(device_id: int, start_loc: Point, end_loc: Point) -
     """
     Find legs that are similar to the given start and end locations.
     """
-    return Leg.objects.filter(trip__device__pk=device_id, start_loc__distance_lte=(start_loc, D(m=100)), end_loc__distance_lte=(end_loc, D(m=100)))
+    return Leg.objects.filter(
+        trip__device__pk=device_id,
+        start_loc__distance_lte=(start_loc, D(m=SIMILAR_LEG_DISTANCE)),
+        end_loc__distance_lte=(end_loc, D(m=SIMILAR_LEG_DISTANCE)),
+    )
 
 
-def user_mode_prob_ests(device_id: int) -> typing.Dict[str, float]:
+def user_mode_prob_ests(device_id: int, modes: typing.Optional[typing.Iterable[str]] = None) -> typing.Dict[str, float]:
     """
-    Calculate the probability of each mode for the user.
+    Calculate the probability of each mode for the user from the stored mode counts.
     """
-    legs = Leg.objects.filter(trip__device__pk=device_id)
+    counts = DeviceModeCounts.for_device(device_id).counts
+    if modes is None:
+        modes = TransportMode.objects.values_list("identifier", flat=True)
 
-    return calculate_mode_probs(legs)
+    return mode_probs_from_counts(counts, modes)
 
 def probs_for_similar_legs(device_id: int, start_loc: Point, end_loc: Point) -> typing.Dict:
     """
@@ -79,24 +92,103 @@ def calculate_mode_probs(legs: QuerySet[Leg]) -> typing.Dict:
     """
 
     counts = legs.values("mode", "mode__identifier").order_by("mode").annotate(count=Count("id"))
-    total = sum(count["count"] for count in counts)
+    mode_counts = {count["mode__identifier"]: count["count"] for count in counts}
+    modes = TransportMode.objects.values_list("identifier", flat=True)
+
+    return mode_probs_from_counts(mode_counts, modes)
+
 
-    modes = TransportMode.objects.all()
+def mode_probs_from_counts(mode_counts: typing.Dict[str, int], modes: typing.Iterable[str]) -> typing.Dict:
+    """
+    Calculate the percentages of each mode (by identifier) from leg counts.
+    """
+    total = sum(mode_counts.values())
 
     probs = {}
     for mode in modes:
-        count = next((count for count in counts if count["mode__identifier"] == mode.identifier), None)
-        if count is None:
+        count = mode_counts.get(mode)
+        if not count:
             mode_prob = 0
         else:
-            mode_prob = count["count"] / total
+            mode_prob = count / total
 
-        atypes = mode_to_atype[mode.identifier]
+        atypes = mode_to_atype[mode]
         for atype in atypes:
             probs[atype] = mode_prob
 
     return probs
 
 
+class LegEndpointIndex:
+    """
+    In-memory index of the start and end points of the legs of a device.
 
+    Answers the same question as similar_legs_by_location without a database
+    query. The points are kept in local metric coordinates (LOCAL_2D_CRS)
+    and hashed by their start point into a grid with SIMILAR_LEG_DISTANCE
+    sized cells, so only the 3x3 cells around a start point need to be
+    checked.
+    """
 
+    def __init__(self, modes: typing.Iterable[str], distance=SIMILAR_LEG_DISTANCE):
+        self.modes = list(modes)
+        self.distance = distance
+        # leg id -> (mode identifier, start x, start y, end x, end y)
+        self.legs = {}
+        self.cells = defaultdict(set)
+
+    @classmethod
+    def for_device(cls, device_id: int) -> 'LegEndpointIndex':
+        index = cls(TransportMode.objects.values_list("identifier", flat=True))
+        legs = Leg.objects.filter(trip__device__pk=device_id).annotate(
+            start_local=Transform("start_loc", LOCAL_2D_CRS),
+            end_local=Transform("end_loc", LOCAL_2D_CRS),
+        ).values_list("id", "mode__identifier", "start_local", "end_local")
+        for leg_id, mode, start, end in legs:
+            index.add(leg_id, mode, start.x, start.y, end.x, end.y)
+        return index
+
+    def cell(self, x, y):
+        return (math.floor(x / self.distance), math.floor(y / self.distance))
+
+    def add(self, leg_id: int, mode: str, start_x, start_y, end_x, end_y):
+        self.remove([leg_id])
+        self.legs[leg_id] = (mode, start_x, start_y, end_x, end_y)
+        self.cells[self.cell(start_x, start_y)].add(leg_id)
+
+    def remove(self, leg_ids: typing.Iterable[int]):
+        for leg_id in leg_ids:
+            leg = self.legs.pop(leg_id, None)
+            if leg is None:
+                continue
+            key = self.cell(leg[1], leg[2])
+            self.cells[key].discard(leg_id)
+            if not self.cells[key]:
+                del self.cells[key]
+
+    def similar_mode_counts(self, start_x, start_y, end_x, end_y) -> typing.Dict[str, int]:
+        """
+        Count the modes of the legs that start and end close to the given points.
+        """
+        counts = {}
+        d2 = self.distance ** 2
+        cx, cy = self.cell(start_x, start_y)
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for leg_id in self.cells.get((cx + dx, cy + dy), ()):
+                    mode, sx, sy, ex, ey = self.legs[leg_id]
+                    if (sx - start_x) ** 2 + (sy - start_y) ** 2 > d2:
+                        continue
+                    if (ex - end_x) ** 2 + (ey - end_y) ** 2 > d2:
+                        continue
+                    counts[mode] = counts.get(mode, 0) + 1
+        return counts
+
+    def similar_mode_probs(self, start_x, start_y, end_x, end_y) -> typing.Optional[typing.Dict]:
+        """
+        Like calculate_mode_probs for the similar legs, or None if there are none.
+        """
+        counts = self.similar_mode_counts(start_x, start_y, end_x, end_y)
+        if not counts:
+            return None
+        return mode_probs_from_counts(counts, self.modes)
@@ -0,0 +1,125 @@
+import io
+import struct
+
+import numpy as np
+
+
+# Decoding and encoding of the PostgreSQL binary COPY format as NumPy arrays.
+#
+# Only rows where every field has a fixed width and is never NULL are
+# handled; the query is expected to COALESCE NULLs into sentinels (NaN for
+# floats, -infinity for timestamps, -1 for small ints). Then every row has the
+# same layout and the whole result can be viewed as one structured array
+# without touching the rows in Python.
+
+COPY_SIGNATURE = b'PGCOPY\n\xff\r\n\0'
+HEADER_SIZE = len(COPY_SIGNATURE) + 4 + 4
+HEADER = COPY_SIGNATURE + struct.pack('>ii', 0, 0)
+TRAILER = struct.pack('>h', -1)
+
+# PostGIS receives geometries in the binary format as EWKB; a 2D point with
+# an SRID has a fixed size.
+EWKB_POINT_DTYPE = np.dtype([
+    ('byte_order', 'u1'), ('wkb_type', '<u4'), ('srid', '<u4'), ('x', '<f8'), ('y', '<f8'),
+])
+EWKB_POINT = 1
+EWKB_SRID_FLAG = 0x20000000
+
+# Binary send formats of the supported column types
+FIELD_TYPES = {
+    'float8': '>f8',
+    'int8': '>i8',
+    'int4': '>i4',
+    'int2': '>i2',
+    'timestamptz': '>i8',
+    'point': EWKB_POINT_DTYPE,
+}
+
+# Timestamps are sent as microseconds since 2000-01-01
+PG_EPOCH_OFFSET_US = 946684800 * 1000000
+PG_TIMESTAMP_MIN = np.iinfo(np.int64).min
+
+
+def row_dtype(fields):
+    """Structured dtype of one row of a binary COPY with the (name, type) fields."""
+    parts = [('_nfields', '>i2')]
+    for name, type_name in fields:
+        parts.append(('_len_%s' % name, '>i4'))
+        parts.append((name, FIELD_TYPES[type_name]))
+    return np.dtype(parts)
+
+
+def decode_binary_copy(buf, fields) -> dict:
+    """Decode the output of COPY ... TO STDOUT (FORMAT binary) into native arrays."""
+    buf = memoryview(buf)
+    if bytes(buf[:len(COPY_SIGNATURE)]) != COPY_SIGNATURE:
+        raise ValueError('Not a binary COPY stream')
+    ext_len = struct.unpack('>i', buf[HEADER_SIZE - 4:HEADER_SIZE])[0]
+    start = HEADER_SIZE + ext_len
+    if bytes(buf[-2:]) != TRAILER:
+        raise ValueError('Binary COPY stream is truncated')
+
+    dtype = row_dtype(fields)
+    body = len(buf) - start - len(TRAILER)
+    if body % dtype.itemsize:
+        raise ValueError('Binary COPY rows have an unexpected size (NULL values?)')
+    rows = np.frombuffer(buf, dtype=dtype, count=body // dtype.itemsize, offset=start)
+
+    out = {}
+    for name, type_name in fields:
+        col = rows[name]
+        if type_name == 'timestamptz':
+            col = col.astype(np.int64)
+            missing = col == PG_TIMESTAMP_MIN
+            col = (col + PG_EPOCH_OFFSET_US).view('datetime64[us]')
+            col[missing] = np.datetime64('NaT')
+        else:
+            col = col.astype(col.dtype.newbyteorder('='))
+        out[name] = col
+    return out
+
+
+def copy_to_arrays(cursor, query, params, fields) -> dict:
+    """Run `query` (a SELECT) through a binary COPY and return the columns as arrays."""
+    sql = cursor.mogrify(query, params)
+    if isinstance(sql, bytes):
+        sql = sql.decode('utf8')
+    buf = io.BytesIO()
+    cursor.copy_expert('COPY (%s) TO STDOUT (FORMAT binary)' % sql, buf)
+    return decode_binary_copy(buf.getbuffer(), fields)
+
+
+def encode_binary_copy(columns: dict, fields, srid=None) -> bytes:
+    """Encode the columns into a COPY ... FROM STDIN (FORMAT binary) stream.
+
+    Timestamps are given as datetime64 arrays and points as (n, 2) arrays
+    of x and y, which get the given srid.
+    """
+    dtype = row_dtype(fields)
+    n = len(columns[fields[0][0]])
+    rows = np.empty(n, dtype=dtype)
+    rows['_nfields'] = len(fields)
+    for name, type_name in fields:
+        rows['_len_%s' % name] = dtype[name].itemsize
+        col = columns[name]
+        if type_name == 'timestamptz':
+            rows[name] = col.astype('datetime64[us]').view(np.int64) - PG_EPOCH_OFFSET_US
+        elif type_name == 'point':
+            if srid is None:
+                raise ValueError('srid is required for point fields')
+            points = rows[name]
+            points['byte_order'] = 1
+            points['wkb_type'] = EWKB_POINT | EWKB_SRID_FLAG
+            points['srid'] = srid
+            points['x'] = col[:, 0]
+            points['y'] = col[:, 1]
+        else:
+            rows[name] = col
+    return HEADER + rows.tobytes() + TRAILER
+
+
+def copy_from_arrays(cursor, table, columns: dict, fields, srid=None):
+    """Insert the columns into table through a binary COPY."""
+    buf = io.BytesIO(encode_binary_copy(columns, fields, srid=srid))
+    names = ', '.join(name for name, _ in fields)
+    cursor.copy_expert('COPY %s (%s) FROM STDIN (FORMAT binary)' % (table, names), buf)
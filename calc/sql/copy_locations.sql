@@ -0,0 +1,26 @@
+-- Same rows as read_locations.sql, but every column encoded with a fixed
+-- width and without NULLs for decoding with calc.pgcopy.
+SELECT
+    l.time AS time,
+    ST_X(l.loc) AS x,
+    ST_Y(l.loc) AS y,
+    COALESCE(l.loc_error, 'NaN') :: float8 AS loc_error,
+    COALESCE(array_position(%(atypes)s :: varchar[], l.atype :: varchar) - 1, -1) :: int2 AS atype,
+    COALESCE(l.aconf, 'NaN') :: float8 AS aconf,
+    COALESCE(l.speed, 'NaN') :: float8 AS speed,
+    COALESCE(l.heading, 'NaN') :: float8 AS heading,
+    COALESCE(l.is_moving :: int, -1) :: int2 AS is_moving,
+    COALESCE(l.odometer, 'NaN') :: float8 AS odometer,
+    COALESCE(l.battery_charging :: int, -1) :: int2 AS battery_charging,
+    COALESCE(ROUND(l.closest_car_way_dist :: numeric, 1) :: float8, 'NaN') AS closest_car_way_dist,
+    COALESCE(ROUND(l.closest_rail_way_dist :: numeric, 1) :: float8, 'NaN') AS closest_rail_way_dist,
+    COALESCE(l.created_at, '-infinity') AS created_at
+FROM
+    trips_ingest_location AS l
+WHERE
+    l.uuid = %(uuid)s
+    AND l.time >= %(start_time)s
+    AND l.time <= %(end_time)s
+    AND l.deleted_at IS NULL
+ORDER BY
+    l.time
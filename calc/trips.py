@@ -1,13 +1,23 @@
+import heapq
 import os
+from collections import namedtuple
+from functools import lru_cache
 import logging
 import numba
 import numpy as np
 from datetime import date, datetime, timedelta
 import pandas as pd
+from pyproj import Transformer
 from utils.perf import PerfCounter
 
-from .dragimm import filter_trajectory, filters as transport_modes
-from .transitest import transit_prob_ests_糞
+from .pgcopy import copy_to_arrays
+
+from .dragimm import (
+    filter_trajectory, filter_trajectory_arrays, iter_trajectory_samples,
+    filters as transport_modes, filter_idx as transport_mode_idx, DEFAULT_ENGINE as DEFAULT_FILTER_ENGINE, ENGINES as FILTER_ENGINES,
+    transition_cache_info,
+)
+from .transitest import transit_prob_ests_batched
 
 
 TABLE_NAME = 'trips_ingest_location'
@@ -25,6 +35,19 @@ LOCAL_2D_CRS = 3067
 logger = logging.getLogger(__name__)
 
 
+@lru_cache(maxsize=None)
+def get_gps_transformer():
+    # Building a transformer is expensive, so share one per process
+    return Transformer.from_crs(LOCAL_2D_CRS, 4326, always_xy=True)
+
+
+def to_gps_coords(x, y):
+    """Transform arrays of LOCAL_2D_CRS coordinates into (lon, lat) arrays."""
+    return get_gps_transformer().transform(
+        np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    )
+
+
 def prepare_sql_statements(conn):
     with conn.cursor() as curs:
         # Check if we have prepared the statement for this DB session before.
@@ -43,10 +66,155 @@ def prepare_sql_statements(conn):
             curs.execute(query)
 
 
-def read_locations(conn, uid, start_time=None, end_time=None, include_all=False):
-    pc = PerfCounter('read %s' % uid, show_time_to_last=True)
+# Columns returned by the binary COPY reader, see sql/copy_locations.sql
+LOCATION_COPY_FIELDS = [
+    ('time', 'timestamptz'),
+    ('x', 'float8'),
+    ('y', 'float8'),
+    ('loc_error', 'float8'),
+    ('atype', 'int2'),
+    ('aconf', 'float8'),
+    ('speed', 'float8'),
+    ('heading', 'float8'),
+    ('is_moving', 'int2'),
+    ('odometer', 'float8'),
+    ('battery_charging', 'int2'),
+    ('closest_car_way_dist', 'float8'),
+    ('closest_rail_way_dist', 'float8'),
+    ('created_at', 'timestamptz'),
+]
+LOCATION_BOOL_FIELDS = ('is_moving', 'battery_charging')
+
+LOCATION_READERS = ('copy', 'sql')
 
-    prepare_sql_statements(conn)
+
+def read_location_columns(conn, uid, start_time, end_time) -> dict:
+    """Read the location samples of a device as typed NumPy columns.
+
+    The atype column holds the indices to ATYPE_MAPPING keys (-1 for NULL)
+    and the boolean columns are 1, 0 or -1 for NULL.
+    """
+    path = os.path.dirname(__file__)
+    fn = os.path.join(path, 'sql', 'copy_locations.sql')
+    query = open(fn, 'r').read()
+    params = dict(uuid=uid, start_time=start_time, end_time=end_time, atypes=_ATYPE_CATEGORIES)
+    with conn.cursor() as curs:
+        return copy_to_arrays(curs, query, params, LOCATION_COPY_FIELDS)
+
+
+def location_columns_to_df(cols: dict) -> pd.DataFrame:
+    data = {}
+    for name, _ in LOCATION_COPY_FIELDS:
+        col = cols[name]
+        if name in ('time', 'created_at'):
+            col = pd.Series(col.astype('datetime64[ns]')).dt.tz_localize('UTC')
+        elif name == 'atype':
+            col = pd.Categorical.from_codes(col.astype(np.int8), categories=_ATYPE_CATEGORIES)
+        elif name in LOCATION_BOOL_FIELDS:
+            col = pd.arrays.BooleanArray(col == 1, col < 0)
+        data[name] = col
+    return pd.DataFrame(data)
+
+
+@numba.njit(cache=True)
+def segment_trips(time, x, y, loc_error, not_moving, created_at, max_gap, include_all):
+    """Split the location samples of a device into trips in one pass.
+
+    The times are epoch microseconds (NaT as the int64 minimum). A new trip
+    starts after a gap longer than max_gap. Unless include_all is set, the
+    samples after the last "not moving" sample are dropped, because the trip
+    might still be ongoing. If there are no such samples, the last burst
+    (by created_at) is dropped instead.
+
+    Trips without more than 10 good samples further than
+    MIN_DISTANCE_MOVED_IN_TRIP from the trip center get the trip id -1.
+
+    Returns the trip ids, the distances from the previous samples, the mask
+    of the rows to keep, the number of good samples and the number of trips kept.
+    """
+    n = len(time)
+    nat = np.iinfo(np.int64).min
+    trip_ids = np.empty(n, dtype=np.int64)
+    distance = np.empty(n, dtype=np.float64)
+    keep = np.empty(n, dtype=np.bool_)
+
+    trip_id = 0
+    has_not_moving = False
+    last_not_moving = nat
+    last_created_at = nat
+    for i in range(n):
+        if i == 0:
+            distance[i] = 0.0
+        else:
+            if time[i] - time[i - 1] > max_gap:
+                trip_id += 1
+            d = ((x[i] - x[i - 1]) ** 2 + (y[i] - y[i - 1]) ** 2) ** 0.5
+            distance[i] = d if d == d else 0.0
+        trip_ids[i] = trip_id
+        if not_moving[i]:
+            has_not_moving = True
+            if time[i] > last_not_moving:
+                last_not_moving = time[i]
+        if created_at[i] != nat and created_at[i] > last_created_at:
+            last_created_at = created_at[i]
+    n_trips = trip_id + 1 if n else 0
+
+    # Per-trip center points of the good samples
+    center_x = np.zeros(n_trips, dtype=np.float64)
+    center_y = np.zeros(n_trips, dtype=np.float64)
+    counts = np.zeros(n_trips, dtype=np.int64)
+    n_good = 0
+    for i in range(n):
+        if include_all:
+            keep[i] = True
+        elif has_not_moving:
+            keep[i] = time[i] <= last_not_moving
+        else:
+            keep[i] = created_at[i] != nat and created_at[i] < last_created_at
+        if keep[i] and loc_error[i] < 100:
+            center_x[trip_ids[i]] += x[i]
+            center_y[trip_ids[i]] += y[i]
+            counts[trip_ids[i]] += 1
+            n_good += 1
+
+    for t in range(n_trips):
+        if counts[t]:
+            center_x[t] /= counts[t]
+            center_y[t] /= counts[t]
+        counts[t] = 0
+
+    # Count the good samples far enough from the center
+    for i in range(n):
+        if keep[i] and loc_error[i] < 100:
+            t = trip_ids[i]
+            d = ((x[i] - center_x[t]) ** 2 + (y[i] - center_y[t]) ** 2) ** 0.5
+            if d > MIN_DISTANCE_MOVED_IN_TRIP:
+                counts[t] += 1
+
+    n_kept = 0
+    for t in range(n_trips):
+        if counts[t] > 10:
+            n_kept += 1
+    for i in range(n):
+        if counts[trip_ids[i]] <= 10:
+            trip_ids[i] = -1
+            if not include_all:
+                keep[i] = False
+
+    return trip_ids, distance, keep, n_good, n_kept
+
+
+def read_locations(conn, uid, start_time=None, end_time=None, include_all=False, reader='copy'):
+    """Read the location samples of a device and split them into trips.
+
+    The 'copy' reader streams only the columns the pipeline needs through a
+    binary COPY. The 'sql' reader returns all the columns of read_locations.sql
+    (including e.g. manual_atype and the closest way ids).
+    """
+    if reader not in LOCATION_READERS:
+        raise ValueError('Unknown location reader: %s' % reader)
+
+    pc = PerfCounter('read %s' % uid, show_time_to_last=True)
 
     if end_time is None:
         end_time = datetime.utcnow()
@@ -57,52 +225,40 @@ def read_locations(conn, uid, start_time=None, end_time=None, include_all=False)
         else:
             start_time = (date.today() - timedelta(days=14)).isoformat()
 
-    params = dict(uuid=uid, start_time=start_time, end_time=end_time)
-    query = 'EXECUTE read_locations(%(uuid)s, %(start_time)s, %(end_time)s)'
-    df = pd.read_sql_query(query, conn, params=params)
-    pc.display('query done, got %d rows' % len(df))
-
-    df['time'] = pd.to_datetime(df.time, utc=True)
-    df['timediff'] = df['time'].diff().dt.total_seconds().fillna(value=0)
-    df['new_trip'] = df['timediff'] > MINS_BETWEEN_TRIPS * 60
-    df['trip_id'] = df['new_trip'].cumsum()
-    d = ((df.x - df.x.shift()) ** 2 + (df.y - df.y.shift()) ** 2).pow(.5).fillna(0)
-    df['distance'] = d
-
-    # Filter out everything after the latest "not moving" event,
-    # because a trip might still be ongoing
-    if not include_all:
-        not_moving = df[df.is_moving == False]
-        if not len(not_moving):
-            # If we don't have any "not moving" samples, just filter
-            # out the last burst.
-            df = df[df.created_at < df.created_at.max()]
-        else:
-            last_not_moving = not_moving.time.max()
-            df = df[df.time <= last_not_moving]
+    if reader == 'copy':
+        cols = read_location_columns(conn, uid, start_time, end_time)
+        df = location_columns_to_df(cols)
+        pc.display('copy done, got %d rows' % len(df))
+        segment_columns = (
+            cols['time'].view(np.int64), cols['x'], cols['y'], cols['loc_error'],
+            cols['is_moving'] == 0, cols['created_at'].view(np.int64),
+        )
+    else:
+        prepare_sql_statements(conn)
+        params = dict(uuid=uid, start_time=start_time, end_time=end_time)
+        query = 'EXECUTE read_locations(%(uuid)s, %(start_time)s, %(end_time)s)'
+        df = pd.read_sql_query(query, conn, params=params)
+        pc.display('query done, got %d rows' % len(df))
+        df['time'] = pd.to_datetime(df.time, utc=True)
+        segment_columns = (
+            epoch_microseconds(df.time), df.x.to_numpy(dtype=np.float64), df.y.to_numpy(dtype=np.float64),
+            df.loc_error.to_numpy(dtype=np.float64, na_value=np.nan),
+            (df.is_moving == False).to_numpy(dtype=bool, na_value=False),  # noqa
+            epoch_microseconds(pd.to_datetime(df.created_at, utc=True)),
+        )
 
-    # Filter out trips that do not have enough low location error samples
-    # far enough from the trip center point.
-    good_samples = df[df.loc_error < 100]
-    if not len(good_samples):
+    trip_ids, distance, keep, n_good, n_trips = segment_trips(
+        *segment_columns, MINS_BETWEEN_TRIPS * 60 * 1000000, include_all,
+    )
+    if not n_good:
         print('No good samples, returning')
         return
 
-    avg_loc = good_samples.groupby('trip_id')[['x', 'y']].mean()
-    avg_loc.columns = ['avg_x', 'avg_y']
-    d = good_samples.join(avg_loc, on='trip_id')
-    d['mean_distance'] = ((d.x - d.avg_x) ** 2 + (d.y - d.avg_y) ** 2).pow(.5)
-
-    loc_count = d[d['mean_distance'] > MIN_DISTANCE_MOVED_IN_TRIP].groupby('trip_id')['time'].count()
-    trips_to_keep = loc_count.index[loc_count > 10]
-
-    df.loc[~df.trip_id.isin(trips_to_keep), 'trip_id'] = -1
-
-    if not include_all:
-        df = df[df.trip_id >= 0]
-
-    df = df.drop(columns=['timediff', 'new_trip'])
-    pc.display('returning %d trips (%d rows)' % (len(trips_to_keep), len(df)))
+    df['trip_id'] = trip_ids
+    df['distance'] = distance
+    if not keep.all():
+        df = df[keep]
+    pc.display('returning %d trips (%d rows)' % (n_trips, len(df)))
 
     return df
 
@@ -130,36 +286,116 @@ ATYPE_UNKNOWN = ALL_ATYPES.index('unknown')
 
 IDX_MAPPING = {idx: ATYPE_REVERSE[x] for idx, x in enumerate(transport_modes.keys())}
 
+# Lookup tables for converting the atype strings to filter indices (-1 for unknown)
+# in one vectorised pass. The last element catches atypes not in ATYPE_MAPPING.
+_ATYPE_CATEGORIES = list(ATYPE_MAPPING.keys())
+_ATYPE_FILTER_IDX = np.array(
+    [transport_mode_idx[x] if x is not None else -1 for x in ATYPE_MAPPING.values()] + [-1], dtype=np.int64
+)
+_FILTER_IDX_ATYPE = np.array([IDX_MAPPING[idx] for idx in range(len(IDX_MAPPING))], dtype=object)
 
-def filter_trips(df: pd.DataFrame, initial_state_prob_ests=None):
-    out = df[['time', 'x', 'y', 'speed']].copy()
-    s = df['time'].dt.tz_convert(None) - pd.Timestamp('1970-01-01')
-    out['time'] = s / pd.Timedelta('1s')
 
-    out['location_std'] = df['loc_error'].clip(lower=0.1)
-    out['atype'] = df['atype'].map(ATYPE_MAPPING)
-    out['aconf'] = df['aconf'] / 100
-    out['vehicle_way_distance'] = df[['closest_car_way_dist', 'closest_rail_way_dist']].min(axis=1)
-    out.loc[out.aconf == 1, 'aconf'] /= 2
+def epoch_seconds(time: pd.Series) -> np.ndarray:
+    s = time.dt.tz_convert(None) - pd.Timestamp('1970-01-01')
+    return (s / pd.Timedelta('1s')).to_numpy(dtype=np.float64)
 
-    ms, Ss, state_probs, most_likely_path, _ = filter_trajectory((r for i, r in out.iterrows()), initial_state_prob_ests)
 
-    x = ms[:, 0]
-    y = ms[:, 1]
-    df = df.copy()
-    df['xf'] = x
-    df['yf'] = y
-    df['atypef'] = most_likely_path
-    df['atypef'] = df['atypef'].map(IDX_MAPPING)
+def epoch_microseconds(time: pd.Series) -> np.ndarray:
+    return time.dt.tz_convert(None).to_numpy(dtype='datetime64[us]').view(np.int64)
+
+
+def trajectory_columns(df: pd.DataFrame, way_raster=None) -> dict:
+    """Convert the samples of a trip to the columnar input of the filter engines.
+
+    If a WayDistanceRaster is given, the vehicle way distances are looked up
+    from it instead of the closest way columns of the samples.
+    """
+    codes = pd.Categorical(df['atype'], categories=_ATYPE_CATEGORIES).codes
+    aconf = df['aconf'].to_numpy(dtype=np.float64, na_value=np.nan) / 100
+    aconf[aconf == 1] /= 2
+    if way_raster is not None:
+        vehicle_way_distance = way_raster.lookup(df['x'].to_numpy(), df['y'].to_numpy())
+    else:
+        car_dist = df['closest_car_way_dist'].to_numpy(dtype=np.float64, na_value=np.nan)
+        rail_dist = df['closest_rail_way_dist'].to_numpy(dtype=np.float64, na_value=np.nan)
+        vehicle_way_distance = np.fmin(car_dist, rail_dist)
+
+    return dict(
+        time=epoch_seconds(df['time']),
+        x=df['x'].to_numpy(dtype=np.float64),
+        y=df['y'].to_numpy(dtype=np.float64),
+        location_std=np.clip(df['loc_error'].to_numpy(dtype=np.float64, na_value=np.nan), 0.1, None),
+        atype=_ATYPE_FILTER_IDX[codes],
+        aconf=aconf,
+        vehicle_way_distance=vehicle_way_distance,
+    )
+
+
+def filter_trip_columns(cols: dict, initial_state_prob_ests=None, smooth=False, filter_state=None):
+    """Run the compiled filter over the columns returned by trajectory_columns.
+
+    Only NumPy arrays go in and come out, so this can be run in a worker process.
+    Returns the filtered locations, the state probabilities, the most likely
+    path and the filter state after the last sample.
+    """
+    ms, _, state_probs, most_likely_path, _, end_state = filter_trajectory_arrays(
+        **cols, initial_state_prob_ests=initial_state_prob_ests, smooth=smooth,
+        state=filter_state, return_state=True,
+    )
+    # The covariances aren't used, so don't bother shipping them around
+    return np.ascontiguousarray(ms[:, :2]), state_probs, most_likely_path, end_state
 
-    modes = transport_modes.keys()
-    for idx, mode in enumerate(modes):
+
+def filter_output_columns(ms, state_probs, most_likely_path) -> dict:
+    out = dict(
+        xf=ms[:, 0],
+        yf=ms[:, 1],
+        atypef=_FILTER_IDX_ATYPE[np.asarray(most_likely_path, dtype=np.int64)],
+    )
+    for idx, mode in enumerate(transport_modes.keys()):
         if mode == 'driving':
             mode = 'in_vehicle'
         elif mode == 'cycling':
             mode = 'on_bicycle'
-        df[mode] = [x[idx] for x in state_probs]
+        out[mode] = state_probs[:, idx]
+    return out
 
+
+def filter_trips(
+    df: pd.DataFrame, initial_state_prob_ests=None, engine=DEFAULT_FILTER_ENGINE, smooth=False,
+    filter_state=None, return_state=False, way_raster=None,
+):
+    """Run the samples of a trip through the IMM filter bank.
+
+    With the compiled engine, filtering can continue from the `filter_state`
+    checkpoint of an earlier run, and the checkpoint after the last sample
+    is returned along with the DataFrame if `return_state` is set.
+    """
+    if engine not in FILTER_ENGINES:
+        raise ValueError('Unknown filter engine: %s' % engine)
+    if engine == 'python' and (filter_state is not None or return_state):
+        raise ValueError('Filter state checkpoints need the compiled engine')
+
+    cols = trajectory_columns(df, way_raster=way_raster)
+    if engine == 'python':
+        ms, Ss, state_probs, most_likely_path, _ = filter_trajectory(
+            iter_trajectory_samples(**cols), initial_state_prob_ests, smooth=smooth
+        )
+        end_state = None
+    else:
+        ms, state_probs, most_likely_path, end_state = filter_trip_columns(
+            cols, initial_state_prob_ests, smooth=smooth, filter_state=filter_state,
+        )
+    if logger.isEnabledFor(logging.DEBUG):
+        cache_info = transition_cache_info()
+        logger.debug('Transition cache hit rate: bank %.1f %%, filter %.1f %%' % (
+            cache_info['bank']['hit_rate'] * 100, cache_info['filter']['hit_rate'] * 100
+        ))
+
+    out = filter_output_columns(ms, state_probs, most_likely_path)
+    df = df.assign(**out)
+    if return_state:
+        return df, end_state
     return df
 
 
@@ -221,97 +457,203 @@ def get_transit_locations(conn, uid: str, start_time: datetime, end_time: dateti
     return df
 
 
-def get_dominant_mode_numpy(leg_ids, atype_array, leg_id):
-    """Get the most frequent transport mode for a given leg."""
-    mask = leg_ids == leg_id
-    if not np.any(mask):
-        return ATYPE_UNKNOWN
-    
-    leg_modes = atype_array[mask]
-    if len(leg_modes) == 0:
-        return ATYPE_UNKNOWN
-    
-    # Count occurrences of each mode
-    unique_modes = np.unique(leg_modes)
-    max_count = 0
-    dominant_mode = ATYPE_UNKNOWN
-    
-    for mode in unique_modes:
-        count = np.sum(leg_modes == mode)
-        if count > max_count:
-            max_count = count
-            dominant_mode = mode
-    
-    return dominant_mode
+# Transit vehicle locations are matched to a leg if they are reported within
+# these margins of the leg time span and of the path of the leg.
+TRANSIT_LOCATION_TIME_MARGIN = 60
+TRANSIT_LOCATION_DISTANCE_MARGIN = 200
+TRANSIT_LEG_MAX_LOC_ERROR = 200
+
+# Search window of a leg: the time span and the bounding box with the
+# margins, and the path (the accurate enough samples in time order).
+TransitLegWindow = namedtuple('TransitLegWindow', ['start', 'end', 'xmin', 'ymin', 'xmax', 'ymax', 'path_x', 'path_y'])
+
+
+def polyline_distances(px, py, lx, ly) -> np.ndarray:
+    """Return the distances of points to a polyline (or to a point, if it has one vertex)."""
+    if len(lx) == 1:
+        return np.hypot(px - lx[0], py - ly[0])
+    ax, ay = lx[:-1], ly[:-1]
+    dx, dy = np.diff(lx), np.diff(ly)
+    seg_len2 = dx * dx + dy * dy
+    # Position of the closest point on each segment, as a fraction of the segment
+    t = ((px[:, np.newaxis] - ax) * dx + (py[:, np.newaxis] - ay) * dy) / np.where(seg_len2 > 0, seg_len2, 1)
+    t = np.clip(t, 0, 1)
+    dist = np.hypot(ax + t * dx - px[:, np.newaxis], ay + t * dy - py[:, np.newaxis])
+    return dist.min(axis=1, initial=np.inf)
+
+
+class TransitLocationIndex:
+    """Transit vehicle locations around all the legs of a trip.
+
+    The locations are loaded with one query, and the candidates for each leg
+    are sliced out of the time-sorted arrays in memory. Like in
+    get_transit_locations, a leg gets the locations within
+    TRANSIT_LOCATION_DISTANCE_MARGIN of its path.
+    """
+
+    def __init__(self, df: pd.DataFrame):
+        self.df = df.sort_values('epoch_time', kind='stable').reset_index(drop=True)
+        self.time = self.df['epoch_time'].to_numpy(dtype=np.float64)
+        self.x = self.df['x'].to_numpy(dtype=np.float64)
+        self.y = self.df['y'].to_numpy(dtype=np.float64)
+
+    @staticmethod
+    def leg_window(leg_df: pd.DataFrame):
+        """Return the TransitLegWindow of a leg, or None if the leg has no
+        accurate enough samples."""
+        good = leg_df[leg_df.loc_error <= TRANSIT_LEG_MAX_LOC_ERROR]
+        if not len(good):
+            return None
+        t = epoch_seconds(leg_df['time'])
+        m = TRANSIT_LOCATION_DISTANCE_MARGIN
+        return TransitLegWindow(
+            t.min() - TRANSIT_LOCATION_TIME_MARGIN, t.max() + TRANSIT_LOCATION_TIME_MARGIN,
+            good.x.min() - m, good.y.min() - m, good.x.max() + m, good.y.max() + m,
+            good.x.to_numpy(dtype=np.float64), good.y.to_numpy(dtype=np.float64),
+        )
+
+    @classmethod
+    def load(cls, conn, windows):
+        conds = []
+        params = []
+        for w in windows:
+            conds.append(
+                '(time >= to_timestamp(%s) AND time <= to_timestamp(%s) '
+                'AND loc && ST_MakeEnvelope(%s, %s, %s, %s, %s))'
+            )
+            params += [w.start, w.end, w.xmin, w.ymin, w.xmax, w.ymax, LOCAL_2D_CRS]
+        if not conds:
+            conds.append('false')
+        query = f"""
+            SELECT
+                vehicle_journey_ref,
+                vehicle_ref,
+                time,
+                extract(epoch from time) AS epoch_time,
+                ST_X(loc) AS x,
+                ST_Y(loc) AS y,
+                route_type,
+                (SELECT route_long_name FROM gtfs.routes
+                    WHERE feed_index = vl.gtfs_feed_id AND route_id = vl.gtfs_route_id
+                ) AS route_name
+            FROM {TRANSIT_TABLE} vl
+            WHERE {' OR '.join(conds)}
+            ORDER BY time
+        """
+        df = pd.read_sql_query(query, conn, params=params)
+        return cls(df)
+
+    def leg_locations(self, window: TransitLegWindow) -> pd.DataFrame:
+        lo = np.searchsorted(self.time, window.start, side='left')
+        hi = np.searchsorted(self.time, window.end, side='right')
+        x = self.x[lo:hi]
+        y = self.y[lo:hi]
+        idx = np.flatnonzero((x >= window.xmin) & (x <= window.xmax) & (y >= window.ymin) & (y <= window.ymax))
+        # The bounding box is only a prefilter, the corners are farther from the path
+        dist = polyline_distances(x[idx], y[idx], window.path_x, window.path_y)
+        idx = idx[dist <= TRANSIT_LOCATION_DISTANCE_MARGIN]
+        return self.df.iloc[lo + idx]
+
+
+# Run-length table of the legs of a trip: one row per leg (in the order of
+# their start times) with the index of the first and the last sample, the
+# number of samples and the number of samples of each mode. The samples
+# in between belong to no leg (-1).
+LegTable = namedtuple('LegTable', ['leg_id', 'start', 'end', 'count', 'mode_counts', 'sample_leg'])
+
+
+def build_leg_table(leg_ids, atype_array, n_modes=len(ALL_ATYPES)) -> LegTable:
+    valid_idx = np.flatnonzero(leg_ids != -1)
+    legs, first, inverse, count = np.unique(
+        leg_ids[valid_idx], return_index=True, return_inverse=True, return_counts=True
+    )
+    last = np.zeros(len(legs), dtype=np.int64)
+    np.maximum.at(last, inverse, valid_idx)
+    start = valid_idx[first]
+    mode_counts = np.zeros((len(legs), n_modes), dtype=np.int64)
+    np.add.at(mode_counts, (inverse, atype_array[valid_idx]), 1)
+
+    # Order the legs by their first sample; sample_leg maps the samples to the rows
+    order = np.argsort(start, kind='stable')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    sample_leg = np.full(len(leg_ids), -1, dtype=np.int64)
+    sample_leg[valid_idx] = rank[inverse]
+    return LegTable(legs[order], start[order], last[order], count[order], mode_counts[order], sample_leg)
+
+
+def dominant_modes(mode_counts):
+    """The most frequent mode of each leg (the smallest mode index on ties)."""
+    return np.argmax(mode_counts, axis=1)
 
 
 def detect_and_merge_invalid_transitions(leg_ids, atype_array, time_array):
-    """Detect and merge bicycle ↔ vehicle transitions without 'still' between them."""
+    """Detect and merge bicycle ↔ vehicle transitions without 'still' between them.
+
+    The samples must be in time order. leg_ids and atype_array are modified in place.
+    """
     bicycle_mode = ALL_ATYPES.index('on_bicycle')
     vehicle_mode = ALL_ATYPES.index('in_vehicle')
     still_mode = ATYPE_STILL
-    
-    # Get unique leg IDs with their first occurrence times
-    unique_legs = []
-    leg_start_times = {}
-    
-    for i in range(len(leg_ids)):
-        if leg_ids[i] != -1 and leg_ids[i] not in unique_legs:
-            unique_legs.append(leg_ids[i])
-            leg_start_times[leg_ids[i]] = time_array[i]
-    
-    if len(unique_legs) <= 1:
+
+    table = build_leg_table(leg_ids, atype_array)
+    n_legs = len(table.leg_id)
+    if n_legs <= 1:
         return leg_ids
-    
-    # Sort legs by their start times
-    sorted_legs = sorted(unique_legs, key=lambda x: leg_start_times[x])
-    
+
+    modes = dominant_modes(table.mode_counts)
+    # Still samples outside of legs, cumulatively, for counting them between legs
+    still_outside = np.concatenate(([0], np.cumsum((atype_array == still_mode) & (leg_ids == -1))))
+
     # Find invalid transitions
     legs_to_merge = []
-    
-    for i in range(len(sorted_legs) - 1):
-        current_leg = sorted_legs[i]
-        next_leg = sorted_legs[i + 1]
-        
-        current_mode = get_dominant_mode_numpy(leg_ids, atype_array, current_leg)
-        next_mode = get_dominant_mode_numpy(leg_ids, atype_array, next_leg)
-        
-        # Check for invalid bicycle ↔ vehicle transition
-        is_bicycle_to_vehicle = (current_mode == bicycle_mode and next_mode == vehicle_mode)
-        is_vehicle_to_bicycle = (current_mode == vehicle_mode and next_mode == bicycle_mode)
-        
-        if is_bicycle_to_vehicle or is_vehicle_to_bicycle:
-            # Find time range between legs
-            current_end_time = np.max(time_array[leg_ids == current_leg])
-            next_start_time = np.min(time_array[leg_ids == next_leg])
-            
-            # Check if there's enough 'still' time between legs
-            between_mask = (time_array > current_end_time) & (time_array < next_start_time)
-            still_between = np.sum((atype_array[between_mask] == still_mode) & (leg_ids[between_mask] == -1))
-            
-            # Require at least some 'still' samples between bicycle and vehicle (threshold: 3 samples)
-            if still_between < 3:
-                legs_to_merge.append((current_leg, next_leg))
-    
-    # Merge invalid transition legs
+    for i in range(n_legs - 1):
+        if not ({modes[i], modes[i + 1]} == {bicycle_mode, vehicle_mode}):
+            continue
+        # Samples strictly between the end of this leg and the start of the next one
+        lo = np.searchsorted(time_array, time_array[table.end[i]], side='right')
+        hi = np.searchsorted(time_array, time_array[table.start[i + 1]], side='left')
+        still_between = still_outside[hi] - still_outside[lo] if hi > lo else 0
+
+        # Require at least some 'still' samples between bicycle and vehicle (threshold: 3 samples)
+        if still_between < 3:
+            legs_to_merge.append((i, i + 1))
+
+    if not legs_to_merge:
+        return leg_ids
+
+    # Apply the merges on the table. Each row tracks the leg it has been merged
+    # into and its current mode counts.
+    group = np.arange(n_legs)
+    mode_counts = table.mode_counts.copy()
+    forced_mode = np.full(n_legs, -1, dtype=np.int64)
     for leg1, leg2 in legs_to_merge:
-        # Count samples in each leg
-        leg1_count = np.sum(leg_ids == leg1)
-        leg2_count = np.sum(leg_ids == leg2)
-        
+        # A leg that has already been merged into another one has no samples left
+        in1 = group == leg1
+        in2 = group == leg2
+        leg1_count = table.count[in1].sum()
+        leg2_count = table.count[in2].sum()
+
         # Determine which leg to keep and which mode to use
-        if leg1_count >= leg2_count:
-            dominant_leg = leg1
-            merge_target_mode = get_dominant_mode_numpy(leg_ids, atype_array, leg1)
-        else:
-            dominant_leg = leg2
-            merge_target_mode = get_dominant_mode_numpy(leg_ids, atype_array, leg2)
-        
+        dominant_leg = leg1 if leg1_count >= leg2_count else leg2
+        members = group == dominant_leg
+        merge_target_mode = np.argmax(mode_counts[members].sum(axis=0))
+
         # Merge both legs under the same leg_id and transport mode
-        merge_mask = (leg_ids == leg1) | (leg_ids == leg2)
-        leg_ids[merge_mask] = dominant_leg
-        atype_array[merge_mask] = merge_target_mode
-    
+        merged = in1 | in2
+        group[merged] = dominant_leg
+        forced_mode[merged] = merge_target_mode
+        mode_counts[merged] = 0
+        mode_counts[merged, merge_target_mode] = table.count[merged]
+
+    # Expand the merged table back to the samples
+    in_leg = table.sample_leg >= 0
+    rows = table.sample_leg[in_leg]
+    leg_ids[in_leg] = table.leg_id[group[rows]]
+    forced = forced_mode[rows]
+    idx = np.flatnonzero(in_leg)[forced >= 0]
+    atype_array[idx] = forced[forced >= 0]
+
     return leg_ids
 
 
@@ -416,6 +758,9 @@ def get_transport_mode_group(mode):
     return 'other'
 
 
+_TRANSPORT_MODE_GROUP = {mode: group for group, modes in TRANSPORT_MODE_GROUPS.items() for mode in modes}
+
+
 def limit_transportation_methods(df, max_methods=3):
     """
     Limit a trip to maximum 3 transportation method changes.
@@ -434,119 +779,119 @@ def limit_transportation_methods(df, max_methods=3):
     df = df.copy()
     
     # Get only meaningful transport modes (exclude still/unknown)
-    meaningful_mask = df.atype.isin(MEANINGFUL_TRANSPORT_MODES) & (df.leg_id != -1)
+    meaningful_mask = (df.atype.isin(MEANINGFUL_TRANSPORT_MODES) & (df.leg_id != -1)).to_numpy()
     
     if not meaningful_mask.any():
         return df
-    
-    # Work with meaningful rows and create transport groups
-    meaningful_df = df[meaningful_mask].copy()
-    meaningful_df['transport_group'] = meaningful_df.atype.apply(get_transport_mode_group)
-    
-    # Create segments based on consecutive transport groups
-    meaningful_df['group_change'] = meaningful_df.transport_group != meaningful_df.transport_group.shift()
-    meaningful_df['segment_id'] = meaningful_df.group_change.cumsum()
-    
-    # Analyze segments
-    segments = meaningful_df.groupby('segment_id').agg({
-        'transport_group': 'first',
-        'atype': lambda x: x.value_counts().index[0],  # Most frequent atype
-        'time': ['min', 'max'],
-        'leg_id': ['count', 'first', 'last']
-    }).reset_index()
-    
-    # Flatten column names
-    segments.columns = ['segment_id', 'transport_group', 'dominant_atype', 
-                       'start_time', 'end_time', 'sample_count', 'first_leg', 'last_leg']
-    segments['duration'] = (segments.end_time - segments.start_time).dt.total_seconds()
-    
-    unique_groups = segments.transport_group.nunique()
-    
-    # If we already have <= max_methods, return as-is
-    if unique_groups <= max_methods:
+
+    atypes = df.atype.to_numpy()[meaningful_mask]
+    groups = np.array([_TRANSPORT_MODE_GROUP.get(x, 'other') for x in atypes], dtype=object)
+    time = df.time.to_numpy(dtype='datetime64[ns]')[meaningful_mask].astype(np.int64)
+    n = len(atypes)
+
+    # Segments of consecutive transport groups
+    starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+    n_segments = len(starts)
+    sample_segment = np.repeat(np.arange(n_segments), np.diff(np.r_[starts, n]))
+    seg_group = groups[starts]
+
+    if len(set(seg_group)) <= max_methods:
         return df
-    
-    # Create a simpler merging strategy
-    # Step 1: Merge shortest segments with adjacent segments
-    while segments.transport_group.nunique() > max_methods and len(segments) > 1:
-        # Find shortest segment
-        shortest_idx = segments.duration.idxmin()
-        shortest_segment = segments.loc[shortest_idx]
-        
+
+    seg_count = np.diff(np.r_[starts, n])
+    seg_start = np.minimum.reduceat(time, starts)
+    seg_end = np.maximum.reduceat(time, starts)
+
+    # Most frequent atype of each segment, the first occurring one on ties
+    codes, uniques = pd.factorize(atypes)
+    atype_counts = np.zeros((n_segments, len(uniques)), dtype=np.int64)
+    np.add.at(atype_counts, (sample_segment, codes), 1)
+    first_seen = np.full((n_segments, len(uniques)), n, dtype=np.int64)
+    np.minimum.at(first_seen, (sample_segment, codes), np.arange(n))
+    is_max = atype_counts == atype_counts.max(axis=1)[:, None]
+    seg_atype = uniques[np.argmin(np.where(is_max, first_seen, n), axis=1)].astype(object)
+
+    # Merge the shortest segments into their neighbours until few enough groups
+    # remain. The segments form a linked list, and a heap keyed by the duration
+    # (and the position on ties) gives the shortest one; entries for segments
+    # that have changed since are skipped.
+    prev_seg = np.arange(n_segments) - 1
+    next_seg = np.arange(n_segments) + 1
+    next_seg[-1] = -1
+    merged_into = np.arange(n_segments)
+    version = np.zeros(n_segments, dtype=np.int64)
+    group_counts = {}
+    for g in seg_group:
+        group_counts[g] = group_counts.get(g, 0) + 1
+    heap = [(seg_end[i] - seg_start[i], i, 0) for i in range(n_segments)]
+    heapq.heapify(heap)
+    live = n_segments
+
+    while len(group_counts) > max_methods and live > 1:
+        duration, shortest, ver = heapq.heappop(heap)
+        if merged_into[shortest] != shortest or ver != version[shortest]:
+            continue
+        prev, nxt = prev_seg[shortest], next_seg[shortest]
+
         # Determine which adjacent segment to merge with
-        merge_target = None
-        
-        if shortest_idx > 0 and shortest_idx < len(segments) - 1:
+        if prev >= 0 and nxt >= 0:
             # Has both neighbors - choose the one with same group or longer duration
-            prev_segment = segments.loc[shortest_idx - 1]
-            next_segment = segments.loc[shortest_idx + 1]
-            
-            if prev_segment.transport_group == shortest_segment.transport_group:
-                merge_target = shortest_idx - 1
-            elif next_segment.transport_group == shortest_segment.transport_group:
-                merge_target = shortest_idx + 1
-            elif prev_segment.duration >= next_segment.duration:
-                merge_target = shortest_idx - 1
+            if seg_group[prev] == seg_group[shortest]:
+                target = prev
+            elif seg_group[nxt] == seg_group[shortest]:
+                target = nxt
+            elif seg_end[prev] - seg_start[prev] >= seg_end[nxt] - seg_start[nxt]:
+                target = prev
             else:
-                merge_target = shortest_idx + 1
-                
-        elif shortest_idx > 0:
-            # Only has previous neighbor
-            merge_target = shortest_idx - 1
-        elif shortest_idx < len(segments) - 1:
-            # Only has next neighbor
-            merge_target = shortest_idx + 1
+                target = nxt
+        elif prev >= 0:
+            target = prev
         else:
-            # Only one segment left - can't merge
+            target = nxt
+
+        # Merge segments - keep the transport group of the longer segment
+        for g in (seg_group[shortest], seg_group[target]):
+            group_counts[g] -= 1
+        if seg_count[shortest] > seg_count[target]:
+            seg_group[target] = seg_group[shortest]
+            seg_atype[target] = seg_atype[shortest]
+        group_counts[seg_group[target]] = group_counts.get(seg_group[target], 0) + 1
+        for g in list(group_counts):
+            if not group_counts[g]:
+                del group_counts[g]
+        seg_start[target] = min(seg_start[shortest], seg_start[target])
+        seg_end[target] = max(seg_end[shortest], seg_end[target])
+        seg_count[target] += seg_count[shortest]
+        version[target] += 1
+        heapq.heappush(heap, (seg_end[target] - seg_start[target], target, version[target]))
+
+        # Unlink the shortest segment
+        merged_into[shortest] = target
+        if prev >= 0:
+            next_seg[prev] = nxt
+        if nxt >= 0:
+            prev_seg[nxt] = prev
+        live -= 1
+
+    # Resolve the segment each original segment ended up in
+    final = merged_into.copy()
+    while True:
+        nxt_final = final[final]
+        if np.array_equal(nxt_final, final):
             break
-        
-        if merge_target is not None:
-            target_segment = segments.loc[merge_target]
-            
-            # Merge segments - keep the transport group of the longer segment
-            if shortest_segment.sample_count > target_segment.sample_count:
-                # Shortest is actually longer, keep its attributes
-                merged_group = shortest_segment.transport_group
-                merged_atype = shortest_segment.dominant_atype
-            else:
-                # Target is longer, keep its attributes
-                merged_group = target_segment.transport_group
-                merged_atype = target_segment.dominant_atype
-            
-            # Update target segment with merged data
-            segments.loc[merge_target, 'end_time'] = max(shortest_segment.end_time, target_segment.end_time)
-            segments.loc[merge_target, 'start_time'] = min(shortest_segment.start_time, target_segment.start_time)
-            segments.loc[merge_target, 'duration'] = (segments.loc[merge_target, 'end_time'] - 
-                                                    segments.loc[merge_target, 'start_time']).total_seconds()
-            segments.loc[merge_target, 'sample_count'] += shortest_segment.sample_count
-            segments.loc[merge_target, 'transport_group'] = merged_group
-            segments.loc[merge_target, 'dominant_atype'] = merged_atype
-            
-            # Mark shortest segment's rows for merging
-            segment_mask = meaningful_df.segment_id == shortest_segment.segment_id
-            meaningful_df.loc[segment_mask, 'segment_id'] = target_segment.segment_id
-            
-            # Remove shortest segment from segments list
-            segments = segments.drop(shortest_idx).reset_index(drop=True)
-    
-    # Apply changes back to original dataframe
-    # Create mapping from segment_id to new atype
-    segment_atype_map = dict(zip(segments.segment_id, segments.dominant_atype))
-    
-    # Update meaningful rows with new atypes
-    for idx, row in meaningful_df.iterrows():
-        new_atype = segment_atype_map.get(row.segment_id)
-        if new_atype and new_atype != row.atype:
-            df.loc[idx, 'atype'] = new_atype
-    
+        final = nxt_final
+
+    # Apply changes back to original dataframe in one go
+    atype_col = df.columns.get_loc('atype')
+    df.iloc[np.flatnonzero(meaningful_mask), atype_col] = seg_atype[final[sample_segment]]
+
     return df
 
 
 def split_trip_legs(conn, uid, df, include_all=False, user_has_car=True, limit_methods=False):
     assert len(df.trip_id.unique()) == 1
 
-    s = df['time'].dt.tz_convert(None) - pd.Timestamp('1970-01-01')
-    df['epoch_ts'] = s / pd.Timedelta('1s')
+    df['epoch_ts'] = epoch_seconds(df['time'])
     df['calc_speed'] = df.speed
     df['int_atype'] = df.atype.map(ALL_ATYPES.index).astype(int)
     df['leg_id'] = filter_legs(
@@ -573,16 +918,25 @@ def split_trip_legs(conn, uid, df, include_all=False, user_has_car=True, limit_m
 
     df = df.copy()
 
+    vehicle_legs = []
     for leg_id in df.leg_id.unique():
         leg_df = df[df.leg_id == leg_id].copy()
         if leg_df.iloc[0].atype != 'in_vehicle':
             continue
+        window = TransitLocationIndex.leg_window(leg_df)
+        if window is not None:
+            vehicle_legs.append((leg_id, leg_df, window))
 
+    transit_index = None
+    if vehicle_legs:
         try:
-            transit_locs = get_transit_locations(conn, uid, leg_df.time.min(), leg_df.time.max())
+            transit_index = TransitLocationIndex.load(conn, [window for _, _, window in vehicle_legs])
         except pd.io.sql.DatabaseError as e:
             logger.error('Error when querying transit locations from the db.', exc_info=e)
-            continue
+            vehicle_legs = []
+
+    for leg_id, leg_df, window in vehicle_legs:
+        transit_locs = transit_index.leg_locations(window).copy()
         if not len(transit_locs):
             continue
         transit_locs['time'] = transit_locs.epoch_time
@@ -591,7 +945,9 @@ def split_trip_legs(conn, uid, df, include_all=False, user_has_car=True, limit_m
         transit_type_by_id = {vech: d.iloc[0].route_type for vech, d in transit_loc_by_id.items()}
 
         leg_df['time'] = df['epoch_ts'].astype(float)
-        transit_probs = transit_prob_ests_糞(leg_df, transit_loc_by_id)
+        # Without a car, even distant vehicles are accepted, so none can be rejected early
+        max_reject_dist = max(MAX_DISTANCE_BY_TRANSIT_TYPE.values()) if user_has_car else None
+        transit_probs = transit_prob_ests_batched(leg_df, transit_loc_by_id, max_distance=max_reject_dist)
         transit_probs = sorted(
             [(key, dist) for key, dist in transit_probs.items() if dist == dist],
             key=lambda p: p[1]
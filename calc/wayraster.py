@@ -0,0 +1,216 @@
+import json
+import logging
+import math
+import os
+
+import numpy as np
+from scipy.ndimage import distance_transform_edt
+
+from utils.perf import PerfCounter
+
+
+logger = logging.getLogger(__name__)
+
+# Distance from each grid cell to the nearest car or rail way, precomputed
+# from the OSM materialised views. The distances are stored as uint8 in
+# DISTANCE_UNIT steps so that a 5 m grid over the whole service area fits
+# comfortably in the page cache; the array file is memory-mapped, so all
+# the processes on a host share the same pages.
+
+DEFAULT_RESOLUTION = 5.0
+DEFAULT_MAX_DISTANCE = 50.0
+DISTANCE_UNIT = 0.25
+NO_WAY = 255
+assert DEFAULT_MAX_DISTANCE / DISTANCE_UNIT < NO_WAY
+
+# Cells processed at once when building
+BUILD_TILE_SIZE = 2000
+
+VEHICLE_WAY_VIEWS = ('planet_osm_car_ways', 'planet_osm_rail_ways')
+
+
+# The raster file starts with a JSON header giving the grid origin,
+# resolution and shape, followed by the grid (padded to DATA_ALIGNMENT).
+# Keeping them in one file lets a rebuild replace both at once.
+FILE_MAGIC = b'MOCAFWAYRASTER1\n'
+DATA_ALIGNMENT = 4096
+
+
+def write_header(f, meta) -> int:
+    """Write the file header and return the offset of the grid data."""
+    header = json.dumps(meta).encode('utf8')
+    f.write(FILE_MAGIC)
+    f.write(len(header).to_bytes(4, 'little'))
+    f.write(header)
+    offset = -(-f.tell() // DATA_ALIGNMENT) * DATA_ALIGNMENT
+    f.write(b'\0' * (offset - f.tell()))
+    return offset
+
+
+def read_header(f):
+    """Return the metadata of the raster file and the offset of the grid data."""
+    if f.read(len(FILE_MAGIC)) != FILE_MAGIC:
+        raise ValueError('Not a way distance raster file')
+    size = int.from_bytes(f.read(4), 'little')
+    meta = json.loads(f.read(size).decode('utf8'))
+    offset = -(-f.tell() // DATA_ALIGNMENT) * DATA_ALIGNMENT
+    return meta, offset
+
+
+class WayDistanceRaster:
+    def __init__(self, grid, x0, y0, resolution, max_distance):
+        self.grid = grid
+        # (x0, y0) is the south-west corner of the grid, rows go northwards
+        self.x0 = x0
+        self.y0 = y0
+        self.resolution = resolution
+        self.max_distance = max_distance
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            meta, offset = read_header(f)
+        grid = np.memmap(path, dtype=np.uint8, mode='r', offset=offset, shape=tuple(meta['shape']))
+        return cls(grid, meta['x0'], meta['y0'], meta['resolution'], meta['max_distance'])
+
+    def lookup(self, x, y):
+        """Return the distances (in meters) to the nearest vehicle way for the
+        points in EPSG:3067. Points outside the grid or further away than
+        max_distance from any way get NaN."""
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        ny, nx = self.grid.shape
+        with np.errstate(invalid='ignore'):
+            col = np.floor((x - self.x0) / self.resolution)
+            row = np.floor((y - self.y0) / self.resolution)
+            inside = (col >= 0) & (col < nx) & (row >= 0) & (row < ny)
+        out = np.full(len(x), np.nan)
+        vals = self.grid[row[inside].astype(np.int64), col[inside].astype(np.int64)]
+        dist = vals * DISTANCE_UNIT
+        dist[vals == NO_WAY] = np.nan
+        out[inside] = dist
+        return out
+
+
+# The rasters loaded by this process: path -> ((inode, mtime) of the file, raster)
+_loaded_rasters = {}
+
+
+def get_way_distance_raster(path):
+    """Return the raster at path, or None if it hasn't been built.
+
+    The file is checked on every call, so a raster built (or rebuilt) after
+    the process started is picked up.
+    """
+    if not path:
+        return None
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    version = (stat.st_ino, stat.st_mtime_ns)
+    loaded = _loaded_rasters.get(path)
+    if loaded is None or loaded[0] != version:
+        loaded = _loaded_rasters[path] = (version, WayDistanceRaster.load(path))
+    return loaded[1]
+
+
+def read_way_points(cursor, bounds, resolution, srid):
+    # Densify the ways so that every grid cell a way passes through gets a point
+    xmin, ymin, xmax, ymax = bounds
+    parts = []
+    for view in VEHICLE_WAY_VIEWS:
+        parts.append(f"""
+            SELECT (ST_DumpPoints(ST_Segmentize(ST_Intersection(way, env.geom), %(step)s))).geom AS geom
+            FROM {view}, env
+            WHERE way && env.geom
+        """)
+    query = f"""
+        WITH env AS (SELECT ST_MakeEnvelope(%(xmin)s, %(ymin)s, %(xmax)s, %(ymax)s, %(srid)s) AS geom)
+        SELECT ST_X(p.geom), ST_Y(p.geom) FROM (
+            {' UNION ALL '.join(parts)}
+        ) AS p
+    """
+    cursor.execute(query, dict(
+        xmin=xmin, ymin=ymin, xmax=xmax, ymax=ymax, srid=srid, step=resolution / 2,
+    ))
+    rows = cursor.fetchall()
+    if not rows:
+        return np.empty((0, 2))
+    return np.array(rows, dtype=np.float64)
+
+
+def read_way_extent(cursor):
+    parts = ' UNION ALL '.join(f'SELECT way FROM {view}' for view in VEHICLE_WAY_VIEWS)
+    cursor.execute(f'SELECT ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e) FROM (SELECT ST_Extent(way) AS e FROM ({parts}) AS w) AS x')
+    return cursor.fetchone()
+
+
+def build_way_distance_raster(
+    conn, path, srid, bounds=None, resolution=DEFAULT_RESOLUTION, max_distance=DEFAULT_MAX_DISTANCE,
+):
+    """Rasterise the vehicle ways into a distance grid and save it to path.
+
+    The grid is computed in tiles, with enough overlap that ways just outside
+    of a tile are accounted for.
+    """
+    if max_distance / DISTANCE_UNIT >= NO_WAY:
+        raise ValueError('max_distance too large for the distance encoding')
+
+    pc = PerfCounter('build way raster', show_time_to_last=True)
+    with conn.cursor() as cursor:
+        if bounds is None:
+            bounds = read_way_extent(cursor)
+        xmin, ymin, xmax, ymax = bounds
+        x0 = math.floor((xmin - max_distance) / resolution) * resolution
+        y0 = math.floor((ymin - max_distance) / resolution) * resolution
+        nx = int(math.ceil((xmax + max_distance - x0) / resolution))
+        ny = int(math.ceil((ymax + max_distance - y0) / resolution))
+        logger.info('Building a %d x %d way distance grid' % (nx, ny))
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            offset = write_header(f, dict(
+                x0=x0, y0=y0, resolution=resolution, max_distance=max_distance, srid=srid, shape=[ny, nx],
+            ))
+            f.truncate(offset + nx * ny)
+        grid = np.memmap(tmp_path, dtype=np.uint8, mode='r+', offset=offset, shape=(ny, nx))
+        margin = int(math.ceil(max_distance / resolution)) + 1
+
+        for row0 in range(0, ny, BUILD_TILE_SIZE):
+            for col0 in range(0, nx, BUILD_TILE_SIZE):
+                rows = min(BUILD_TILE_SIZE, ny - row0)
+                cols = min(BUILD_TILE_SIZE, nx - col0)
+                # Tile with the margin, in cells and in map coordinates
+                tx0 = x0 + (col0 - margin) * resolution
+                ty0 = y0 + (row0 - margin) * resolution
+                tile_shape = (rows + 2 * margin, cols + 2 * margin)
+                points = read_way_points(cursor, (
+                    tx0, ty0, tx0 + tile_shape[1] * resolution, ty0 + tile_shape[0] * resolution
+                ), resolution, srid)
+
+                if not len(points):
+                    grid[row0:row0 + rows, col0:col0 + cols] = NO_WAY
+                    continue
+
+                no_way = np.ones(tile_shape, dtype=bool)
+                pcol = np.floor((points[:, 0] - tx0) / resolution).astype(np.int64)
+                prow = np.floor((points[:, 1] - ty0) / resolution).astype(np.int64)
+                ok = (pcol >= 0) & (pcol < tile_shape[1]) & (prow >= 0) & (prow < tile_shape[0])
+                no_way[prow[ok], pcol[ok]] = False
+
+                dist = distance_transform_edt(no_way, sampling=resolution)
+                dist = dist[margin:margin + rows, margin:margin + cols]
+                vals = np.round(dist / DISTANCE_UNIT)
+                vals[dist > max_distance] = NO_WAY
+                grid[row0:row0 + rows, col0:col0 + cols] = vals.astype(np.uint8)
+            pc.display('%d / %d rows done' % (min(row0 + BUILD_TILE_SIZE, ny), ny))
+
+        grid.flush()
+        del grid
+
+    # Replace the old raster atomically, so that running processes keep
+    # using their (unlinked) mapping of the old file.
+    # The metadata is in the same file, so a loader never sees a new grid
+    # with the old origin or resolution.
+    os.replace(tmp_path, path)
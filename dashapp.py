@@ -158,10 +158,10 @@ def make_map_component(xstart=None, xend=None):
     df.speed = (df.speed * 3.6).fillna(value=-1)
     df = df[[
         'lon', 'lat', 'loc_error', 'color', 'colorf', 'aconf', 'speed', 'time_str', 'atype',
-        'battery_charging', 'atypef', 'closest_car_way_name', 'closest_car_way_dist', 'pos'
+        'battery_charging', 'atypef', 'closest_car_way_id', 'closest_car_way_dist', 'pos'
     ]]
     df.atypef = df.atypef.fillna(value='')
-    df.closest_car_way_name = df.closest_car_way_name.fillna(value='')
+    df.closest_car_way_id = df.closest_car_way_id.fillna(value='')
     df.closest_car_way_dist = df.closest_car_way_dist.round(1).fillna(value=-1)
     df.battery_charging = df.battery_charging.fillna(value=False)
     df['description'] = df[['atype', 'atypef']].apply(
@@ -201,7 +201,7 @@ def make_map_component(xstart=None, xend=None):
         'html': '{time_str}<br />{description}<br />Speed: {speed} km/h<br />' +
             'Loc. error: {loc_error} m<br />' +
             'Battery charging: {battery_charging}<br />'
-            'Closest car way: {closest_car_way_name}<br />'
+            'Closest car way: {closest_car_way_id}<br />'
             'Closest car way distance: {closest_car_way_dist} m'
     }
 
@@ -522,7 +522,7 @@ def render_output(new_path, disable_filters, show_probs):
 
     if locations_uuid is None or locations_uuid != new_uid or filters_enabled != new_filtered:
         pc.display('reading trips for %s' % new_uid)
-        df = read_locations(conn, new_uid, include_all=True, start_time='2022-01-01')
+        df = read_locations(conn, new_uid, include_all=True, start_time='2022-01-01', reader='sql')
         pc.display('trips read (%d rows)' % len(df))
         df.time = pd.to_datetime(df.time, utc=True)
 
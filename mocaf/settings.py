@@ -52,6 +52,11 @@ env = environ.Env(
     PROMETHEUS_EXPORT_MIGRATIONS=(bool, False),
     POSTGRES_DB=(str, 'mocaf'),
     POSTGRES_PASSWORD=(str, 'abcdef'),
+    TRIP_FILTER_WORKERS=(int, 1),
+    WAY_DISTANCE_RASTER_PATH=(str, ''),
+    PERSONAL_MODE_PRIOR_HALF_LIFE_DAYS=(float, 0),
+    MUNICIPALITY_AREA_TYPE=(str, 'fi:kunta'),
+    TRIP_GENERATION_CHUNK_SIZE=(int, 10),
 )
 PROMETHEUS_EXPORT_MIGRATIONS = env('PROMETHEUS_EXPORT_MIGRATIONS')
 
@@ -239,6 +244,26 @@ CELERY_WORKER_SEND_TASK_EVENTS = True
 # CELERY_TASK_SEND_SENT_EVENT = True  # required only for danihodovic/celery-exporter
 # CELERY_WORKER_CONCURRENCY = 4
 
+# Number of processes the generate_trips management command filters trips with
+TRIP_FILTER_WORKERS = env('TRIP_FILTER_WORKERS')
+
+# Number of devices in each trip generation task the generate_new_trips
+# beat task fans out to the trips queue
+TRIP_GENERATION_CHUNK_SIZE = env('TRIP_GENERATION_CHUNK_SIZE')
+
+# Memory-mapped grid of distances to the nearest vehicle way (see the
+# build_way_raster management command). If empty or not built yet, the
+# distances stored with the location samples are used.
+WAY_DISTANCE_RASTER_PATH = env('WAY_DISTANCE_RASTER_PATH')
+
+# Half-life of the legs in the personal mode prior of trip generation. With
+# 0, all the legs of a device count the same.
+PERSONAL_MODE_PRIOR_HALF_LIFE_DAYS = env('PERSONAL_MODE_PRIOR_HALF_LIFE_DAYS')
+
+# Analytics area type with the municipality polygons the start and end
+# municipalities of survey trips are looked up from (see import_areas).
+MUNICIPALITY_AREA_TYPE = env('MUNICIPALITY_AREA_TYPE')
+
 # Application definition
 
 INSTALLED_APPS = [
@@ -3,7 +3,6 @@ import logging
 from typing import Optional
 import sentry_sdk
 import geopandas as gpd
-import requests
 from sqlalchemy.util import has_compiled_ext
 
 from calc.trips import (
@@ -20,12 +19,11 @@ from django.db.models import Q, Exists, Max, OuterRef
 from django.contrib.gis.gdal import SpatialReference, CoordTransform
 from django.contrib.gis.geos import Point
 from django.utils import timezone
-from psycopg2.extras import execute_values
+from poll.municipalities import get_municipality_resolver
+from trips.generate import copy_leg_locations, has_invalid_speeds, leg_location_columns
 from trips.models import Device
 from trips_ingest.models import Location
 from poll.models import (
-    MUNICIPALITY_CHOICES,
-    MUNICIPALITY_OTHER,
     SurveyInfo,
     Trips,
     Legs,
@@ -50,20 +48,6 @@ def make_point(x, y):
     return pnt
 
 
-def generate_leg_location_rows(leg, df):
-    rows = df.apply(
-        lambda row: (
-            leg.id,
-            row.lon,
-            row.lat,
-            "%s" % str(row.time),
-            row.speed,
-        ),
-        axis=1,
-    )
-    return list(rows.values)
-
-
 class GeneratorError(Exception):
     pass
 
@@ -83,32 +67,14 @@ class SurveyTripGenerator:
             "train": "train",
         }
 
-    def insert_survey_leg_locations(self, rows):
+    def insert_survey_leg_locations(self, legs):
         # Having "None" as the speed column is a periodically recurring
         # issue. Raise error to continue with other uuids if None found
         # in speed column
-        try:
-            next(x for x in rows if x[4] is None)
+        if has_invalid_speeds(legs):
             raise GeneratorError("Encountered invalid value None as speed for leg")
-        except StopIteration:
-            pass
         pc = PerfCounter("save_locations", show_time_to_last=True)
-        query = f"""INSERT INTO {LEGS_LOCATION_TABLE} (
-            leg_id, loc, time, speed
-        ) VALUES %s"""
-
-        with connection.cursor() as cursor:
-            pc.display("after cursor")
-            value_template = """(
-                    %s,
-                    ST_SetSRID(ST_MakePoint(%s, %s), 4326),
-                    %s :: timestamptz,
-                    %s
-            )"""
-            execute_values(
-                cursor, query, rows, template=value_template, page_size=10000
-            )
-
+        copy_leg_locations(LEGS_LOCATION_TABLE, legs)
         pc.display("after insert")
 
     def save_survey_leg(self, trip, df, last_ts, pc):
@@ -138,55 +104,19 @@ class SurveyTripGenerator:
             received_at=received_at,
         )
         leg.save()
-        rows = generate_leg_location_rows(leg, df)
+        rows = leg_location_columns(leg, df)
         pc.display(str(leg))
 
         return rows, end.time
 
-    def save_survey_trip_town(self, tripObj, df, starttown):
-        if starttown:
-            time_loc = df.iloc[0][["time", "x", "y"]]
-        else:
-            time_loc = df.iloc[-1][["time", "x", "y"]]
-        mycoord = SpatialReference(4326)
-        gcoord = SpatialReference(LOCAL_2D_CRS)
-        trans = CoordTransform(gcoord, mycoord)
-
-        pnt = Point(time_loc.x, time_loc.y, srid=LOCAL_2D_CRS)
-        pnt.transform(trans)
-        lat = pnt.y
-        lon = pnt.x
-        coord_link = (
-            "https://nominatim.openstreetmap.org/reverse?format=json&lat="
-            + str(lat)
-            + "&lon="
-            + str(lon)
-            + "&zoom=10&addressdetails=10"
+    def save_survey_trip_towns(self, tripObj, start_df, end_df):
+        # Both endpoints are resolved at once from the local municipality polygons
+        start = start_df.iloc[0]
+        end = end_df.iloc[-1]
+        tripObj.start_municipality, tripObj.end_municipality = get_municipality_resolver().lookup(
+            [start.x, end.x], [start.y, end.y]
         )
-        headers = {"User-Agent": "mocaf"}
-        request_json = requests.get(coord_link, headers=headers).json()
-
-        # towndict = {"Tampere": "Tampere", "Kangasala": "Kangasala", "Pirkkala": "Pirkkala",
-        #             "Nokia": "Nokia", "Ylöjärvi": "Ylojarvi", "Lempäälä": "Lempaala",
-        #             "Vesilahti": "Vesilahti", "Orivesi": "Orivesi"}
-
-        town = MUNICIPALITY_OTHER
-
-        if request_json.get("name"):
-            start_town = request_json.get("name")
-
-            municipalities = [x[0] for x in MUNICIPALITY_CHOICES]
-            if start_town in municipalities:
-                town = start_town
-
-        if starttown:
-            tripObj.start_municipality = town
-        else:
-            tripObj.end_municipality = town
-
-        tripObj.save()
-
-        return
+        tripObj.save(update_fields=["start_municipality", "end_municipality"])
 
     def save_trip(self, device, df, default_variants, uuid, partisipant):
         pc = PerfCounter("generate_trips", show_time_to_last=True)
@@ -255,24 +185,23 @@ class SurveyTripGenerator:
             )
             survey_trip.save()
             pc.display("survey trip %d saved" % survey_trip.id)
-            first_leg = True
+            first_leg_df = None
             leg_ids = df.leg_id.unique()
             leg_df = None
             last_ts = df.time.min()
             for leg_id in leg_ids:
                 leg_df = df[df.leg_id == leg_id]
 
-                if first_leg:
-                    first_leg = False
-                    self.save_survey_trip_town(survey_trip, leg_df, True)
+                if first_leg_df is None:
+                    first_leg_df = leg_df
 
                 leg_rows_survey, last_ts = self.save_survey_leg(
                     survey_trip, leg_df, last_ts, pc
                 )
-                all_rows_survey += leg_rows_survey
+                all_rows_survey.append(leg_rows_survey)
 
-            if not first_leg and leg_df is not None:
-                self.save_survey_trip_town(survey_trip, leg_df, False)
+            if first_leg_df is not None:
+                self.save_survey_trip_towns(survey_trip, first_leg_df, leg_df)
 
             pc.display("generated %d survey legs" % len(leg_ids))
             self.insert_survey_leg_locations(all_rows_survey)
@@ -0,0 +1,76 @@
+import logging
+from functools import lru_cache
+
+import numpy as np
+from django.conf import settings
+from shapely import wkb
+from shapely.geometry import Point
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+
+from analytics.models import Area
+from poll.models import MUNICIPALITY_CHOICES, MUNICIPALITY_OTHER
+
+
+logger = logging.getLogger(__name__)
+
+
+class MunicipalityResolver:
+    """Finds the municipalities of points from the municipality polygons.
+
+    The polygons are kept in memory in an STRtree, so a lookup only tests
+    the prepared polygons whose bounding boxes contain the point. The points
+    are in the local coordinate system of the analytics areas
+    (settings.LOCAL_SRS).
+    """
+
+    def __init__(self, names, geometries):
+        self.names = list(names)
+        self.geometries = list(geometries)
+        self.prepared = [prep(geom) for geom in self.geometries]
+        self.tree = STRtree(self.geometries) if self.geometries else None
+        # Shapely < 2.0 returns the geometries instead of their indices
+        self.geometry_idx = {id(geom): idx for idx, geom in enumerate(self.geometries)}
+
+    @classmethod
+    def load(cls, area_type=None):
+        if area_type is None:
+            area_type = settings.MUNICIPALITY_AREA_TYPE
+        areas = Area.objects.filter(type__identifier=area_type).values_list("name", "geometry")
+        names = []
+        geometries = []
+        for name, geometry in areas:
+            names.append(name)
+            geometries.append(wkb.loads(bytes(geometry.wkb)))
+        if not names:
+            logger.warning(
+                "No areas of type %s, municipalities can't be resolved" % area_type
+            )
+        return cls(names, geometries)
+
+    def find(self, x, y):
+        """Return the name of the area containing the point, or None."""
+        if self.tree is None:
+            return None
+        point = Point(x, y)
+        for hit in self.tree.query(point):
+            if not isinstance(hit, (int, np.integer)):
+                hit = self.geometry_idx[id(hit)]
+            if self.prepared[hit].contains(point):
+                return self.names[hit]
+        return None
+
+    def lookup(self, xs, ys):
+        """Return the survey municipalities (MUNICIPALITY_CHOICES) of the points."""
+        municipalities = {x[0] for x in MUNICIPALITY_CHOICES}
+        out = []
+        for x, y in zip(xs, ys):
+            name = self.find(x, y)
+            out.append(name if name in municipalities else MUNICIPALITY_OTHER)
+        return out
+
+
+@lru_cache(maxsize=None)
+def get_municipality_resolver():
+    """Return the resolver of this process, loading the polygons on first use."""
+    return MunicipalityResolver.load()
@@ -0,0 +1,60 @@
+import pytest
+from django.conf import settings
+from django.contrib.gis.geos import MultiPolygon, Polygon
+from shapely.geometry import Polygon as ShapelyPolygon, box
+
+from analytics.models import Area, AreaType
+from poll.models import MUNICIPALITY_OTHER
+from poll.municipalities import MunicipalityResolver
+
+X0, Y0 = 320000, 6820000
+
+
+def make_resolver():
+    # An L-shaped Tampere whose bounding box covers the square of Nokia,
+    # and an area that isn't one of the survey municipalities
+    tampere = ShapelyPolygon([
+        (X0, Y0), (X0 + 2000, Y0), (X0 + 2000, Y0 + 1000), (X0 + 1000, Y0 + 1000),
+        (X0 + 1000, Y0 + 2000), (X0, Y0 + 2000),
+    ])
+    nokia = box(X0 + 1200, Y0 + 1200, X0 + 1800, Y0 + 1800)
+    helsinki = box(X0 + 5000, Y0, X0 + 6000, Y0 + 1000)
+    return MunicipalityResolver(["Tampere", "Nokia", "Helsinki"], [tampere, nokia, helsinki])
+
+
+def test_municipality_resolver_find():
+    resolver = make_resolver()
+    assert resolver.find(X0 + 500, Y0 + 1500) == "Tampere"
+    assert resolver.find(X0 + 1500, Y0 + 500) == "Tampere"
+    assert resolver.find(X0 + 1500, Y0 + 1500) == "Nokia"
+    # Inside the bounding box of Tampere but outside of both polygons
+    assert resolver.find(X0 + 1900, Y0 + 1900) is None
+    assert resolver.find(X0 + 5500, Y0 + 500) == "Helsinki"
+    assert resolver.find(X0 - 100, Y0) is None
+
+
+def test_municipality_resolver_lookup():
+    resolver = make_resolver()
+    xs = [X0 + 500, X0 + 1500, X0 + 1900, X0 + 5500]
+    ys = [Y0 + 1500, Y0 + 1500, Y0 + 1900, Y0 + 500]
+    assert resolver.lookup(xs, ys) == ["Tampere", "Nokia", MUNICIPALITY_OTHER, MUNICIPALITY_OTHER]
+    assert resolver.lookup([], []) == []
+
+
+def test_municipality_resolver_without_areas():
+    resolver = MunicipalityResolver([], [])
+    assert resolver.find(X0, Y0) is None
+    assert resolver.lookup([X0], [Y0]) == [MUNICIPALITY_OTHER]
+
+
+@pytest.mark.django_db
+def test_municipality_resolver_load():
+    area_type = AreaType.objects.create(identifier="fi:kunta", name="Kunta")
+    other_type = AreaType.objects.create(identifier="fi:osa-alue", name="Osa-alue")
+    geometry = MultiPolygon(Polygon.from_bbox((X0, Y0, X0 + 1000, Y0 + 1000)), srid=settings.LOCAL_SRS)
+    Area.objects.create(type=area_type, identifier="837", name="Tampere", geometry=geometry)
+    Area.objects.create(type=other_type, identifier="1", name="Keskusta", geometry=geometry)
+
+    resolver = MunicipalityResolver.load("fi:kunta")
+    assert resolver.names == ["Tampere"]
+    assert resolver.lookup([X0 + 500, X0 + 1500], [Y0 + 500, Y0 + 500]) == ["Tampere", MUNICIPALITY_OTHER]
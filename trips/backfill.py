@@ -0,0 +1,147 @@
+import logging
+import multiprocessing
+import time
+from multiprocessing.connection import wait
+
+from django.db import connections, transaction
+from django.db.models import Count, Sum
+from django.utils import timezone
+
+from trips_ingest.models import Location
+from .generate import TripGenerator
+from .models import Device, TripBackfillDevice
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds between the progress reports
+REPORT_INTERVAL = 30
+# Seconds to wait before claiming a device again whose trips were being
+# generated by someone else
+LOCKED_DEVICE_RETRY_INTERVAL = 5
+
+
+def run_backfill_worker(backfill, write_slots, force, smooth):
+    # Runs in a forked process; the connections of the parent were closed
+    # before forking, so this process opens its own.
+    generator = TripGenerator(force=force, smooth=smooth, write_slots=write_slots)
+    generator.begin()
+    while True:
+        obj = TripBackfillDevice.claim(backfill)
+        transaction.commit()
+        if obj is None:
+            break
+        with generator.device_lock(obj.uuid) as locked:
+            if not locked:
+                # The new trips of the device are being generated; put it
+                # back and claim it again after a while.
+                TripBackfillDevice.objects.filter(id=obj.id).update(started_at=None)
+                transaction.commit()
+                time.sleep(LOCKED_DEVICE_RETRY_INTERVAL)
+                continue
+            try:
+                rows = generator.generate_trips(obj.uuid, obj.start_time, obj.end_time)
+            except Exception as e:
+                transaction.rollback()
+                logger.exception('%s: Trip generation failed' % obj.uuid)
+                TripBackfillDevice.objects.filter(id=obj.id).update(error=str(e))
+            else:
+                TripBackfillDevice.objects.filter(id=obj.id).update(rows=rows or 0, finished_at=timezone.now())
+            transaction.commit()
+    generator.end()
+
+
+class TripBackfill:
+    """Regenerates the trips of many devices in parallel worker processes.
+
+    The devices of a run are recorded in TripBackfillDevice, so a run that
+    was interrupted continues with the unfinished devices when started
+    again with the same name.
+    """
+
+    def __init__(self, name, processes=1, max_writers=None, force=False, smooth=False, log=None):
+        self.name = name
+        self.processes = processes
+        self.max_writers = max_writers
+        self.force = force
+        self.smooth = smooth
+        self.log = log or logger.info
+
+    def devices(self):
+        return TripBackfillDevice.objects.filter(backfill=self.name)
+
+    def add_devices(self, uuids=None, start_time=None, end_time=None) -> int:
+        """Add the devices with samples between start_time and end_time to the run.
+
+        Returns the number of devices added. Devices already in the run keep
+        their progress and time range.
+        """
+        qs = Location.objects.filter(deleted_at__isnull=True)
+        qs = qs.filter(uuid__in=Device.objects.values('uuid'))
+        if uuids:
+            qs = qs.filter(uuid__in=uuids)
+        if start_time is not None:
+            qs = qs.filter(time__gte=start_time)
+        if end_time is not None:
+            qs = qs.filter(time__lt=end_time)
+        counts = qs.values('uuid').annotate(count=Count('*')).order_by()
+        existing = set(self.devices().values_list('uuid', flat=True))
+        objs = [
+            TripBackfillDevice(
+                backfill=self.name, uuid=row['uuid'], start_time=start_time, end_time=end_time,
+                expected_rows=row['count'],
+            ) for row in counts if row['uuid'] not in existing
+        ]
+        TripBackfillDevice.objects.bulk_create(objs)
+        return len(objs)
+
+    def report(self, started_at, rows_before):
+        finished = self.devices().filter(finished_at__isnull=False)
+        stats = finished.aggregate(rows=Sum('rows'), devices=Count('id'))
+        remaining = self.devices().filter(finished_at__isnull=True).aggregate(
+            rows=Sum('expected_rows'), devices=Count('id'),
+        )
+        rows = (stats['rows'] or 0) - rows_before
+        elapsed = time.monotonic() - started_at
+        rate = rows / elapsed if elapsed > 0 else 0
+        if rate > 0:
+            eta = '%d min' % ((remaining['rows'] or 0) / rate / 60)
+        else:
+            eta = 'unknown'
+        self.log('%s: %d devices done, %d left, %.0f rows/s, ETA %s' % (
+            self.name, stats['devices'], remaining['devices'], rate, eta,
+        ))
+
+    def run(self):
+        # Devices left started by an interrupted run are claimed again
+        self.devices().filter(finished_at__isnull=True).update(started_at=None, error=None)
+        rows_before = self.devices().aggregate(rows=Sum('rows'))['rows'] or 0
+
+        ctx = multiprocessing.get_context('fork')
+        write_slots = ctx.BoundedSemaphore(self.max_writers) if self.max_writers else None
+        # The workers must not share the connections of this process
+        connections.close_all()
+        workers = [
+            ctx.Process(target=run_backfill_worker, args=(self.name, write_slots, self.force, self.smooth))
+            for _ in range(self.processes)
+        ]
+        for worker in workers:
+            worker.start()
+
+        started_at = time.monotonic()
+        next_report = started_at + REPORT_INTERVAL
+        alive = workers
+        while alive:
+            wait([worker.sentinel for worker in alive], timeout=max(next_report - time.monotonic(), 0))
+            alive = [worker for worker in alive if worker.is_alive()]
+            if time.monotonic() >= next_report:
+                self.report(started_at, rows_before)
+                next_report += REPORT_INTERVAL
+        self.report(started_at, rows_before)
+
+        for worker in workers:
+            if worker.exitcode:
+                self.log('%s: Worker %d exited with code %d' % (self.name, worker.pid, worker.exitcode))
+        failed = self.devices().filter(error__isnull=False).count()
+        if failed:
+            self.log('%s: Trip generation failed for %d devices' % (self.name, failed))
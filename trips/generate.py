@@ -1,26 +1,32 @@
-from datetime import datetime, timedelta, date
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from datetime import timedelta, date
 import logging
-from typing import Optional
+import math
 import sentry_sdk
-import geopandas as gpd
-import requests
+import numpy as np
 
-from calc.personal_emphasis import user_mode_prob_ests, transform_probs_to_trajectory_probs, similar_legs_by_location, \
-    calculate_mode_probs
+from calc.pgcopy import copy_from_arrays
+from calc.personal_emphasis import user_mode_prob_ests, transform_probs_to_trajectory_probs, LegEndpointIndex
+from calc.dragimm import filter_bank_state_from_dict, filter_bank_state_to_dict
+from calc.filterpool import TripFilterPool
+from calc.wayraster import get_way_distance_raster
 from calc.trips import (
-    LOCAL_2D_CRS, read_locations, read_uuids, split_trip_legs, filter_trips
+    LOCAL_2D_CRS, MINS_BETWEEN_TRIPS, read_locations, read_uuids, split_trip_legs, trajectory_columns,
+    filter_output_columns, to_gps_coords
 )
 
 from utils.perf import PerfCounter
+from django.conf import settings
 from django.db import transaction, connection
-from django.db.models import Q, Max
+from django.db.models import Count, Q, Max
 from django.contrib.gis.gdal import SpatialReference, CoordTransform
 from django.contrib.gis.geos import Point
 from django.utils import timezone
-from psycopg2.extras import execute_values
-from trips.models import Device, TransportMode, Trip, Leg, LegLocation
-from trips_ingest.models import Location
-from poll.models import MUNICIPALITY_CHOICES, MUNICIPALITY_OTHER, Trips, Legs, LegsLocation, Partisipants
+from trips.models import Device, DeviceFilterState, DeviceModeCounts, TransportMode, Trip, Leg, LegLocation
+from trips_ingest.models import DirtyDevice
+from poll.municipalities import get_municipality_resolver
+from poll.models import Trips, Legs, LegsLocation, Partisipants
 
 
 logger = logging.getLogger(__name__)
@@ -28,6 +34,18 @@ logger = logging.getLogger(__name__)
 LEG_LOCATION_TABLE = LegLocation._meta.db_table
 LEGS_LOCATION_TABLE = LegsLocation._meta.db_table
 
+# First key of the per-device advisory locks taken while generating trips
+# (the second one is a hash of the device uuid)
+DEVICE_LOCK_NAMESPACE = 4701
+
+# Columns of the LegLocation and LegsLocation tables written with a binary COPY
+LEG_LOCATION_COPY_FIELDS = [
+    ('leg_id', 'int4'),
+    ('loc', 'point'),
+    ('time', 'timestamptz'),
+    ('speed', 'float8'),
+]
+
 local_crs = SpatialReference(LOCAL_2D_CRS)
 gps_crs = SpatialReference(4326)
 coord_transform = CoordTransform(local_crs, gps_crs)
@@ -40,14 +58,61 @@ def make_point(x, y):
     return pnt
 
 
-def generate_leg_location_rows(leg, df):
-    rows = df.apply(lambda row: (
-        leg.id,
-        row.lon, row.lat,
-        '%s' % str(row.time),
-        row.speed,
-    ), axis=1)
-    return list(rows.values)
+def leg_end_points(df):
+    """Return the GPS start and end points of a leg from its lon and lat columns."""
+    start = Point(df.lon.iloc[0], df.lat.iloc[0], srid=4326)
+    end = Point(df.lon.iloc[-1], df.lat.iloc[-1], srid=4326)
+    return start, end
+
+
+# Leg fields that depend on the samples of the leg; if any of them changes,
+# the locations of the leg are rewritten.
+LEG_GEOMETRY_FIELDS = ('length', 'start_loc', 'end_loc', 'received_at')
+
+
+def leg_time_range(start_time, end_time):
+    # Microsecond timestamps, so that pandas and Python datetimes compare equal
+    return (round(start_time.timestamp() * 1000000), round(end_time.timestamp() * 1000000))
+
+
+def changed_leg_fields(old, new) -> list:
+    """Return the generated fields that differ between an existing leg and its regenerated version."""
+    changed = []
+    for field in ('mode', 'mode_variant', 'estimated_mode'):
+        if getattr(old, field + '_id') != getattr(new, field + '_id'):
+            changed.append(field)
+    for field in ('length', 'carbon_footprint'):
+        if not math.isclose(getattr(old, field), getattr(new, field), rel_tol=1e-9, abs_tol=1e-6):
+            changed.append(field)
+    for field in ('start_loc', 'end_loc'):
+        if not getattr(old, field).equals_exact(getattr(new, field), 1e-9):
+            changed.append(field)
+    if old.received_at != new.received_at:
+        changed.append('received_at')
+    return changed
+
+
+def leg_location_columns(leg, df) -> dict:
+    """Return the location rows of a saved leg as columns for copy_leg_locations."""
+    return dict(
+        leg_id=np.full(len(df), leg.id, dtype=np.int32),
+        loc=np.column_stack((df.lon.to_numpy(dtype=np.float64), df.lat.to_numpy(dtype=np.float64))),
+        time=df.time.dt.tz_convert(None).to_numpy(dtype='datetime64[us]'),
+        speed=df.speed.to_numpy(dtype=np.float64, na_value=np.nan),
+    )
+
+
+def has_invalid_speeds(legs) -> bool:
+    return any(np.isnan(leg['speed']).any() for leg in legs)
+
+
+def copy_leg_locations(table, legs):
+    """Write the location rows of legs (a list of leg_location_columns) to table."""
+    if not legs:
+        return
+    cols = {name: np.concatenate([leg[name] for leg in legs]) for name, _ in LEG_LOCATION_COPY_FIELDS}
+    with connection.cursor() as cursor:
+        copy_from_arrays(cursor, table, cols, LEG_LOCATION_COPY_FIELDS, srid=4326)
 
 
 class GeneratorError(Exception):
@@ -55,9 +120,17 @@ class GeneratorError(Exception):
 
 
 class TripGenerator:
-    def __init__(self, force=False):
+    def __init__(self, force=False, smooth=False, workers=1, write_slots=None):
         self.force = force
+        # Shared semaphore limiting the processes with an open write
+        # transaction; each trip is saved and committed holding a slot
+        self.write_slots = write_slots if write_slots is not None else nullcontext()
+        # Run the backward smoothing pass over the filtered trajectories
+        self.smooth = smooth
+        # Trips are filtered in worker processes if workers > 1
+        self.filter_pool = TripFilterPool(workers)
         transport_modes = {x.identifier: x for x in TransportMode.objects.all()}
+        self.mode_identifiers = list(transport_modes.keys())
         self.atype_to_mode = {
             'walking': transport_modes['walk'],
             'on_foot': transport_modes['walk'],
@@ -81,67 +154,31 @@ class TripGenerator:
             'train': 'train',
         }
 
-    def insert_leg_locations(self, rows):
+    def insert_leg_locations(self, legs):
         # Having "None" as the speed column is a periodically recurring
         # issue. Raise error to continue with other uuids if None found
         # in speed column
-        try:
-            next(x for x in rows if x[4] is None)
+        if has_invalid_speeds(legs):
             raise GeneratorError('Encountered invalid value None as speed for leg')
-        except StopIteration:
-            pass
         pc = PerfCounter('save_locations', show_time_to_last=True)
-        query = f'''INSERT INTO {LEG_LOCATION_TABLE} (
-            leg_id, loc, time, speed
-        ) VALUES %s'''
-
-        with connection.cursor() as cursor:
-            pc.display('after cursor')
-            value_template = """(
-                    %s,
-                    ST_SetSRID(ST_MakePoint(%s, %s), 4326),
-                    %s :: timestamptz,
-                    %s
-            )"""
-            execute_values(
-                cursor, query, rows, template=value_template, page_size=10000
-            )
-
+        copy_leg_locations(LEG_LOCATION_TABLE, legs)
         pc.display('after insert')
 
-    def insert_survey_leg_locations(self, rows):
-        # Having "None" as the speed column is a periodically recurring
-        # issue. Raise error to continue with other uuids if None found
-        # in speed column
-        try:
-            next(x for x in rows if x[4] is None)
+    def insert_survey_leg_locations(self, legs):
+        if has_invalid_speeds(legs):
             raise GeneratorError('Encountered invalid value None as speed for leg')
-        except StopIteration:
-            pass
         pc = PerfCounter('save_locations', show_time_to_last=True)
-        query = f'''INSERT INTO {LEGS_LOCATION_TABLE} (
-            leg_id, loc, time, speed
-        ) VALUES %s'''
-
-        with connection.cursor() as cursor:
-            pc.display('after cursor')
-            value_template = """(
-                    %s,
-                    ST_SetSRID(ST_MakePoint(%s, %s), 4326),
-                    %s :: timestamptz,
-                    %s
-            )"""
-            execute_values(
-                cursor, query, rows, template=value_template, page_size=10000
-            )
-
+        copy_leg_locations(LEGS_LOCATION_TABLE, legs)
         pc.display('after insert')
 
-    def save_leg(self, trip, df, last_ts, default_variants, pc):
+    def build_leg(self, device, df, last_ts, default_variants):
+        """Return an unsaved leg (without a trip) for the samples of a leg."""
         start = df.iloc[0][['time', 'x', 'y']]
         end = df.iloc[-1][['time', 'x', 'y']]
         received_at = df.iloc[-1].created_at
 
+        start_loc, end_loc = leg_end_points(df)
+
         leg_length = df['distance'].sum()
 
         # Ensure trips are ordered properly
@@ -149,10 +186,10 @@ class TripGenerator:
 
         # Check if similar legs exist, and if so, use the mode from them
         similar_prob = None
-        if trip.device.personal_tuning_enabled:
-            similar_legs = similar_legs_by_location(trip.device.id, make_point(start.x, start.y), make_point(end.x, end.y))
-            if similar_legs:
-                similar_leg_props = calculate_mode_probs(similar_legs)
+        if device.personal_tuning_enabled:
+            leg_index = self.get_leg_index(device)
+            similar_leg_props = leg_index.similar_mode_probs(start.x, start.y, end.x, end.y)
+            if similar_leg_props:
                 # convert dict to array of tuples
                 probs = [(k, v) for k, v in similar_leg_props.items()]
                 # sort by probability
@@ -171,28 +208,25 @@ class TripGenerator:
 
 
         leg = Leg(
-            trip=trip,
             mode=mode,
             mode_variant=variant,
             estimated_mode=mode,
             length=leg_length,
             start_time=start.time,
             end_time=end.time,
-            start_loc=make_point(start.x, start.y),
-            end_loc=make_point(end.x, end.y),
+            start_loc=start_loc,
+            end_loc=end_loc,
             received_at=received_at,
         )
         leg.update_carbon_footprint()
-        leg.save()
-        rows = generate_leg_location_rows(leg, df)
-        pc.display(str(leg))
 
-        return rows, end.time
+        return leg, end.time
 
 
     def save_survey_leg(self, trip, df, last_ts, pc):
         start = df.iloc[0][['time', 'x', 'y']]
         end = df.iloc[-1][['time', 'x', 'y']]
+        start_loc, end_loc = leg_end_points(df)
 
         leg_length = df['distance'].sum()
 
@@ -207,56 +241,23 @@ class TripGenerator:
             trip_length=leg_length,
             start_time=start.time,
             end_time=end.time,
-            start_loc=make_point(start.x, start.y),
-            end_loc=make_point(end.x, end.y),
+            start_loc=start_loc,
+            end_loc=end_loc,
         )
         leg.save()
-        rows = generate_leg_location_rows(leg, df)
+        rows = leg_location_columns(leg, df)
         pc.display(str(leg))
 
         return rows, end.time
 
-    def save_survey_trip_town(self, tripObj, df, starttown):
-        if starttown:
-            time_loc = df.iloc[0][['time', 'x', 'y']]
-        else:
-            time_loc = df.iloc[-1][['time', 'x', 'y']]
-        mycoord = SpatialReference(4326)
-        gcoord = SpatialReference(LOCAL_2D_CRS)
-        trans = CoordTransform(gcoord, mycoord)
-
-        pnt = Point(time_loc.x, time_loc.y, srid=LOCAL_2D_CRS)
-        pnt.transform(trans)
-        lat = pnt.y
-        lon = pnt.x
-        coord_link = "https://nominatim.openstreetmap.org/reverse?format=json&lat=" +  str(lat) + "&lon=" +  str(lon) + "&zoom=10&addressdetails=10"
-        headers = {
-            "User-Agent": "mocaf"
-        }
-        request_json = requests.get(coord_link, headers=headers).json()
-
-        # towndict = {"Tampere": "Tampere", "Kangasala": "Kangasala", "Pirkkala": "Pirkkala", 
-        #             "Nokia": "Nokia", "Ylöjärvi": "Ylojarvi", "Lempäälä": "Lempaala", 
-        #             "Vesilahti": "Vesilahti", "Orivesi": "Orivesi"}
-
-        town = MUNICIPALITY_OTHER
-
-        if request_json.get("name"):
-            start_town = request_json.get("name")
-
-            municipalities = [x[0] for x in MUNICIPALITY_CHOICES]
-            if start_town in municipalities:
-                town = start_town
-
-        if starttown:
-            tripObj.start_municipality = town
-        else:
-            tripObj.end_municipality = town
-        
-        tripObj.save()
-
-        return
-    
+    def save_survey_trip_towns(self, tripObj, start_df, end_df):
+        # Both endpoints are resolved at once from the local municipality polygons
+        start = start_df.iloc[0]
+        end = end_df.iloc[-1]
+        tripObj.start_municipality, tripObj.end_municipality = get_municipality_resolver().lookup(
+            [start.x, end.x], [start.y, end.y]
+        )
+        tripObj.save(update_fields=['start_municipality', 'end_municipality'])
 
     def save_trip(self, device, df, default_variants, uuid):
         pc = PerfCounter('generate_trips', show_time_to_last=True)
@@ -269,14 +270,11 @@ class TripGenerator:
         min_time = df.time.min()
         max_time = df.time.max()
 
-        df = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df.x, df.y, crs=LOCAL_2D_CRS))
-        pc.display('after create gdf for %d points' % len(df))
-        df['geometry'] = df['geometry'].to_crs(4326)
-        df['lon'] = df.geometry.x
-        df['lat'] = df.geometry.y
+        lon, lat = to_gps_coords(df.x.to_numpy(), df.y.to_numpy())
+        df = df.assign(lon=lon, lat=lat)
         pc.display('after crs for %d points' % len(df))
 
-        # Delete trips that overlap with our data
+        # Find the legs that overlap with our data
         overlap = Q(end_time__gte=min_time) & Q(end_time__lte=max_time)
         overlap |= Q(start_time__gte=min_time) & Q(start_time__lte=max_time)
         legs = Leg.objects.filter(trip__device=device).filter(overlap)
@@ -293,47 +291,200 @@ class TripGenerator:
                 logger.info('Trips have user corrected elements, not deleting')
                 return
 
-        count = device.trips.filter(legs__in=legs).delete()
-        pc.display('deleted')
-
-        # Create trips
-        mocaf_enabled = Device.objects.get(uuid=uuid).mocaf_enabled
-
-        if mocaf_enabled:
-            all_rows = []
-            trip = Trip(device=device)
-            trip.save()
-            pc.display('trip %d saved' % trip.id)
+        # Reconcile the regenerated legs with the legs of the overlapping
+        # trips. Legs with the same time range are kept (and updated in place
+        # if something changed), so re-running the generation for the same
+        # samples doesn't rewrite anything.
+        affected_trips = list(device.trips.filter(legs__in=legs).distinct())
+        existing_legs = list(
+            Leg.objects.filter(trip__in=affected_trips).select_related('mode').order_by('start_time')
+        )
+        leg_index = self.get_leg_index(device) if device.personal_tuning_enabled else None
+        if leg_index is not None:
+            # The old versions of the legs don't count as similar legs
+            leg_index.remove([leg.id for leg in existing_legs])
 
-            leg_ids = df.leg_id.unique()
-            last_ts = df.time.min()
-            for leg_id in leg_ids:
-                leg_df = df[df.leg_id == leg_id]
+        existing_by_range = {}
+        for leg in existing_legs:
+            if leg.user_corrected_mode_id is None and leg.user_corrected_mode_variant_id is None:
+                existing_by_range.setdefault(leg_time_range(leg.start_time, leg.end_time), leg)
 
-                leg_rows, last_ts = self.save_leg(trip, leg_df, last_ts, default_variants, pc)
-                all_rows += leg_rows
+        mocaf_enabled = Device.objects.get(uuid=uuid).mocaf_enabled
+        leg_dfs = [df[df.leg_id == leg_id] for leg_id in df.leg_id.unique()] if mocaf_enabled else []
+        matches = [
+            existing_by_range.pop(leg_time_range(leg_df.time.iloc[0], leg_df.time.iloc[-1]), None)
+            for leg_df in leg_dfs
+        ]
+        matched_location_counts = dict(
+            LegLocation.objects.filter(leg__in=[old for old in matches if old is not None])
+            .order_by().values_list('leg').annotate(count=Count('id'))
+        )
 
-            pc.display('generated %d legs' % len(leg_ids))
-            self.insert_leg_locations(all_rows)
-            pc.display('updating carbon footprint')
-            trip.update_device_carbon_footprint()
+        trip = None
+        if leg_dfs:
+            # Keep the trip most of the matched legs belong to, also if the
+            # user has deleted it
+            trip_counts = Counter(old.trip_id for old in matches if old is not None)
+            if trip_counts:
+                trip_id = trip_counts.most_common(1)[0][0]
+                trip = next(t for t in affected_trips if t.id == trip_id)
+            else:
+                trip = Trip(device=device)
+                trip.save()
+                pc.display('trip %d saved' % trip.id)
+
+        mode_count_changes = []
+        footprint_ranges = []
+        location_rows = []
+        rewritten_leg_ids = []
+        trip_legs = []
+        last_ts = df.time.min()
+        for leg_df, old in zip(leg_dfs, matches):
+            leg, last_ts = self.build_leg(device, leg_df, last_ts, default_variants)
+            if old is None:
+                leg.trip = trip
+                # New legs of a trip the user has deleted are deleted, too
+                leg.deleted_at = trip.deleted_at
+                leg.save()
+                location_rows.append(leg_location_columns(leg, leg_df))
+                if leg.deleted_at is None:
+                    mode_count_changes.append((leg.mode.identifier, leg.start_time, 1))
+                footprint_ranges.append((leg.start_time, leg.end_time))
+            else:
+                leg.nr_passengers = old.nr_passengers
+                leg.update_carbon_footprint()
+                changed = changed_leg_fields(old, leg)
+                if old.mode_id != leg.mode_id and old.deleted_at is None:
+                    mode_count_changes.append((old.mode.identifier, old.start_time, -1))
+                    mode_count_changes.append((leg.mode.identifier, old.start_time, 1))
+                for field in changed:
+                    setattr(old, field, getattr(leg, field))
+                if changed:
+                    footprint_ranges.append((old.start_time, old.end_time))
+                if old.trip_id != trip.id:
+                    old_trip = next(t for t in affected_trips if t.id == old.trip_id)
+                    if old_trip.deleted_at is not None and old.deleted_at is None:
+                        # The leg stays deleted with the trip it came from
+                        old.deleted_at = old_trip.deleted_at
+                        changed.append('deleted_at')
+                        mode_count_changes.append((leg.mode.identifier, old.start_time, -1))
+                    old.trip = trip
+                    changed.append('trip')
+                if changed:
+                    old.save(update_fields=changed)
+                if set(changed) & set(LEG_GEOMETRY_FIELDS) or matched_location_counts.get(old.id) != len(leg_df):
+                    rewritten_leg_ids.append(old.id)
+                    location_rows.append(leg_location_columns(old, leg_df))
+                leg = old
+            trip_legs.append(leg)
+            if leg_index is not None:
+                leg_index.add(
+                    leg.id, leg.mode.identifier,
+                    leg_df.x.iloc[0], leg_df.y.iloc[0], leg_df.x.iloc[-1], leg_df.y.iloc[-1],
+                )
+            pc.display(str(leg))
+
+        kept_leg_ids = {old.id for old in matches if old is not None}
+        deleted_legs = [leg for leg in existing_legs if leg.id not in kept_leg_ids]
+        for leg in deleted_legs:
+            if leg.deleted_at is None:
+                mode_count_changes.append((leg.mode.identifier, leg.start_time, -1))
+            footprint_ranges.append((leg.start_time, leg.end_time))
+        if deleted_legs:
+            Leg.objects.filter(id__in=[leg.id for leg in deleted_legs]).delete()
+        # The other trips have no legs left
+        Trip.objects.filter(id__in=[t.id for t in affected_trips if trip is None or t.id != trip.id]).delete()
+        if rewritten_leg_ids:
+            LegLocation.objects.filter(leg__in=rewritten_leg_ids).delete()
+        if trip is not None:
+            # A trip is deleted when all of its legs are (see
+            # Trip.handle_leg_deletion), also after legs have moved between trips.
+            if any(leg.deleted_at is None for leg in trip_legs):
+                deleted_at = None
+            else:
+                deleted_at = trip.deleted_at or max(leg.deleted_at for leg in trip_legs)
+            if deleted_at != trip.deleted_at:
+                trip.deleted_at = deleted_at
+                trip.save(update_fields=['deleted_at'])
+        pc.display('reconciled %d legs (%d kept, %d deleted, %d locations rewritten)' % (
+            len(leg_dfs), len(kept_leg_ids), len(deleted_legs), len(rewritten_leg_ids)
+        ))
+
+        self.insert_leg_locations(location_rows)
+        DeviceModeCounts.update_device(device.id, mode_count_changes)
+        self.defer_footprint_update(device, footprint_ranges)
+        if trip is not None:
             pc.display('trip %d save done' % trip.id)
-            
-
 
     def begin(self):
         transaction.set_autocommit(False)
 
-    def process_trip(self, device, df, uuid):
-        pc = PerfCounter('process_trip')
+    def load_filter_state(self, device, start_time):
+        """Return the filter state checkpoint of the device and the time to continue from.
+
+        If there is no usable checkpoint, returns None and `start_time` unchanged.
+        """
+        obj = DeviceFilterState.objects.filter(device=device).first()
+        if obj is None:
+            return None, start_time
+        if start_time is not None and obj.time < start_time:
+            # Trips have been generated past the checkpoint some other way
+            return None, start_time
+        state = filter_bank_state_from_dict(obj.state)
+        if state is None:
+            logger.info('%s: Filter state checkpoint is not compatible, ignoring' % str(device))
+            return None, start_time
+        # Continue with the samples strictly newer than the checkpoint
+        return (obj.time, state), obj.time + timedelta(microseconds=1)
+
+    def save_filter_state(self, device, time, state):
+        DeviceFilterState.objects.update_or_create(
+            device=device, defaults=dict(time=time, state=filter_bank_state_to_dict(state))
+        )
+
+    def defer_footprint_update(self, device, time_ranges):
+        # The daily footprints are rebuilt once per device at the end of
+        # generate_trips instead of after every trip.
+        if not hasattr(device, '_footprint_ranges'):
+            device._footprint_ranges = []
+        device._footprint_ranges += time_ranges
+
+    def update_carbon_footprints(self, device):
+        time_ranges = getattr(device, '_footprint_ranges', None)
+        if not time_ranges:
+            return
+        device.update_daily_carbon_footprints(time_ranges)
+        device._footprint_ranges = []
+
+    def get_leg_index(self, device):
+        # The index of the legs of the device is loaded on first use and
+        # kept up to date as the trips of the device are (re)generated.
+        leg_index = getattr(device, '_leg_index', None)
+        if leg_index is None:
+            leg_index = device._leg_index = LegEndpointIndex.for_device(device.id)
+        return leg_index
+
+    def trip_prior(self, device):
         # get initial prob ests from users previous trips
-        initial_prob_ests_traj = None
-        if device.personal_tuning_enabled:
-            initial_prob_ests = user_mode_prob_ests(device.id)
-            initial_prob_ests_traj = transform_probs_to_trajectory_probs(initial_prob_ests)
+        if not device.personal_tuning_enabled:
+            return None
+        initial_prob_ests = user_mode_prob_ests(device.id, self.mode_identifiers)
+        return transform_probs_to_trajectory_probs(initial_prob_ests)
+
+    def submit_trip(self, df, initial_prob_ests_traj, filter_state=None):
+        # Picks up a raster built or rebuilt while the generator is running
+        way_raster = get_way_distance_raster(settings.WAY_DISTANCE_RASTER_PATH)
+        cols = trajectory_columns(df, way_raster=way_raster)
+        return self.filter_pool.submit(cols, initial_prob_ests_traj, smooth=self.smooth, filter_state=filter_state)
+
+    def process_trip(self, device, df, uuid, filter_state=None, filter_result=None):
+        pc = PerfCounter('process_trip')
         logger.info('%s: %s: trip with %d samples' % (str(device), df.time.min(), len(df)))
-        df = filter_trips(df, initial_prob_ests_traj)
-        pc.display('filter done')
+        if filter_result is None:
+            filter_result = self.submit_trip(df, self.trip_prior(device), filter_state)
+        ms, state_probs, most_likely_path, end_state = filter_result.result()
+        df = df.assign(**filter_output_columns(ms, state_probs, most_likely_path))
+        pc.display('filter done%s' % (' (continued from checkpoint)' if filter_state is not None else ''))
 
         # Use the fixed versions of columns
         df['atype'] = df['atypef']
@@ -348,12 +499,17 @@ class TripGenerator:
         pc.display('legs split')
         if df is None:
             logger.info('%s: No legs for trip' % str(device))
-            return
-        with transaction.atomic():
-            self.save_trip(device, df, device._default_variants, uuid)
+            return end_state
+        with self.write_slots:
+            with transaction.atomic():
+                self.save_trip(device, df, device._default_variants, uuid)
+            # Commit before giving up the slot, so that the slots limit the
+            # open write transactions and the locks they hold
+            transaction.commit()
         pc.display('trip saved')
+        return end_state
 
-    def generate_trips(self, uuid, start_time, end_time, generation_started_at=None):
+    def generate_trips(self, uuid, start_time, end_time, generation_started_at=None, resume=False):
         device: Device = Device.objects.filter(uuid=uuid).first()
         if device is None:
             raise GeneratorError('Device %s not found' % uuid)
@@ -361,100 +517,174 @@ class TripGenerator:
         device._default_variants = {x.mode: x.variant for x in device.default_mode_variants.all()}
 
         pc = PerfCounter('update trips for %s' % uuid, show_time_to_last=True)
+        checkpoint = None
+        if resume:
+            checkpoint, start_time = self.load_filter_state(device, start_time)
         df = read_locations(connection, uuid, start_time=start_time, end_time=end_time)
         if df is None or not len(df):
             if generation_started_at is not None:
-                device.last_processed_data_received_at = generation_started_at
-                device.save(update_fields=['last_processed_data_received_at'])
-            return
+                with self.write_slots:
+                    device.last_processed_data_received_at = generation_started_at
+                    device.save(update_fields=['last_processed_data_received_at'])
+                    transaction.commit()
+            return 0
         pc.display('read done, got %d rows' % len(df))
 
+        # The personal prior is computed once per run, so that all the trips
+        # can be filtered independently of each other.
+        initial_prob_ests_traj = self.trip_prior(device)
+        trips = []
         for trip_id in df.trip_id.unique():
             trip_df = df[df.trip_id == trip_id].copy()
+            # Only a trip continuing right after the checkpoint can use it
+            filter_state = None
+            if checkpoint is not None:
+                checkpoint_time, state = checkpoint
+                if (trip_df.time.min() - checkpoint_time).total_seconds() <= MINS_BETWEEN_TRIPS * 60:
+                    filter_state = state
+                checkpoint = None
+            filter_result = self.submit_trip(trip_df, initial_prob_ests_traj, filter_state)
+            trips.append((trip_df, filter_state, filter_result))
+        pc.display('%d trips submitted for filtering' % len(trips))
+
+        # Save the trips serially in the original order
+        last_state = None
+        for trip_df, filter_state, filter_result in trips:
             with sentry_sdk.configure_scope() as scope:
                 scope.set_tag('start_time', trip_df.time.min().isoformat())
                 scope.set_tag('end_time', trip_df.time.max().isoformat())
-                self.process_trip(device, trip_df, uuid)
+                end_state = self.process_trip(
+                    device, trip_df, uuid, filter_state=filter_state, filter_result=filter_result,
+                )
                 scope.clear()
+            if end_state is not None:
+                last_state = (trip_df.time.max(), end_state)
 
-        if generation_started_at is not None:
-            device.last_processed_data_received_at = generation_started_at
-            device.save(update_fields=['last_processed_data_received_at'])
-        transaction.commit()
+        with self.write_slots:
+            if last_state is not None:
+                self.save_filter_state(device, *last_state)
+
+            pc.display('updating carbon footprints')
+            self.update_carbon_footprints(device)
+
+            if generation_started_at is not None:
+                device.last_processed_data_received_at = generation_started_at
+                device.save(update_fields=['last_processed_data_received_at'])
+            transaction.commit()
         pc.display('trips generated')
+        return len(df)
 
-    def find_uuids_with_new_samples(self, min_received_at: Optional[datetime]=None):
-        if not min_received_at:
-            min_received_at = timezone.now() - timedelta(days=7)
+    def lock_device(self, uuid) -> bool:
+        # Session-level advisory lock, so that it is held over the commits
+        # of generate_trips. Returns False if someone else holds the lock.
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT pg_try_advisory_lock(%s, hashtext(%s))', [DEVICE_LOCK_NAMESPACE, str(uuid)]
+            )
+            return cursor.fetchone()[0]
 
-        uuid_qs = (
-            Location.objects
-            .filter(deleted_at__isnull=True, time__gte=min_received_at)
-            .filter(uuid__in=Device.objects.filter(mocaf_enabled=True).values('uuid'))
-            .values('uuid').annotate(newest_created_at=Max('created_at')).order_by()
-        )
-        uuids = uuid_qs.values('uuid')
-        devices = (
-            Device.objects.annotate(
+    def unlock_device(self, uuid):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT pg_advisory_unlock(%s, hashtext(%s))', [DEVICE_LOCK_NAMESPACE, str(uuid)]
+            )
+
+    @contextmanager
+    def device_lock(self, uuid):
+        # Yields False if someone else holds the lock
+        locked = self.lock_device(uuid)
+        try:
+            yield locked
+        finally:
+            if locked:
+                self.unlock_device(uuid)
+
+    def generate_dirty_device_trips(self, dirty, now):
+        min_received_at = now - timedelta(days=7)
+        device = (
+            Device.objects.filter(uuid=dirty.uuid, mocaf_enabled=True)
+            .annotate(
                 last_leg_received_at=Max('trips__legs__received_at'),
                 last_leg_end_time=Max('trips__legs__end_time'),
             )
-            .values('uuid', 'last_leg_received_at', 'last_leg_end_time', 'last_processed_data_received_at')
-            .filter(uuid__in=uuids)
+            .first()
         )
-        dev_by_uuid = {
-            x['uuid']: dict(
-                last_leg_received_at=x['last_leg_received_at'],
-                last_leg_end_time=x['last_leg_end_time'],
-                last_data_processed_at=x['last_processed_data_received_at'],
-            )
-            for x in devices
-        }
-
-        uuids = uuid_qs.values('uuid', 'newest_created_at')
-
-        uuids_to_process = []
-        for row in uuids:
-            uuid = row['uuid']
-            newest_created_at = row['newest_created_at']
-
-            dev = dev_by_uuid.get(uuid)
-            end_time = min_received_at
-            if dev:
-                if dev['last_leg_received_at'] and newest_created_at <= dev['last_leg_received_at']:
-                    continue
-                if dev['last_data_processed_at'] and newest_created_at <= dev['last_data_processed_at']:
-                    continue
-                if dev['last_leg_end_time'] and dev['last_leg_end_time'] > min_received_at:
-                    end_time = dev['last_leg_end_time']
-
-            uuids_to_process.append([uuid, end_time])
-        return uuids_to_process
+        if device is None:
+            return
+        if device.last_leg_received_at and dirty.received_at <= device.last_leg_received_at:
+            return
+        if device.last_processed_data_received_at and dirty.received_at <= device.last_processed_data_received_at:
+            return
+        start_time = min_received_at
+        if device.last_leg_end_time and device.last_leg_end_time > min_received_at:
+            start_time = device.last_leg_end_time
+
+        with sentry_sdk.configure_scope() as scope:
+            scope.set_tag('uuid', str(dirty.uuid))
+            try:
+                self.generate_trips(
+                    dirty.uuid, start_time=start_time, end_time=now, generation_started_at=now, resume=True,
+                )
+            except GeneratorError as e:
+                sentry_sdk.capture_exception(e)
+
+    def claim_dirty_device(self, queued_before, uuids, exclude):
+        """Claim the longest-queued device not being processed elsewhere.
+
+        Returns the claimed DirtyDevice, holding its device lock, and a list
+        of the devices that were skipped because someone else (e.g. a
+        backfill) holds their device lock. The device is None if none is left.
+        """
+        skipped = []
+        while True:
+            with transaction.atomic():
+                dirty = DirtyDevice.claim(queued_before, uuids=uuids, exclude=exclude + skipped)
+                # The row lock keeps the other queue generators away until
+                # the device lock, which is held over the commits of
+                # generate_trips, has been taken.
+                locked = dirty is not None and self.lock_device(dirty.uuid)
+            transaction.commit()
+            if dirty is None or locked:
+                return dirty, skipped
+            logger.info('%s: Trips are being generated by another worker' % dirty.uuid)
+            skipped.append(dirty.uuid)
+
+    def generate_queued_trips(self, dirty, now):
+        """Generate the new trips of a claimed device and remove it from the queue.
+
+        If the generation fails, the device stays queued for the next run.
+        """
+        try:
+            self.generate_dirty_device_trips(dirty, now)
+        except Exception:
+            transaction.rollback()
+            raise
+        # Samples received during the generation keep the device queued
+        dirty.dequeue()
+        transaction.commit()
 
-    def generate_new_trips(self, only_uuid=None):
+    def generate_new_trips(self, only_uuid=None, uuids=None):
         now = timezone.now()
-        uuids = self.find_uuids_with_new_samples()
-        for uuid, last_leg_end in uuids:
-            if only_uuid is not None:
-                if str(uuid) != only_uuid:
-                    continue
-            if last_leg_end:
-                start_time = last_leg_end
-                end_time = now
-            else:
-                start_time = None
-                end_time = None
-
-            with sentry_sdk.configure_scope() as scope:
-                scope.set_tag('uuid', str(uuid))
-                try:
-                    self.generate_trips(uuid, start_time=start_time, end_time=end_time, generation_started_at=now,)
-                except GeneratorError as e:
-                    sentry_sdk.capture_exception(e)
+        if only_uuid is not None:
+            uuids = [only_uuid]
+        # Devices queued during this run are left for the next one, and so
+        # are the devices that got new samples while they were processed.
+        done = []
+        while True:
+            dirty, skipped = self.claim_dirty_device(now, uuids, done)
+            done += skipped
+            if dirty is None:
+                break
+            done.append(dirty.uuid)
+            try:
+                self.generate_queued_trips(dirty, now)
+            finally:
+                self.unlock_device(dirty.uuid)
 
     def end(self):
         transaction.commit()
         transaction.set_autocommit(True)
+        self.filter_pool.shutdown()
 
 
 if __name__ == '__main__':
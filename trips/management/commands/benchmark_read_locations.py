@@ -0,0 +1,46 @@
+import gc
+import time
+import tracemalloc
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+
+from calc.trips import LOCATION_READERS, read_locations
+
+
+class Command(BaseCommand):
+    help = 'Compare the wall time and peak memory of the location readers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('uuid', type=str)
+        parser.add_argument('--days', type=int, default=14)
+        parser.add_argument('--rounds', type=int, default=3)
+
+    def measure(self, reader, uuid, start_time, end_time):
+        gc.collect()
+        tracemalloc.start()
+        start = time.perf_counter()
+        df = read_locations(connection, uuid, start_time=start_time, end_time=end_time, include_all=True, reader=reader)
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return elapsed, peak, len(df) if df is not None else 0
+
+    def handle(self, *args, **options):
+        end_time = timezone.now()
+        start_time = end_time - timedelta(days=options['days'])
+        uuid = options['uuid']
+
+        # Warm up the caches of the database and prepare the statements
+        for reader in LOCATION_READERS:
+            self.measure(reader, uuid, start_time, end_time)
+
+        for reader in LOCATION_READERS:
+            results = [self.measure(reader, uuid, start_time, end_time) for _ in range(options['rounds'])]
+            best_time = min(r[0] for r in results)
+            peak = max(r[1] for r in results)
+            self.stdout.write('%-5s %7d rows  %8.1f ms  peak %8.1f MiB' % (
+                reader, results[0][2], best_time * 1000, peak / 1024 / 1024
+            ))
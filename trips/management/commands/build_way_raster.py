@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from calc.wayraster import DEFAULT_MAX_DISTANCE, DEFAULT_RESOLUTION, build_way_distance_raster
+
+
+class Command(BaseCommand):
+    help = 'Build the memory-mapped grid of distances to the nearest car or rail way'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', type=str, default=settings.WAY_DISTANCE_RASTER_PATH)
+        parser.add_argument('--resolution', type=float, default=DEFAULT_RESOLUTION, help='Cell size in meters')
+        parser.add_argument('--max-distance', type=float, default=DEFAULT_MAX_DISTANCE)
+        parser.add_argument(
+            '--bbox', type=float, nargs=4, metavar=('XMIN', 'YMIN', 'XMAX', 'YMAX'),
+            help='Area to cover (in EPSG:%d), by default the extent of the ways' % settings.LOCAL_SRS
+        )
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if not path:
+            raise CommandError('Set WAY_DISTANCE_RASTER_PATH or give --path')
+        build_way_distance_raster(
+            connection, path, settings.LOCAL_SRS, bounds=options['bbox'],
+            resolution=options['resolution'], max_distance=options['max_distance'],
+        )
+        self.stdout.write('Way distance raster saved to %s' % path)
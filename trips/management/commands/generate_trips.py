@@ -2,9 +2,11 @@ from django.core.management.base import BaseCommand, CommandError
 from dateutil.parser import parse
 from datetime import datetime
 from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
 from django.db import connection
 from django.utils.timezone import localdate
 from trips.models import Device, LOCAL_TZ
+from trips.backfill import TripBackfill
 from trips.generate import TripGenerator
 from calc.trips import read_uuids
 
@@ -19,9 +21,23 @@ class Command(BaseCommand):
         parser.add_argument('--start-time', type=str)
         parser.add_argument('--end-time', type=str)
         parser.add_argument('--force', action='store_true')
+        parser.add_argument('--smooth', action='store_true', help='Smooth the filtered trajectories')
+        parser.add_argument(
+            '--workers', type=int, default=settings.TRIP_FILTER_WORKERS,
+            help='Number of processes to filter the trips with'
+        )
+        parser.add_argument(
+            '--backfill', type=str, metavar='NAME',
+            help='Regenerate the trips of all devices as a named backfill run that can be resumed'
+        )
+        parser.add_argument('--processes', type=int, default=1, help='Number of backfill worker processes')
+        parser.add_argument(
+            '--max-writers', type=int,
+            help='Maximum number of backfill worker processes with an open write transaction at once '
+                 '(each trip is committed separately)'
+        )
 
     def handle(self, *args, **options):
-        generator = TripGenerator(force=options['force'])
         uuid = options['uuid']
         start_uuid = options['start_after_uuid']
         start_time = options['start_time']
@@ -35,6 +51,17 @@ class Command(BaseCommand):
             if not end_time.tzinfo:
                 end_time = LOCAL_TZ.localize(end_time)
 
+        if options['backfill']:
+            backfill = TripBackfill(
+                options['backfill'], processes=options['processes'], max_writers=options['max_writers'],
+                force=options['force'], smooth=options['smooth'], log=self.stdout.write,
+            )
+            added = backfill.add_devices([uuid] if uuid else None, start_time, end_time)
+            self.stdout.write('%d devices added to the backfill' % added)
+            backfill.run()
+            return
+
+        generator = TripGenerator(force=options['force'], smooth=options['smooth'], workers=options['workers'])
         generator.begin()
         if options['new']:
             generator.generate_new_trips(only_uuid=options['uuid'])
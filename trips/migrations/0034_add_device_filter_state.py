@@ -0,0 +1,24 @@
+# Generated by Django 3.1.9 on 2026-10-17 10:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trips', '0033_device_personal_tuning_enabled'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeviceFilterState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('time', models.DateTimeField(help_text='Time of the last filtered sample')),
+                ('state', models.JSONField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('device', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='filter_state', to='trips.device')),
+            ],
+        ),
+    ]
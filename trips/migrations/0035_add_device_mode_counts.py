@@ -0,0 +1,25 @@
+# Generated by Django 3.1.9 on 2026-10-17 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trips', '0034_add_device_filter_state'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeviceModeCounts',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('counts', models.JSONField(default=dict, help_text='Leg counts (or weights) by mode identifier')),
+                ('half_life_days', models.FloatField(null=True)),
+                ('reference_time', models.DateTimeField(help_text='Start time of the newest counted leg', null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('device', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='mode_counts', to='trips.device')),
+            ],
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 3.1.9 on 2026-10-17 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trips', '0035_add_device_mode_counts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TripBackfillDevice',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('backfill', models.CharField(help_text='Name of the backfill run', max_length=100)),
+                ('uuid', models.UUIDField()),
+                ('start_time', models.DateTimeField(null=True)),
+                ('end_time', models.DateTimeField(null=True)),
+                ('expected_rows', models.PositiveIntegerField(default=0, help_text='Location samples in the time range')),
+                ('rows', models.PositiveIntegerField(help_text='Location samples processed', null=True)),
+                ('started_at', models.DateTimeField(null=True)),
+                ('finished_at', models.DateTimeField(null=True)),
+                ('error', models.TextField(null=True)),
+            ],
+            options={
+                'unique_together': {('backfill', 'uuid')},
+            },
+        ),
+    ]
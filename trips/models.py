@@ -6,6 +6,7 @@ from datetime import date, datetime, time, timedelta
 from itertools import groupby
 from typing import List, Optional, Literal
 import calendar
+import math
 import pandas as pd
 import uuid
 from django.db.models.aggregates import Sum
@@ -14,7 +15,7 @@ from ranking import Ranking
 
 import pytz
 from django.utils import timezone
-from django.db import transaction
+from django.db import connection, transaction
 from django.contrib.gis.db import models
 from django.conf import settings
 from django.utils.translation import gettext_lazy as _
@@ -125,17 +126,21 @@ class Device(ExportModelOperationsMixin('device'), models.Model):
             units=EmissionUnit.KG
         )
         date_summary = {fp['date']: fp for fp in summary}
+        dates = [x.date() for x in pd.date_range(start=start_date.date(), end=end_date.date()).to_pydatetime()]
+        dates_without_footprint = [x for x in dates if date_summary.get(x, {}).get('carbon_footprint') is None]
+        dates_with_data = self.dates_with_any_data(dates_without_footprint)
         with transaction.atomic():
             self.daily_carbon_footprints.filter(date__gte=start_date, date__lte=end_date).delete()
             self.daily_health_impacts.filter(date__gte=start_date, date__lte=end_date).delete()
             objs = []
             health_objs = []
-            for cur_datetime in pd.date_range(start=start_date.date(), end=end_date.date()).to_pydatetime():
-                cur_date = cur_datetime.date()
+            for cur_date in dates:
                 cur_summary = date_summary.get(cur_date)
                 carbon_footprint = cur_summary['carbon_footprint'] if cur_summary is not None else None
                 default_footprint = default_emissions.calculate_for_date(cur_date, TimeResolution.DAY, EmissionUnit.KG)
-                obj = self.create_device_daily_carbon_footprint(cur_date, carbon_footprint, default_footprint)
+                obj = self.create_device_daily_carbon_footprint(
+                    cur_date, carbon_footprint, default_footprint, has_data=cur_date in dates_with_data,
+                )
                 objs.append(obj)
                 if cur_summary:
                     per_mode = cur_summary['per_mode']
@@ -152,10 +157,28 @@ class Device(ExportModelOperationsMixin('device'), models.Model):
             DeviceDailyCarbonFootprint.objects.bulk_create(objs)
             DeviceDailyHealthImpact.objects.bulk_create(health_objs)
 
-    def create_device_daily_carbon_footprint(self, date, carbon_footprint, default_footprint):
+    def update_daily_carbon_footprints(self, time_ranges, default_emissions: EmissionBudgetLevel = None):
+        """Rebuild the daily footprints of the (start_time, end_time) ranges.
+
+        Overlapping and adjacent ranges are merged first, so that every day
+        is rebuilt only once.
+        """
+        merged = []
+        for start_time, end_time in sorted(time_ranges, key=lambda r: r[0].date()):
+            if merged and start_time.date() <= merged[-1][1].date() + timedelta(days=1):
+                if end_time.date() > merged[-1][1].date():
+                    merged[-1][1] = end_time
+                continue
+            merged.append([start_time, end_time])
+        for start_time, end_time in merged:
+            self.update_daily_carbon_footprint(start_time, end_time, default_emissions)
+
+    def create_device_daily_carbon_footprint(self, date, carbon_footprint, default_footprint, has_data=None):
         average_footprint_used = False
         if carbon_footprint is None:
-            if self.has_any_data_on_date(date):
+            if has_data is None:
+                has_data = self.has_any_data_on_date(date)
+            if has_data:
                 # Device has data, so has not moved
                 carbon_footprint = 0
             else:
@@ -356,6 +379,28 @@ class Device(ExportModelOperationsMixin('device'), models.Model):
         return (DeviceHeartbeat.objects.filter(time__date=date, uuid=self.uuid).exists()
                 or Location.objects.filter(time__date=date, uuid=self.uuid).exists())
 
+    def dates_with_any_data(self, dates: List[date]) -> set:
+        """Return the dates out of `dates` on which the device has sent any data.
+
+        Same as has_any_data_on_date for every date, but in one query.
+        """
+        if not dates:
+            return set()
+        exists_on_date = """EXISTS (
+            SELECT 1 FROM {table} AS t WHERE t.uuid = %(uuid)s
+                AND t.time >= d::timestamp AT TIME ZONE %(tz)s
+                AND t.time < (d + 1)::timestamp AT TIME ZONE %(tz)s
+        )"""
+        query = f"""
+            SELECT d FROM unnest(%(dates)s::date[]) AS d
+            WHERE {exists_on_date.format(table=DeviceHeartbeat._meta.db_table)}
+                OR {exists_on_date.format(table=Location._meta.db_table)}
+        """
+        params = dict(uuid=self.uuid, dates=list(dates), tz=timezone.get_current_timezone_name())
+        with connection.cursor() as cursor:
+            cursor.execute(query, params)
+            return {row[0] for row in cursor.fetchall()}
+
     @transaction.atomic
     def register(self, account_key, migrate_existing=True):
         if self.account_key:
@@ -369,6 +414,7 @@ class Device(ExportModelOperationsMixin('device'), models.Model):
                 raise MigrationRequired()
             old_device.account_key = None
             old_device.trips.update(device=self)
+            DeviceModeCounts.reset([old_device.id, self.id])
             if not self.background_info_questions.exists():
                 old_device.background_info_questions.update(device=self)
             if not self.default_mode_variants.exists():
@@ -391,6 +437,163 @@ class Device(ExportModelOperationsMixin('device'), models.Model):
         return str(self.uuid)
 
 
+class DeviceFilterState(models.Model):
+    """Checkpoint of the trip filter bank state of a device.
+
+    Trip generation continues filtering from the checkpoint, so the samples
+    up to `time` don't have to be filtered again. The checkpoint is dropped
+    when samples older than it arrive.
+    """
+    device = models.OneToOneField(Device, on_delete=models.CASCADE, related_name='filter_state')
+    time = models.DateTimeField(help_text=_('Time of the last filtered sample'))
+    state = models.JSONField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return '%s: filter state at %s' % (self.device, self.time.astimezone(LOCAL_TZ))
+
+
+class DeviceModeCounts(models.Model):
+    """Counts of the legs of a device by transport mode.
+
+    The counts are the personal mode prior used in trip generation. They are
+    kept up to date as legs are generated, deleted and corrected, so reading
+    the prior doesn't need a recount of all the legs. If
+    PERSONAL_MODE_PRIOR_HALF_LIFE_DAYS is set, each leg is weighted by its
+    age relative to the newest counted leg, so that old habits fade.
+    """
+    device = models.OneToOneField(Device, on_delete=models.CASCADE, related_name='mode_counts')
+    counts = models.JSONField(default=dict, help_text=_('Leg counts (or weights) by mode identifier'))
+    half_life_days = models.FloatField(null=True)
+    reference_time = models.DateTimeField(null=True, help_text=_('Start time of the newest counted leg'))
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return '%s: %s' % (self.device, self.counts)
+
+    @classmethod
+    def configured_half_life(cls) -> Optional[float]:
+        return settings.PERSONAL_MODE_PRIOR_HALF_LIFE_DAYS or None
+
+    @classmethod
+    def for_device(cls, device_id: int) -> DeviceModeCounts:
+        """Return the mode counts of a device, counting the legs if needed."""
+        obj = cls.objects.filter(device_id=device_id).first()
+        if obj is not None and obj.half_life_days == cls.configured_half_life():
+            return obj
+        with transaction.atomic():
+            obj = cls.objects.select_for_update().filter(device_id=device_id).first()
+            if obj is None:
+                obj = cls(device_id=device_id)
+            obj.recount()
+            obj.save()
+        return obj
+
+    @classmethod
+    def update_device(cls, device_id: int, changes):
+        """Apply (mode identifier, leg start time, +1 or -1) changes to the counts.
+
+        Devices that haven't been counted yet are left alone, they are counted
+        from the legs when the counts are first needed.
+        """
+        if not changes:
+            return
+        with transaction.atomic():
+            obj = cls.objects.select_for_update().filter(device_id=device_id).first()
+            if obj is None:
+                return
+            if obj.half_life_days != cls.configured_half_life():
+                obj.recount()
+            else:
+                for mode, start_time, delta in changes:
+                    obj.add(mode, start_time, delta)
+            obj.save()
+
+    @classmethod
+    def reset(cls, device_ids):
+        """Drop the counts of devices whose legs changed outside of update_device.
+
+        They are counted again from the legs when the counts are next needed.
+        """
+        cls.objects.filter(device_id__in=device_ids).delete()
+
+    def recount(self):
+        self.counts = {}
+        self.reference_time = None
+        self.half_life_days = self.configured_half_life()
+        legs = Leg.objects.active().filter(trip__device_id=self.device_id)
+        if self.half_life_days is None:
+            for row in legs.values('mode__identifier').order_by().annotate(count=models.Count('id')):
+                self.counts[row['mode__identifier']] = row['count']
+            return
+        for mode, start_time in legs.values_list('mode__identifier', 'start_time'):
+            self.add(mode, start_time, 1)
+
+    def add(self, mode: str, start_time: datetime, delta: int):
+        if self.half_life_days is None:
+            weight = delta
+        else:
+            rate = math.log(2) / (self.half_life_days * 24 * 3600)
+            if self.reference_time is None:
+                self.reference_time = start_time
+            elif start_time > self.reference_time:
+                # Age the existing counts to the new reference time
+                decay = math.exp(-rate * (start_time - self.reference_time).total_seconds())
+                self.counts = {key: val * decay for key, val in self.counts.items()}
+                self.reference_time = start_time
+            weight = delta * math.exp(-rate * (self.reference_time - start_time).total_seconds())
+        self.counts[mode] = max(self.counts.get(mode, 0) + weight, 0)
+
+
+class TripBackfillDevice(models.Model):
+    """Progress of a device in a backfill run of the generate_trips command.
+
+    The workers of a run claim the devices one at a time and mark them
+    finished in their own transaction, so an interrupted run continues with
+    the devices that weren't finished.
+    """
+    backfill = models.CharField(max_length=100, help_text=_('Name of the backfill run'))
+    uuid = models.UUIDField()
+    start_time = models.DateTimeField(null=True)
+    end_time = models.DateTimeField(null=True)
+    expected_rows = models.PositiveIntegerField(default=0, help_text=_('Location samples in the time range'))
+    rows = models.PositiveIntegerField(null=True, help_text=_('Location samples processed'))
+    started_at = models.DateTimeField(null=True)
+    finished_at = models.DateTimeField(null=True)
+    error = models.TextField(null=True)
+
+    class Meta:
+        unique_together = (('backfill', 'uuid'),)
+
+    def __str__(self):
+        return '%s: %s' % (self.backfill, self.uuid)
+
+    @classmethod
+    def claim(cls, backfill: str) -> Optional[TripBackfillDevice]:
+        """Mark the next unstarted device of the run started and return it.
+
+        The devices with the most samples go first, so that the workers
+        finish at about the same time. Rows claimed by other workers are
+        skipped.
+        """
+        table = cls._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                UPDATE {table} SET started_at = %(now)s WHERE id = (
+                    SELECT id FROM {table}
+                    WHERE backfill = %(backfill)s AND started_at IS NULL AND finished_at IS NULL
+                    ORDER BY expected_rows DESC, id
+                    LIMIT 1
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id
+            """, dict(backfill=backfill, now=timezone.now()))
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        return cls.objects.get(id=row[0])
+
+
 class TransportMode(models.Model):
     identifier = models.CharField(
         max_length=20, unique=True, verbose_name=_('Identifier'),
@@ -19,8 +19,8 @@ from mocaf.graphql_types import AuthenticatedDeviceNode, DjangoNode, DjangoObjec
 from trips_ingest.models import Location
 
 from .models import (
-    AlreadyRegistered, BackgroundInfoQuestion, Device, DeviceDefaultModeVariant, InvalidStateError, Leg, LegLocation,
-    MigrationRequired, TransportMode, TransportModeVariant, Trip
+    AlreadyRegistered, BackgroundInfoQuestion, Device, DeviceDefaultModeVariant, DeviceModeCounts, InvalidStateError,
+    Leg, LegLocation, MigrationRequired, TransportMode, TransportModeVariant, Trip
 )
 from utils.i18n import resolve_i18n_field
 
@@ -242,6 +242,7 @@ class ClearUserDataMutation(graphene.Mutation, AuthenticatedDeviceNode):
         dev = info.context.device
         now = timezone.now()
         with transaction.atomic():
+            DeviceModeCounts.reset([dev.id])
             dev.trips.all().delete()
             # Rows in compressed hypertable chunks can't be deleted
             # Location.objects.filter(uuid=dev.uuid).update(deleted_at=now)
@@ -309,6 +310,8 @@ class UpdateLeg(graphene.Mutation, AuthenticatedDeviceNode):
             if not obj.can_user_update():
                 raise GraphQLError('Leg update no longer possible', [info])
 
+            old_mode_count = (obj.mode.identifier, obj.deleted_at is None)
+
             if mode_obj:
                 obj.user_corrected_mode = mode_obj
                 obj.mode = mode_obj
@@ -348,6 +351,15 @@ class UpdateLeg(graphene.Mutation, AuthenticatedDeviceNode):
 
             obj.user_updates.create(data=update_data)
 
+            new_mode_count = (obj.mode.identifier, obj.deleted_at is None)
+            if new_mode_count != old_mode_count:
+                mode_count_changes = []
+                if old_mode_count[1]:
+                    mode_count_changes.append((old_mode_count[0], obj.start_time, -1))
+                if new_mode_count[1]:
+                    mode_count_changes.append((new_mode_count[0], obj.start_time, 1))
+                DeviceModeCounts.update_device(dev.id, mode_count_changes)
+
             if deleted:
                 obj.trip.handle_leg_deletion(obj)
 
@@ -1,14 +1,34 @@
 import logging
-from celery import shared_task
+from celery import group, shared_task
+from django.conf import settings
+from django.utils import timezone
 
+from trips_ingest.models import DirtyDevice
 from .generate import TripGenerator
 
 
 logger = logging.getLogger(__name__)
 generator = TripGenerator()
 
+# Chunks not started by the next beat are dropped; their devices are still
+# queued and get sent again.
+DEVICE_CHUNK_EXPIRES = 240
+
 
 @shared_task
 def generate_new_trips():
-    logger.info('Generating new trips')
-    generator.generate_new_trips()
+    uuids = [str(uuid) for uuid in DirtyDevice.queued_uuids(timezone.now())]
+    if not uuids:
+        return
+    size = settings.TRIP_GENERATION_CHUNK_SIZE
+    chunks = [uuids[i:i + size] for i in range(0, len(uuids), size)]
+    logger.info('Generating new trips for %d devices in %d chunks' % (len(uuids), len(chunks)))
+    group(generate_new_trips_for_devices.s(chunk) for chunk in chunks).apply_async(
+        expires=DEVICE_CHUNK_EXPIRES,
+    )
+
+
+@shared_task
+def generate_new_trips_for_devices(uuids):
+    logger.info('Generating new trips for %d devices' % len(uuids))
+    generator.generate_new_trips(uuids=uuids)
@@ -0,0 +1,343 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+from shapely.geometry import LineString, Point
+
+from calc.dragimm import filter_bank_state_from_dict, filter_bank_state_to_dict
+from calc.pgcopy import EWKB_POINT, EWKB_SRID_FLAG, decode_binary_copy, encode_binary_copy
+from calc.wayraster import DISTANCE_UNIT, get_way_distance_raster, write_header
+from calc.transitest import transit_prob_ests_batched, transit_prob_ests_糞
+from calc.trips import (
+    ALL_ATYPES, MINS_BETWEEN_TRIPS, TransitLocationIndex, build_leg_table, detect_and_merge_invalid_transitions,
+    filter_trips, limit_transportation_methods, segment_trips,
+)
+
+# The autouse fixtures in conftest.py need the database
+pytestmark = pytest.mark.django_db
+
+
+def make_trip_df(n=300, seed=0):
+    rng = np.random.default_rng(seed)
+    dt = rng.choice([1.0, 5.0, 5.0, 10.0, 30.0], size=n)
+    t = 1.6e9 + np.cumsum(dt)
+    atypes = np.repeat(['still', 'walking', 'in_vehicle', 'on_bicycle', 'on_foot', 'still'], n // 6 + 1)[:n]
+    speed_by_atype = {'still': 0.0, 'walking': 1.4, 'on_foot': 1.4, 'on_bicycle': 5.0, 'in_vehicle': 12.0}
+    speed = np.array([speed_by_atype[x] for x in atypes])
+    x = 327673 + np.cumsum(speed * dt) + rng.normal(0, 5, n)
+    y = 6820919 + rng.normal(0, 5, n)
+    time = pd.to_datetime(t, unit='s', utc=True)
+    return pd.DataFrame(dict(
+        time=time, x=x, y=y, speed=speed,
+        loc_error=rng.choice([5.0, 10.0, 20.0, 50.0], size=n),
+        atype=atypes,
+        aconf=rng.choice([50.0, 75.0, 100.0], size=n),
+        closest_car_way_dist=np.where(rng.random(n) < .5, np.nan, rng.uniform(0, 60, n)),
+        closest_rail_way_dist=np.nan,
+        created_at=time,
+    ))
+
+
+@pytest.mark.parametrize('initial_state_prob_ests', [None, [0.1, 0.3, 0.2, 0.4]])
+def test_filter_engines_match(initial_state_prob_ests):
+    df = make_trip_df()
+    ests = initial_state_prob_ests
+    py = filter_trips(df, list(ests) if ests else None, engine='python')
+    nb = filter_trips(df, list(ests) if ests else None, engine='numba')
+
+    for col in ('xf', 'yf', 'still', 'walking', 'on_bicycle', 'in_vehicle'):
+        np.testing.assert_allclose(nb[col].to_numpy(), py[col].to_numpy(), rtol=1e-7, atol=1e-6)
+    assert list(nb.atypef) == list(py.atypef)
+
+
+def test_filter_engines_match_smoothed():
+    df = make_trip_df()
+    py = filter_trips(df, engine='python', smooth=True)
+    nb = filter_trips(df, engine='numba', smooth=True)
+
+    for col in ('xf', 'yf', 'still', 'walking', 'on_bicycle', 'in_vehicle'):
+        np.testing.assert_allclose(nb[col].to_numpy(), py[col].to_numpy(), rtol=1e-7, atol=1e-6)
+    assert list(nb.atypef) == list(py.atypef)
+
+
+def test_filter_unknown_engine():
+    with pytest.raises(ValueError):
+        filter_trips(make_trip_df(n=10), engine='fortran')
+
+
+def test_filter_resume_from_state():
+    df = make_trip_df()
+    full = filter_trips(df)
+
+    first, state = filter_trips(df.iloc[:150].copy(), return_state=True)
+    state = filter_bank_state_from_dict(filter_bank_state_to_dict(state))
+    second = filter_trips(df.iloc[150:].copy(), filter_state=state)
+    resumed = pd.concat([first, second])
+
+    for col in ('xf', 'yf', 'still', 'walking', 'on_bicycle', 'in_vehicle'):
+        np.testing.assert_allclose(resumed[col].to_numpy(), full[col].to_numpy(), rtol=1e-9, atol=1e-9)
+
+    with pytest.raises(ValueError):
+        filter_trips(df.iloc[100:200].copy(), filter_state=state)
+
+
+def test_transit_prob_ests_batched():
+    rng = np.random.default_rng(1)
+    t = np.arange(0.0, 300.0, 5.0)
+    leg = pd.DataFrame(dict(
+        time=t, x=10 * t + rng.normal(0, 5, len(t)), y=rng.normal(0, 5, len(t)),
+        location_std=rng.choice([5.0, 10.0, 20.0], size=len(t)),
+    ))
+    transits = {}
+    for vid in range(20):
+        vt = np.sort(rng.uniform(-60, 360, rng.integers(1, 40)))
+        offset = rng.choice([0.0, 50.0, 5000.0])
+        transits[vid] = pd.DataFrame(dict(time=vt, x=10 * vt + offset, y=rng.normal(offset, 10, len(vt))))
+
+    ref = transit_prob_ests_糞(leg, transits)
+    for max_distance in (None, 500):
+        out = transit_prob_ests_batched(leg, transits, max_distance=max_distance)
+        assert out.keys() == ref.keys()
+        for vid, dist in ref.items():
+            if max_distance is not None and dist == dist and dist < -max_distance:
+                assert out[vid] != out[vid] or out[vid] == pytest.approx(dist)
+            else:
+                np.testing.assert_allclose(out[vid], dist, rtol=1e-9)
+
+
+def test_segment_trips():
+    # A moving trip, a gap, a stationary trip, a gap and a trip that is still ongoing
+    n = 40
+    dt = np.full(3 * n, 10 * 1000000, dtype=np.int64)
+    dt[n] = dt[2 * n] = 3600 * 1000000
+    time = 1600000000 * 1000000 + np.cumsum(dt)
+    x = np.concatenate([np.arange(n) * 50.0, np.zeros(n), np.arange(n) * 50.0])
+    y = np.zeros(3 * n)
+    loc_error = np.full(3 * n, 10.0)
+    not_moving = np.zeros(3 * n, dtype=bool)
+    not_moving[n - 1] = True
+    max_gap = MINS_BETWEEN_TRIPS * 60 * 1000000
+
+    trip_ids, distance, keep, n_good, n_trips = segment_trips(
+        time, x, y, loc_error, not_moving, time, max_gap, False,
+    )
+    assert n_trips == 1
+    assert n_good == n
+    assert list(np.flatnonzero(keep)) == list(range(n))
+    assert (trip_ids[:n] == 0).all()
+    assert distance[0] == 0 and (distance[1:n] == 50).all()
+
+    trip_ids, distance, keep, n_good, n_trips = segment_trips(
+        time, x, y, loc_error, not_moving, time, max_gap, True,
+    )
+    assert n_trips == 2
+    assert keep.all()
+    assert list(np.unique(trip_ids)) == [-1, 0, 2]
+
+
+def test_transit_location_index_matches_leg_buffer():
+    # A curved, diagonal leg; the inaccurate sample is not part of its path
+    n = 30
+    angle = np.linspace(0, np.pi / 2, n)
+    x = 327673 + 2000 * np.sin(angle)
+    y = 6820919 + 2000 * (1 - np.cos(angle))
+    t = 1.6e9 + np.arange(n) * 10.0
+    loc_error = np.full(n, 10.0)
+    loc_error[5] = 500
+    leg_df = pd.DataFrame(dict(time=pd.to_datetime(t, unit='s', utc=True), x=x, y=y, loc_error=loc_error))
+    window = TransitLocationIndex.leg_window(leg_df)
+
+    rng = np.random.default_rng(0)
+    k = 5000
+    vx = rng.uniform(window.xmin - 100, window.xmax + 100, k)
+    vy = rng.uniform(window.ymin - 100, window.ymax + 100, k)
+    vt = rng.uniform(t[0] - 120, t[-1] + 120, k)
+    index = TransitLocationIndex(pd.DataFrame(dict(vehicle_ref=np.arange(k), epoch_time=vt, x=vx, y=vy)))
+    matched = set(index.leg_locations(window).vehicle_ref)
+
+    # The semantics of ST_Buffer(ST_MakeLine(loc ORDER BY time), 200) in get_transit_locations
+    good = loc_error <= 200
+    path = LineString(np.column_stack((x[good], y[good])))
+    buffer = path.buffer(200)
+    in_time = (vt >= t[0] - 60) & (vt <= t[-1] + 60)
+    expected = {i for i in range(k) if in_time[i] and buffer.contains(Point(vx[i], vy[i]))}
+    # The buffer polygon approximates the round joins and caps
+    near_edge = {i for i in range(k) if abs(path.distance(Point(vx[i], vy[i])) - 200) < 1}
+    assert matched - near_edge == expected - near_edge
+    # Most of the bounding box is far from the path
+    in_box = in_time & (vx >= window.xmin) & (vx <= window.xmax) & (vy >= window.ymin) & (vy <= window.ymax)
+    assert len(matched) < in_box.sum() / 2
+
+    # A leg with a single accurate sample matches around the sample
+    window = TransitLocationIndex.leg_window(leg_df.iloc[[5, 6]])
+    matched = set(index.leg_locations(window).vehicle_ref)
+    dist = np.hypot(vx - x[6], vy - y[6])
+    assert matched == set(np.flatnonzero((dist <= 200) & (vt >= t[5] - 60) & (vt <= t[6] + 60)))
+
+
+def leg_ids_from_str(s):
+    # One character per sample: the leg id, or '.' for no leg
+    return np.array([-1 if c == '.' else int(c) for c in s], dtype=np.int64)
+
+
+def leg_ids_to_str(leg_ids):
+    return ''.join('.' if x == -1 else str(x) for x in leg_ids)
+
+
+def test_build_leg_table():
+    leg_ids = leg_ids_from_str('..11.00.1.')
+    atypes = np.array([0, 0, 2, 3, 0, 1, 1, 0, 2, 9])
+    table = build_leg_table(leg_ids, atypes)
+    # Ordered by the first sample
+    assert list(table.leg_id) == [1, 0]
+    assert list(table.start) == [2, 5]
+    assert list(table.end) == [8, 6]
+    assert list(table.count) == [3, 2]
+    assert list(table.mode_counts[0]) == [0, 0, 2, 1, 0, 0, 0, 0, 0, 0]
+    assert list(table.mode_counts[1]) == [0, 2, 0, 0, 0, 0, 0, 0, 0, 0]
+    assert list(table.sample_leg) == [-1, -1, 0, 0, -1, 1, 1, -1, 0, -1]
+
+
+# (leg ids, atypes) before and after detect_and_merge_invalid_transitions. The
+# atypes are indices to ALL_ATYPES (0 still, 2 on_bicycle, 3 in_vehicle). The
+# random cases were generated once and their outputs recorded from the
+# original per-leg implementation.
+INVALID_TRANSITION_CASES = [
+    # Bicycle and vehicle legs with too few still samples between are merged
+    # into the larger leg, with its mode
+    ('0000.111111', '22220333333', '1111.111111', '33330333333'),
+    ('1111.00', '3333022', '1111.11', '3333033'),
+    # Enough still samples between
+    ('0000...111111', '2222000333333', '0000...111111', '2222000333333'),
+    # The transitions are found before any merging
+    ('000.11.2222', '22203303333', '000.00.2222', '22202203333'),
+    # Random
+    ('....333333111111.44444455.222.', '000122222221222202221223303330',
+     '....333333111111.44444444.222.', '000122222221222202222222203330'),
+    ('11...55533300.4422222111111555', '130103333333302222322232122111',
+     '11...55533300.0022222111111555', '130103333333303322322232122111'),
+    ('...2222...5555511144.333000000', '011113100021333122330223333333',
+     '...2222...5555555500.000000000', '011113100033333333330333333333'),
+    ('11.22333333554444...0000011111', '229232222223322220003333131111',
+     '11.22333333334444...0000011111', '229232222222222220003333131111'),
+    ('0000112255555..333344440000011', '113133332223200222232221111133',
+     '0000115555555..333344440000011', '113133222222200222232221111133'),
+    ('3300444...11122..555...3333300', '112222200033333093229092333333',
+     '3333444...11155..555...3333333', '333322200033322092229093333333'),
+]
+
+
+@pytest.mark.parametrize('leg_ids,atypes,expected_leg_ids,expected_atypes', INVALID_TRANSITION_CASES)
+def test_detect_and_merge_invalid_transitions(leg_ids, atypes, expected_leg_ids, expected_atypes):
+    leg_ids = leg_ids_from_str(leg_ids)
+    atypes = np.array([int(c) for c in atypes], dtype=np.int64)
+    time = np.arange(len(leg_ids), dtype=np.float64)
+    detect_and_merge_invalid_transitions(leg_ids, atypes, time)
+    # The arrays are modified in place
+    assert leg_ids_to_str(leg_ids) == expected_leg_ids
+    assert ''.join(str(x) for x in atypes) == expected_atypes
+    assert atypes.max() < len(ALL_ATYPES)
+
+
+# One character per sample for the atypes of limit_transportation_methods
+ATYPE_CHARS = {
+    's': 'still', 'f': 'on_foot', 'w': 'walking', 'b': 'on_bicycle', 'v': 'in_vehicle', 'c': 'car',
+    'B': 'bus', 'T': 'tram', 'R': 'train', 'o': 'other', 'u': 'unknown',
+}
+CHAR_BY_ATYPE = {v: k for k, v in ATYPE_CHARS.items()}
+
+# (atypes, 'x' for samples in a leg and '.' for no leg, seconds since the
+# previous sample, atypes after limiting to 3 transport groups). The random
+# cases were generated once and their outputs recorded from the original
+# pandas implementation.
+LIMIT_METHODS_CASES = [
+    # The shortest segment merges into the longer neighbour and takes its
+    # atype, unless it has more samples
+    ('ffffbbvvvvBBBB', 'x' * 14, '1' * 14, 'ffffffvvvvBBBB'),
+    ('wwwbbbbvvBBB', 'x' * 12, '1' * 12, 'wwwbbbbbbBBB'),
+    # Still samples are left alone
+    ('wwwwbbsvvvvBBBB', 'x' * 15, '1' * 15, 'wwwwwwsvvvvBBBB'),
+    # At most 3 groups already
+    ('wwwbbbvvv', 'x' * 9, '1' * 9, 'wwwbbbvvv'),
+    # Random
+    ('TTTTTssssscccBBubbBBBfsfffffwwwwRRbb', 'xxxxxx.xxx.xxxxx.x.xxxxxxxxxxxxxxxx.',
+     '398188549974293673372797659246612786', 'TTTTTssssscccBBubBBBBfsfffffffffRRRb'),
+    ('uubbbbswwffffoossssfffffffffTTTTTBBB', 'xxxxxxxxxx.xxxxxxxxxx.xxxxxxxxxxx..x',
+     '643959254517482418549697652787417182', 'uubbbbsffffffffssssfffffffffTTTTTBBT'),
+    ('bbccwuuwwwwfffffRRvvRRRbbbbffffvvvvv', 'xxxxxxxxxxx..xxx.xxxxxxxxxxxxxxxxxx.',
+     '912338324753215267451525134519422743', 'wwwwwuuwwwwffwwwRwwwwwwbbbbffffvvvvv'),
+    ('uuuuffcccwTTbbbbboooooouuuubbbTTTTTu', 'xxxxxxxxxxxxxxxx.xxxxxxx..xxxxx...xx',
+     '315973336662792456969367895671786785', 'uuuuccccccccooooboooooouuuuoooTTTTTu'),
+    ('ssssBBvvfffvbbbswwuuuuubbbvvffffTTTT', 'xxxxx.xxxx.xxxx.xx.xxxxxxx.xxxxxxxxx',
+     '581252369839118284655876851316361982', 'ssssvBvvvvfbbbbsbbuuuuubbbvbbbbbTTTT'),
+    ('BTTBBcccvwwwwoooooBRRRRRbwwvvvbbbvvB', 'xxxxxxxxxxxxx.xxxxxxx.xxxxxxxxxxxxxx',
+     '553551765937258448311269963845815536', 'BBBBBccccccccoooooRRRRRRRRRvvvvvvvvv'),
+]
+
+
+@pytest.mark.parametrize('atypes,legs,dts,expected', LIMIT_METHODS_CASES)
+def test_limit_transportation_methods(atypes, legs, dts, expected):
+    t = 1.6e9 + np.cumsum([int(c) for c in dts])
+    df = pd.DataFrame(dict(
+        time=pd.to_datetime(t, unit='s', utc=True),
+        leg_id=[-1 if c == '.' else 0 for c in legs],
+        atype=[ATYPE_CHARS[c] for c in atypes],
+    ))
+    out = limit_transportation_methods(df)
+    assert ''.join(CHAR_BY_ATYPE[x] for x in out.atype) == expected
+    # The input is not modified
+    assert ''.join(CHAR_BY_ATYPE[x] for x in df.atype) == atypes
+
+
+def test_binary_copy_round_trip():
+    fields = [('leg_id', 'int4'), ('loc', 'point'), ('time', 'timestamptz'), ('speed', 'float8')]
+    columns = dict(
+        leg_id=np.array([1, 1, 2], dtype=np.int32),
+        loc=np.array([[327673.5, 6820919.25], [327680.0, 6820920.0], [-1.5, 0.0]]),
+        time=np.array(['1999-12-31T23:59:59.999999', '2000-01-01T00:00:00', '2021-06-01T12:34:56.123456'],
+                      dtype='datetime64[us]'),
+        speed=np.array([1.5, np.nan, 0.0]),
+    )
+    buf = encode_binary_copy(columns, fields, srid=3067)
+    out = decode_binary_copy(buf, fields)
+
+    assert list(out['leg_id']) == [1, 1, 2]
+    np.testing.assert_array_equal(out['time'], columns['time'])
+    np.testing.assert_array_equal(out['speed'], columns['speed'])
+    loc = out['loc']
+    np.testing.assert_array_equal(loc['x'], columns['loc'][:, 0])
+    np.testing.assert_array_equal(loc['y'], columns['loc'][:, 1])
+    assert (loc['byte_order'] == 1).all()
+    assert (loc['wkb_type'] == EWKB_POINT | EWKB_SRID_FLAG).all()
+    assert (loc['srid'] == 3067).all()
+
+    # Points need an srid
+    with pytest.raises(ValueError):
+        encode_binary_copy(columns, fields)
+
+
+def write_way_raster(path, distance):
+    grid = np.full((2, 3), round(distance / DISTANCE_UNIT), dtype=np.uint8)
+    meta = dict(x0=0.0, y0=0.0, resolution=5.0, max_distance=50.0, shape=list(grid.shape))
+    tmp_path = str(path) + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        write_header(f, meta)
+        f.write(grid.tobytes())
+    os.replace(tmp_path, path)
+
+
+def test_way_distance_raster_reloads_rebuilt_file(tmp_path):
+    path = str(tmp_path / 'ways.raster')
+    # Not built yet
+    assert get_way_distance_raster(path) is None
+
+    write_way_raster(path, 10)
+    raster = get_way_distance_raster(path)
+    assert list(raster.lookup([1, 100], [1, 1])) == [10, pytest.approx(np.nan, nan_ok=True)]
+    assert get_way_distance_raster(path) is raster
+
+    write_way_raster(path, 20)
+    assert list(get_way_distance_raster(path).lookup([1], [1])) == [20]
+    # The old mapping stays usable
+    assert list(raster.lookup([1], [1])) == [10]
@@ -0,0 +1,271 @@
+import pandas as pd
+import pytest
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import make_aware, utc
+
+from trips.generate import DEVICE_LOCK_NAMESPACE, TripGenerator
+from trips.models import DeviceModeCounts, Leg, LegLocation, Trip
+from trips.tests.factories import DeviceFactory, TransportModeFactory
+from trips_ingest.models import DirtyDevice
+
+pytestmark = pytest.mark.django_db
+
+T0 = make_aware(datetime(2020, 1, 1, 12, 0), utc)
+DELETED_AT = make_aware(datetime(2020, 1, 2, 8, 0), utc)
+X0, Y0 = 327600, 6820900
+MODES = ['walk', 'car', 'bicycle', 'bus', 'tram', 'train', 'other']
+WRITE_TABLES = [Trip._meta.db_table, Leg._meta.db_table, LegLocation._meta.db_table]
+
+
+@pytest.fixture
+def generator():
+    for identifier in MODES:
+        TransportModeFactory(identifier=identifier, name=identifier)
+    return TripGenerator()
+
+
+@pytest.fixture
+def mocaf_device():
+    return DeviceFactory(mocaf_enabled=True)
+
+
+def make_samples(legs, start=0):
+    """Return the filtered samples of a trip with legs given as (atype, sample count).
+
+    The samples are 10 s and 50 m apart; `start` is the index of the first
+    sample, so that consecutive trips can be made.
+    """
+    rows = []
+    i = start
+    for leg_id, (atype, count) in enumerate(legs):
+        for _ in range(count):
+            time = T0 + timedelta(seconds=10 * i)
+            rows.append(dict(
+                time=time, x=X0 + 50.0 * i, y=Y0, leg_id=leg_id, atype=atype, distance=50.0, speed=5.0,
+                created_at=time + timedelta(minutes=1),
+            ))
+            i += 1
+    return pd.DataFrame(rows)
+
+
+def save_trip(generator, device, df):
+    generator.save_trip(device, df, {}, device.uuid)
+
+
+def device_legs(device):
+    return list(Leg.objects.filter(trip__device=device).select_related('mode').order_by('start_time'))
+
+
+def location_ids(leg):
+    return set(LegLocation.objects.filter(leg=leg).values_list('id', flat=True))
+
+
+def leg_writes(queries):
+    writes = []
+    for query in queries:
+        sql = query['sql']
+        if sql.split(' ', 1)[0] in ('INSERT', 'UPDATE', 'DELETE') and any('"%s"' % t in sql for t in WRITE_TABLES):
+            writes.append(sql)
+    return writes
+
+
+def test_save_trip_rerun_writes_nothing(generator, mocaf_device):
+    df = make_samples([('walking', 6), ('in_vehicle', 6)])
+    save_trip(generator, mocaf_device, df)
+    legs = device_legs(mocaf_device)
+    assert [leg.mode.identifier for leg in legs] == ['walk', 'car']
+    locations = {leg.id: location_ids(leg) for leg in legs}
+    assert [len(ids) for ids in locations.values()] == [6, 6]
+
+    with CaptureQueriesContext(connection) as ctx:
+        save_trip(generator, mocaf_device, df)
+    assert leg_writes(ctx.captured_queries) == []
+    # The locations are written with COPY, which isn't captured
+    assert {leg.id: location_ids(leg) for leg in device_legs(mocaf_device)} == locations
+    assert Trip.objects.filter(device=mocaf_device).count() == 1
+
+
+def test_save_trip_updates_changed_mode_in_place(generator, mocaf_device):
+    save_trip(generator, mocaf_device, make_samples([('walking', 6), ('in_vehicle', 6)]))
+    assert DeviceModeCounts.for_device(mocaf_device.id).counts == {'walk': 1, 'car': 1}
+    walk, car = device_legs(mocaf_device)
+    car_locations = location_ids(car)
+
+    with CaptureQueriesContext(connection) as ctx:
+        save_trip(generator, mocaf_device, make_samples([('walking', 6), ('on_bicycle', 6)]))
+    writes = leg_writes(ctx.captured_queries)
+    assert len(writes) == 1 and writes[0].startswith('UPDATE "%s"' % Leg._meta.db_table)
+
+    legs = device_legs(mocaf_device)
+    assert [(leg.id, leg.mode.identifier) for leg in legs] == [(walk.id, 'walk'), (car.id, 'bicycle')]
+    assert legs[1].estimated_mode.identifier == 'bicycle'
+    assert location_ids(legs[1]) == car_locations
+    assert DeviceModeCounts.objects.get(device=mocaf_device).counts == {'walk': 1, 'car': 0, 'bicycle': 1}
+
+
+def test_save_trip_replaces_only_split_and_merged_legs(generator, mocaf_device):
+    save_trip(generator, mocaf_device, make_samples([('walking', 6), ('in_vehicle', 6)]))
+    walk, car = device_legs(mocaf_device)
+    walk_locations = location_ids(walk)
+
+    # The car leg is split in two
+    save_trip(generator, mocaf_device, make_samples([('walking', 6), ('in_vehicle', 3), ('bus', 3)]))
+    legs = device_legs(mocaf_device)
+    assert [leg.mode.identifier for leg in legs] == ['walk', 'car', 'bus']
+    assert legs[0].id == walk.id
+    assert location_ids(legs[0]) == walk_locations
+    assert car.id not in {leg.id for leg in legs}
+    assert [len(location_ids(leg)) for leg in legs] == [6, 3, 3]
+
+    # ...and merged again
+    split_ids = {leg.id for leg in legs[1:]}
+    save_trip(generator, mocaf_device, make_samples([('walking', 6), ('in_vehicle', 6)]))
+    legs = device_legs(mocaf_device)
+    assert legs[0].id == walk.id
+    assert location_ids(legs[0]) == walk_locations
+    assert legs[1].id not in split_ids
+    assert not Leg.objects.filter(id__in=split_ids).exists()
+    assert LegLocation.objects.filter(leg__trip__device=mocaf_device).count() == 12
+
+
+def test_save_trip_merges_trips(generator, mocaf_device):
+    save_trip(generator, mocaf_device, make_samples([('walking', 6)]))
+    save_trip(generator, mocaf_device, make_samples([('in_vehicle', 6), ('bus', 6)], start=6))
+    walk, car, bus = device_legs(mocaf_device)
+    assert walk.trip_id != car.trip_id
+    locations = {leg.id: location_ids(leg) for leg in (walk, car, bus)}
+
+    save_trip(generator, mocaf_device, make_samples([('walking', 6), ('in_vehicle', 6), ('bus', 6)]))
+    legs = device_legs(mocaf_device)
+    # The legs are moved to the trip most of them belong to and the other
+    # trip is removed
+    assert [leg.id for leg in legs] == [walk.id, car.id, bus.id]
+    assert {leg.trip_id for leg in legs} == {car.trip_id}
+    assert list(Trip.objects.filter(device=mocaf_device).values_list('id', flat=True)) == [car.trip_id]
+    assert {leg.id: location_ids(leg) for leg in legs} == locations
+
+
+def test_save_trip_keeps_deleted_legs(generator, mocaf_device):
+    save_trip(generator, mocaf_device, make_samples([('walking', 6), ('in_vehicle', 6)]))
+    assert DeviceModeCounts.for_device(mocaf_device.id).counts == {'walk': 1, 'car': 1}
+    walk, car = device_legs(mocaf_device)
+    Leg.objects.filter(id=walk.id).update(deleted_at=DELETED_AT)
+    DeviceModeCounts.update_device(mocaf_device.id, [('walk', walk.start_time, -1)])
+
+    save_trip(generator, mocaf_device, make_samples([('walking', 6), ('on_bicycle', 6)]))
+    legs = device_legs(mocaf_device)
+    assert [(leg.id, leg.deleted_at) for leg in legs] == [(walk.id, DELETED_AT), (car.id, None)]
+    assert Trip.objects.get(id=walk.trip_id).deleted_at is None
+    assert DeviceModeCounts.objects.get(device=mocaf_device).counts == {'walk': 0, 'car': 0, 'bicycle': 1}
+
+
+def test_save_trip_keeps_deleted_trip_deleted(generator, mocaf_device):
+    save_trip(generator, mocaf_device, make_samples([('walking', 6), ('in_vehicle', 6)]))
+    walk, car = device_legs(mocaf_device)
+    trip = walk.trip
+    Leg.objects.filter(trip=trip).update(deleted_at=DELETED_AT)
+    Trip.objects.filter(id=trip.id).update(deleted_at=DELETED_AT)
+    assert DeviceModeCounts.for_device(mocaf_device.id).counts == {}
+
+    # A split leg doesn't bring the deleted trip back
+    save_trip(generator, mocaf_device, make_samples([('walking', 6), ('in_vehicle', 3), ('bus', 3)]))
+    legs = device_legs(mocaf_device)
+    assert legs[0].id == walk.id
+    assert {leg.trip_id for leg in legs} == {trip.id}
+    assert [leg.deleted_at for leg in legs] == [DELETED_AT] * 3
+    assert Trip.objects.get(id=trip.id).deleted_at == DELETED_AT
+    assert not Trip.objects.filter(device=mocaf_device).active().exists()
+    assert DeviceModeCounts.objects.get(device=mocaf_device).counts == {}
+
+
+def test_save_trip_moves_legs_of_deleted_trip_as_deleted(generator, mocaf_device):
+    save_trip(generator, mocaf_device, make_samples([('walking', 6)]))
+    save_trip(generator, mocaf_device, make_samples([('in_vehicle', 6), ('bus', 6)], start=6))
+    walk, car, bus = device_legs(mocaf_device)
+    Trip.objects.filter(id=walk.trip_id).update(deleted_at=DELETED_AT)
+
+    save_trip(generator, mocaf_device, make_samples([('walking', 6), ('in_vehicle', 6), ('bus', 6)]))
+    legs = device_legs(mocaf_device)
+    assert [leg.id for leg in legs] == [walk.id, car.id, bus.id]
+    assert [leg.deleted_at for leg in legs] == [DELETED_AT, None, None]
+    assert Trip.objects.get(id=car.trip_id).deleted_at is None
+    assert not Trip.objects.filter(id=walk.trip_id).exists()
+
+
+@pytest.fixture
+def generation(generator, monkeypatch):
+    """Record the devices generate_trips is called for instead of generating their trips.
+
+    A device in `fail` makes generate_trips raise, and one in `new_samples`
+    gets newer samples queued during its generation.
+    """
+    generation = SimpleNamespace(uuids=[], fail=set(), new_samples=set())
+
+    def generate_trips(uuid, start_time, end_time, generation_started_at=None, resume=False):
+        generation.uuids.append(uuid)
+        if uuid in generation.fail:
+            raise RuntimeError('generation failed')
+        if uuid in generation.new_samples:
+            DirtyDevice.enqueue(uuid, end_time, end_time + timedelta(seconds=1))
+
+    monkeypatch.setattr(generator, 'generate_trips', generate_trips)
+    return generation
+
+
+# generate_new_trips commits, so these tests can't run in a transaction
+@pytest.mark.django_db(transaction=True)
+def test_generate_new_trips_dequeues_generated_devices(generator, generation):
+    devices = [DeviceFactory(mocaf_enabled=True) for _ in range(3)]
+    disabled = DeviceFactory(mocaf_enabled=False)
+    for device in devices + [disabled]:
+        DirtyDevice.enqueue(device.uuid, T0, T0)
+    generation.new_samples.add(devices[1].uuid)
+
+    generator.generate_new_trips()
+    assert generation.uuids == [device.uuid for device in devices]
+    # Only the device that got new samples during its generation stays queued
+    assert list(DirtyDevice.objects.values_list('uuid', flat=True)) == [devices[1].uuid]
+    assert DirtyDevice.objects.get().received_at > T0
+
+    generator.generate_new_trips(only_uuid=devices[0].uuid)
+    assert generation.uuids == [device.uuid for device in devices]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_generate_new_trips_keeps_failed_device_queued(generator, generation):
+    device = DeviceFactory(mocaf_enabled=True)
+    DirtyDevice.enqueue(device.uuid, T0, T0)
+    generation.fail.add(device.uuid)
+
+    with pytest.raises(RuntimeError):
+        generator.generate_new_trips()
+    assert list(DirtyDevice.objects.values_list('uuid', 'received_at')) == [(device.uuid, T0)]
+
+    generation.fail.clear()
+    generator.generate_new_trips(uuids=[device.uuid])
+    assert generation.uuids == [device.uuid, device.uuid]
+    assert not DirtyDevice.objects.exists()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_generate_new_trips_skips_locked_devices(generator, generation):
+    locked, free = DeviceFactory(mocaf_enabled=True), DeviceFactory(mocaf_enabled=True)
+    for device in (locked, free):
+        DirtyDevice.enqueue(device.uuid, T0, T0)
+    # E.g. a backfill worker generating the trips of the device
+    other = connection.copy()
+    try:
+        with other.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_lock(%s, hashtext(%s))', [DEVICE_LOCK_NAMESPACE, str(locked.uuid)])
+        generator.generate_new_trips()
+    finally:
+        other.close()
+    assert generation.uuids == [free.uuid]
+    assert list(DirtyDevice.objects.values_list('uuid', flat=True)) == [locked.uuid]
+
+    generator.generate_new_trips()
+    assert generation.uuids == [free.uuid, locked.uuid]
+    assert not DirtyDevice.objects.exists()
@@ -1,15 +1,17 @@
 import pytest
-from datetime import date, datetime
+import uuid
+from datetime import date, datetime, timedelta
 from django.utils.timezone import make_aware, utc
 
 from budget.tests.factories import DeviceDailyCarbonFootprintFactory, PrizeFactory
 from budget.enums import TimeResolution
 from trips.tests.factories import (
-    BackgroundInfoQuestionFactory, DeviceDefaultModeVariantFactory, DeviceFactory, LegFactory, TripFactory
+    BackgroundInfoQuestionFactory, DeviceDefaultModeVariantFactory, DeviceFactory, LegFactory, TransportModeFactory,
+    TripFactory
 )
 from trips.generate import make_point
-from trips.models import AlreadyRegistered, Device, MigrationRequired
-from trips_ingest.models import DeviceHeartbeat, Location
+from trips.models import AlreadyRegistered, Device, DeviceModeCounts, MigrationRequired, TripBackfillDevice
+from trips_ingest.models import DeviceHeartbeat, DirtyDevice, Location
 
 pytestmark = pytest.mark.django_db
 
@@ -41,6 +43,144 @@ def test_update_daily_carbon_footprint_padding_on_idle_days(emission_budget_leve
     assert list(device.daily_carbon_footprints.values_list('carbon_footprint', flat=True)) == expected
 
 
+def test_update_daily_carbon_footprints_merges_ranges(emission_budget_level_bronze):
+    device = DeviceFactory()
+    ranges = []
+    for day in (5, 1, 2):
+        start_time = make_aware(datetime(2020, 1, day, 10, 0), utc)
+        end_time = make_aware(datetime(2020, 1, day, 10, 30), utc)
+        LegFactory(trip__device=device, start_time=start_time, end_time=end_time, carbon_footprint=1000)
+        ranges.append((start_time, end_time))
+
+    device.update_daily_carbon_footprints(ranges)
+    assert list(device.daily_carbon_footprints.values_list('date', 'carbon_footprint')) == [
+        (date(2020, 1, 1), 1.0), (date(2020, 1, 2), 1.0), (date(2020, 1, 5), 1.0),
+    ]
+
+
+def test_device_mode_counts_recount_excludes_deleted_legs(settings):
+    settings.PERSONAL_MODE_PRIOR_HALF_LIFE_DAYS = 0
+    device = DeviceFactory()
+    walk = TransportModeFactory(identifier='walk')
+    bus = TransportModeFactory(identifier='bus')
+    LegFactory.create_batch(2, trip__device=device, mode=walk)
+    LegFactory(trip__device=device, mode=bus, deleted_at=make_aware(datetime(2020, 1, 2), utc))
+    LegFactory(trip__device=DeviceFactory(), mode=bus)
+
+    # Devices are counted when the counts are first needed
+    DeviceModeCounts.update_device(device.id, [('bus', make_aware(datetime(2020, 1, 1), utc), 1)])
+    assert not DeviceModeCounts.objects.filter(device=device).exists()
+
+    counts = DeviceModeCounts.for_device(device.id)
+    assert counts.counts == {'walk': 2}
+    assert counts.half_life_days is None
+
+    DeviceModeCounts.update_device(device.id, [
+        ('walk', make_aware(datetime(2020, 1, 3), utc), -1), ('bus', make_aware(datetime(2020, 1, 3), utc), 1),
+    ])
+    assert DeviceModeCounts.for_device(device.id).counts == {'walk': 1, 'bus': 1}
+
+
+def test_device_mode_counts_half_life(settings):
+    settings.PERSONAL_MODE_PRIOR_HALF_LIFE_DAYS = 1
+    device = DeviceFactory()
+    t0 = make_aware(datetime(2020, 1, 10, 12, 0), utc)
+    LegFactory(trip__device=device, mode=TransportModeFactory(identifier='walk'), start_time=t0 - timedelta(days=2))
+    LegFactory(trip__device=device, mode=TransportModeFactory(identifier='bicycle'), start_time=t0)
+
+    counts = DeviceModeCounts.for_device(device.id)
+    # Weighted by the age relative to the newest leg
+    assert counts.half_life_days == 1
+    assert counts.reference_time == t0
+    assert counts.counts['walk'] == pytest.approx(0.25)
+    assert counts.counts['bicycle'] == pytest.approx(1)
+
+    # A newer leg ages the existing counts
+    DeviceModeCounts.update_device(device.id, [('walk', t0 + timedelta(days=1), 1)])
+    counts = DeviceModeCounts.for_device(device.id)
+    assert counts.reference_time == t0 + timedelta(days=1)
+    assert counts.counts['walk'] == pytest.approx(1.125)
+    assert counts.counts['bicycle'] == pytest.approx(0.5)
+
+
+def test_device_mode_counts_recount_after_half_life_change(settings):
+    settings.PERSONAL_MODE_PRIOR_HALF_LIFE_DAYS = 0
+    device = DeviceFactory()
+    t0 = make_aware(datetime(2020, 1, 10, 12, 0), utc)
+    LegFactory(trip__device=device, mode=TransportModeFactory(identifier='walk'), start_time=t0 - timedelta(days=1))
+    LegFactory(trip__device=device, mode=TransportModeFactory(identifier='bicycle'), start_time=t0)
+    assert DeviceModeCounts.for_device(device.id).counts == {'walk': 1, 'bicycle': 1}
+
+    settings.PERSONAL_MODE_PRIOR_HALF_LIFE_DAYS = 1
+    counts = DeviceModeCounts.for_device(device.id)
+    assert counts.half_life_days == 1
+    assert counts.counts['walk'] == pytest.approx(0.5)
+    assert DeviceModeCounts.objects.filter(device=device).count() == 1
+
+    # Updates recount too, instead of mixing the weightings
+    settings.PERSONAL_MODE_PRIOR_HALF_LIFE_DAYS = 0
+    DeviceModeCounts.update_device(device.id, [('walk', t0, 1)])
+    counts = DeviceModeCounts.objects.get(device=device)
+    assert counts.half_life_days is None
+    assert counts.counts == {'walk': 1, 'bicycle': 1}
+
+
+def test_trip_backfill_claims_largest_unstarted_device_first():
+    small = TripBackfillDevice.objects.create(backfill='test', uuid=uuid.uuid4(), expected_rows=10)
+    large = TripBackfillDevice.objects.create(backfill='test', uuid=uuid.uuid4(), expected_rows=100)
+    TripBackfillDevice.objects.create(
+        backfill='test', uuid=uuid.uuid4(), expected_rows=1000, finished_at=make_aware(datetime(2020, 1, 1), utc)
+    )
+    TripBackfillDevice.objects.create(backfill='other', uuid=uuid.uuid4(), expected_rows=1000)
+
+    assert TripBackfillDevice.claim('test') == large
+    assert TripBackfillDevice.claim('test') == small
+    assert TripBackfillDevice.claim('test') is None
+    small.refresh_from_db()
+    assert small.started_at is not None
+
+
+def test_dirty_device_enqueue_keeps_newest_times():
+    device_uuid = uuid.uuid4()
+    t0 = make_aware(datetime(2020, 1, 1, 12, 0), utc)
+    DirtyDevice.enqueue(device_uuid, t0, t0 + timedelta(minutes=1))
+    queued_at = DirtyDevice.objects.get(uuid=device_uuid).queued_at
+
+    # Late samples don't move the times back
+    DirtyDevice.enqueue(device_uuid, t0 - timedelta(hours=1), t0)
+    DirtyDevice.enqueue(device_uuid, t0 + timedelta(minutes=5), t0 + timedelta(minutes=6))
+    dirty = DirtyDevice.objects.get(uuid=device_uuid)
+    assert dirty.newest_time == t0 + timedelta(minutes=5)
+    assert dirty.received_at == t0 + timedelta(minutes=6)
+    assert dirty.queued_at == queued_at
+
+
+def test_dirty_device_claim_and_dequeue():
+    t0 = make_aware(datetime(2020, 1, 1, 12, 0), utc)
+    first, second = uuid.uuid4(), uuid.uuid4()
+    DirtyDevice.enqueue(second, t0, t0)
+    DirtyDevice.enqueue(first, t0, t0)
+    DirtyDevice.objects.filter(uuid=first).update(queued_at=t0 - timedelta(minutes=10))
+    DirtyDevice.objects.filter(uuid=second).update(queued_at=t0)
+
+    assert DirtyDevice.claim(t0 - timedelta(minutes=20)) is None
+    assert DirtyDevice.claim(t0).uuid == first
+    assert DirtyDevice.claim(t0, exclude=[first]).uuid == second
+    assert DirtyDevice.claim(t0, uuids=[first], exclude=[first]) is None
+    claimed = DirtyDevice.claim(t0, uuids=[second])
+    assert claimed.uuid == second
+    # Claimed devices stay queued until they are dequeued
+    assert DirtyDevice.queued_uuids(t0) == [first, second]
+
+    # Samples queued after the claim keep the device queued
+    DirtyDevice.enqueue(second, t0 + timedelta(minutes=1), t0 + timedelta(minutes=1))
+    assert not claimed.dequeue()
+    assert DirtyDevice.objects.get(uuid=second).received_at == t0 + timedelta(minutes=1)
+
+    assert DirtyDevice.claim(t0, uuids=[second]).dequeue()
+    assert DirtyDevice.queued_uuids(t0) == [first]
+
+
 @pytest.mark.parametrize('month', [
     (date(2020, 1, 1)),
     (date(2020, 1, 31)),
@@ -135,6 +275,18 @@ def test_device_register_not_migrate_existing(registered_device):
         device.register(registered_device.account_key, migrate_existing=False)
 
 
+def test_device_register_recounts_modes(registered_device):
+    LegFactory.create_batch(2, trip__device=registered_device, mode=TransportModeFactory(identifier='walk'))
+    new_device = DeviceFactory()
+    LegFactory(trip__device=new_device, mode=TransportModeFactory(identifier='bus'))
+    assert DeviceModeCounts.for_device(registered_device.id).counts == {'walk': 2}
+    assert DeviceModeCounts.for_device(new_device.id).counts == {'bus': 1}
+
+    new_device.register(registered_device.account_key)
+    assert DeviceModeCounts.for_device(registered_device.id).counts == {}
+    assert DeviceModeCounts.for_device(new_device.id).counts == {'walk': 2, 'bus': 1}
+
+
 def test_device_register_moves_trip(registered_device):
     trip = TripFactory(device=registered_device)
     assert list(registered_device.trips.all()) == [trip]
@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+
+from calc.personal_emphasis import SIMILAR_LEG_DISTANCE, LegEndpointIndex, similar_legs_by_location
+from trips.generate import make_point
+from trips.tests.factories import DeviceFactory, LegFactory, TransportModeFactory, TripFactory
+
+pytestmark = pytest.mark.django_db
+
+MODES = ['walk', 'bicycle', 'car', 'bus']
+X0, Y0 = 327600, 6820900
+
+
+def brute_force_counts(legs, start_x, start_y, end_x, end_y):
+    counts = {}
+    for mode, sx, sy, ex, ey in legs.values():
+        if np.hypot(sx - start_x, sy - start_y) > SIMILAR_LEG_DISTANCE:
+            continue
+        if np.hypot(ex - end_x, ey - end_y) > SIMILAR_LEG_DISTANCE:
+            continue
+        counts[mode] = counts.get(mode, 0) + 1
+    return counts
+
+
+def test_leg_endpoint_index_cell_boundaries():
+    index = LegEndpointIndex(MODES)
+    # The start points are in the cells next to the query start point
+    index.add(1, 'walk', X0 + 199.9, Y0, X0 + 1000, Y0)
+    index.add(2, 'bus', X0 + 200.1 - 99.9, Y0, X0 + 1000, Y0 + 50)
+    index.add(3, 'car', X0 + 200.1 + 99.9, Y0, X0 + 1000, Y0)
+    index.add(4, 'car', X0 + 200.1 + 100.1, Y0, X0 + 1000, Y0)
+    # The end point is too far
+    index.add(5, 'bicycle', X0 + 200.1, Y0 + 10, X0 + 1000, Y0 + 150)
+
+    assert index.similar_mode_counts(X0 + 200.1, Y0, X0 + 1000, Y0) == {'walk': 1, 'bus': 1, 'car': 1}
+    assert index.similar_mode_probs(X0 + 200.1, Y0, X0 + 1000, Y0)['bus'] == pytest.approx(1 / 3)
+    assert index.similar_mode_probs(X0 + 5000, Y0, X0 + 1000, Y0) is None
+
+    # Re-adding a leg replaces it and removed legs are no longer counted
+    index.add(3, 'walk', X0 + 250, Y0, X0 + 1000, Y0)
+    index.remove([1, 2, 99])
+    assert index.similar_mode_counts(X0 + 200.1, Y0, X0 + 1000, Y0) == {'walk': 1}
+
+
+def test_leg_endpoint_index_matches_brute_force():
+    rng = np.random.default_rng(0)
+    index = LegEndpointIndex(MODES)
+    legs = {}
+    for leg_id in range(500):
+        # Points on and around the cell boundaries
+        sx, sy = X0 + rng.integers(0, 6) * 100 + rng.normal(0, 30, 2)
+        ex, ey = X0 + 2000 + rng.integers(0, 3) * 100 + rng.normal(0, 30, 2)
+        mode = MODES[rng.integers(len(MODES))]
+        index.add(leg_id, mode, sx, sy, ex, ey)
+        legs[leg_id] = (mode, sx, sy, ex, ey)
+    removed = list(range(0, 500, 7))
+    index.remove(removed)
+    for leg_id in removed:
+        del legs[leg_id]
+
+    for _ in range(300):
+        sx, sy = X0 + rng.uniform(-100, 700, 2)
+        ex, ey = X0 + 2000 + rng.uniform(-100, 400, 2)
+        assert index.similar_mode_counts(sx, sy, ex, ey) == brute_force_counts(legs, sx, sy, ex, ey)
+
+
+def test_leg_endpoint_index_matches_similar_legs_by_location():
+    device = DeviceFactory()
+    trip = TripFactory(device=device)
+    start_x, start_y, end_x, end_y = X0, Y0, X0 + 3000, Y0 + 500
+    # (mode, start offset, end offset) in meters; well inside or outside of
+    # the limit, so that the geodesic and the planar distance agree
+    legs = [
+        ('walk', (10, 20), (-30, 5)),
+        ('walk', (-60, 40), (50, 50)),
+        ('bus', (0, 0), (0, 0)),
+        ('bus', (150, 0), (0, 0)),
+        ('car', (0, 0), (0, -160)),
+        ('car', (-90, -5), (5, 90)),
+    ]
+    for mode, (sdx, sdy), (edx, edy) in legs:
+        LegFactory(
+            trip=trip, mode=TransportModeFactory(identifier=mode),
+            start_loc=make_point(start_x + sdx, start_y + sdy), end_loc=make_point(end_x + edx, end_y + edy),
+        )
+    # Legs of other devices don't count
+    LegFactory(
+        trip__device=DeviceFactory(), mode=TransportModeFactory(identifier='bus'),
+        start_loc=make_point(start_x, start_y), end_loc=make_point(end_x, end_y),
+    )
+
+    similar = similar_legs_by_location(device.id, make_point(start_x, start_y), make_point(end_x, end_y))
+    expected = {}
+    for leg in similar.select_related('mode'):
+        expected[leg.mode.identifier] = expected.get(leg.mode.identifier, 0) + 1
+
+    index = LegEndpointIndex.for_device(device.id)
+    assert index.similar_mode_counts(start_x, start_y, end_x, end_y) == expected == {'walk': 2, 'bus': 1, 'car': 1}
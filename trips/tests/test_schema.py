@@ -4,7 +4,7 @@ from dateutil.relativedelta import relativedelta
 from django.db.models import Sum
 from django.utils.timezone import make_aware, utc
 
-from trips.tests.factories import DeviceFactory, LegFactory, TripFactory
+from trips.tests.factories import DeviceFactory, LegFactory, TransportModeFactory, TripFactory
 from poll.tests.factories import (
     ParticipantsFactory,
     QuestionsFactory,
@@ -13,7 +13,7 @@ from poll.tests.factories import (
     TripsFactory,
     SurveyInfoFactory,
 )
-from trips.models import Device, Leg, Trip
+from trips.models import Device, DeviceModeCounts, Leg, Trip
 from freezegun import freeze_time
 
 pytestmark = pytest.mark.django_db
@@ -596,6 +596,33 @@ def test_update_leg(graphql_client_query_data, uuid, token, device, settings):
     assert leg.nr_passengers == nr_passengers
 
 
+def test_update_leg_updates_mode_counts(graphql_client_query_data, uuid, token, device, settings):
+    settings.ALLOWED_TRIP_UPDATE_HOURS = 24 * 365 * 1000
+    settings.PERSONAL_MODE_PRIOR_HALF_LIFE_DAYS = 0
+    walk = TransportModeFactory(identifier="walk")
+    TransportModeFactory(identifier="bicycle")
+    leg = LegFactory(trip__device=device, mode=walk)
+    LegFactory(trip=leg.trip, mode=walk)
+    assert DeviceModeCounts.for_device(device.id).counts == {"walk": 2}
+
+    query = """
+        mutation($uuid: String!, $token: String!, $leg: ID!, $mode: ID, $deleted: Boolean)
+        @device(uuid: $uuid, token: $token) {
+          updateLeg(leg: $leg, mode: $mode, deleted: $deleted) {
+            ok
+          }
+        }
+    """
+    variables = {"uuid": uuid, "token": token, "leg": leg.id}
+    data = graphql_client_query_data(query, variables={**variables, "mode": "bicycle"})
+    assert data["updateLeg"]["ok"] is True
+    assert DeviceModeCounts.for_device(device.id).counts == {"walk": 1, "bicycle": 1}
+
+    data = graphql_client_query_data(query, variables={**variables, "deleted": True})
+    assert data["updateLeg"]["ok"] is True
+    assert DeviceModeCounts.for_device(device.id).counts == {"walk": 1, "bicycle": 0}
+
+
 def test_clear_user_data(graphql_client_query_data, device):
     trip = TripFactory(device=device)
     leg = LegFactory(trip=trip)
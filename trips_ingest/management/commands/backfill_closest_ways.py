@@ -0,0 +1,46 @@
+from datetime import timedelta
+
+from dateutil.parser import parse
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max, Min
+
+from trips.models import LOCAL_TZ
+from trips_ingest.models import Location
+from trips_ingest.ways import backfill_closest_ways
+
+
+class Command(BaseCommand):
+    help = 'Fill in the nearest car and rail ways for location samples stored before they were computed at ingest'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--uuid', type=str)
+        parser.add_argument('--start-time', type=str)
+        parser.add_argument('--batch-days', type=int, default=1, help='Length of the time range updated at once')
+
+    def parse_time(self, val):
+        dt = parse(val)
+        if not dt.tzinfo:
+            dt = LOCAL_TZ.localize(dt)
+        return dt
+
+    def handle(self, *args, **options):
+        qs = Location.objects.filter(closest_ways_computed__isnull=True)
+        if options['uuid']:
+            qs = qs.filter(uuid=options['uuid'])
+        if options['start_time']:
+            qs = qs.filter(time__gte=self.parse_time(options['start_time']))
+
+        batch = timedelta(days=options['batch_days'])
+        devices = qs.values('uuid').annotate(first=Min('time'), last=Max('time')).order_by('uuid')
+        for dev in devices:
+            uuid = dev['uuid']
+            start_time = dev['first']
+            count = 0
+            while start_time <= dev['last']:
+                end_time = start_time + batch
+                # Commit each batch to keep the transactions short
+                with transaction.atomic():
+                    count += backfill_closest_ways(uuid, start_time, end_time)
+                start_time = end_time
+            self.stdout.write('%s: %d samples updated' % (uuid, count))
@@ -0,0 +1,24 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trips_ingest', '0015_add_location_deleted_at'),
+    ]
+
+    operations = [
+        migrations.RunSQL("""
+            ALTER TABLE "trips_ingest_location" ADD COLUMN "closest_car_way_id" bigint NULL;
+            ALTER TABLE "trips_ingest_location" ADD COLUMN "closest_car_way_dist" double precision NULL;
+            ALTER TABLE "trips_ingest_location" ADD COLUMN "closest_rail_way_id" bigint NULL;
+            ALTER TABLE "trips_ingest_location" ADD COLUMN "closest_rail_way_dist" double precision NULL;
+            ALTER TABLE "trips_ingest_location" ADD COLUMN "closest_ways_computed" boolean NULL;
+        """, reverse_sql="""
+            ALTER TABLE "trips_ingest_location" DROP COLUMN "closest_car_way_id";
+            ALTER TABLE "trips_ingest_location" DROP COLUMN "closest_car_way_dist";
+            ALTER TABLE "trips_ingest_location" DROP COLUMN "closest_rail_way_id";
+            ALTER TABLE "trips_ingest_location" DROP COLUMN "closest_rail_way_dist";
+            ALTER TABLE "trips_ingest_location" DROP COLUMN "closest_ways_computed";
+        """),
+    ]
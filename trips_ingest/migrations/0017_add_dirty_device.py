@@ -0,0 +1,29 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trips_ingest', '0016_add_location_closest_ways'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DirtyDevice',
+            fields=[
+                ('uuid', models.UUIDField(primary_key=True, serialize=False)),
+                ('newest_time', models.DateTimeField(help_text='Time of the newest queued sample')),
+                ('received_at', models.DateTimeField(help_text='When the newest queued sample was received')),
+                ('queued_at', models.DateTimeField(help_text='When the device was first queued')),
+            ],
+        ),
+        # Queue the devices that the generator would have found by scanning
+        # the samples of the last week.
+        migrations.RunSQL("""
+            INSERT INTO "trips_ingest_dirtydevice" (uuid, newest_time, received_at, queued_at)
+            SELECT uuid, MAX(time), COALESCE(MAX(created_at), MAX(time)), now()
+            FROM "trips_ingest_location"
+            WHERE deleted_at IS NULL AND time >= now() - interval '7 days'
+            GROUP BY uuid
+        """, reverse_sql=migrations.RunSQL.noop),
+    ]
@@ -1,10 +1,12 @@
 import gzip
 import pytz
+from django.db import connection
 from django.db.models import Q
 from django.contrib.gis.db import models
 from django.utils.translation import gettext_lazy as _
 from django.contrib.postgres.fields import ArrayField
 from django.conf import settings
+from django.utils import timezone
 
 
 LOCAL_TZ = pytz.timezone(settings.TIME_ZONE)
@@ -178,6 +180,12 @@ class Location(models.Model):
     manual_atype = models.CharField(choices=ActivityTypeChoices.choices, null=True, max_length=20)
     sensor_data_count = models.PositiveIntegerField(null=True)
     deleted_at = models.DateTimeField(null=True)
+    # Nearest car and rail ways (within CLOSEST_WAY_MAX_DISTANCE), filled in at ingest
+    closest_car_way_id = models.BigIntegerField(null=True)
+    closest_car_way_dist = models.FloatField(null=True)
+    closest_rail_way_id = models.BigIntegerField(null=True)
+    closest_rail_way_dist = models.FloatField(null=True)
+    closest_ways_computed = models.BooleanField(null=True)
 
     class Meta:
         managed = False
@@ -187,6 +195,68 @@ class Location(models.Model):
         return '%s [%s]' % (self.uuid, self.time)
 
 
+class DirtyDevice(models.Model):
+    """Queue of the devices with location samples not yet processed into trips.
+
+    The event processor upserts a row whenever it stores samples for a
+    device and the trip generator removes the row once the trips of the
+    device have been generated, so finding the devices with new data
+    doesn't need a scan of the location table.
+    """
+    uuid = models.UUIDField(primary_key=True)
+    newest_time = models.DateTimeField(help_text=_('Time of the newest queued sample'))
+    received_at = models.DateTimeField(help_text=_('When the newest queued sample was received'))
+    queued_at = models.DateTimeField(help_text=_('When the device was first queued'))
+
+    def __str__(self):
+        return '%s [%s]' % (self.uuid, self.newest_time)
+
+    @classmethod
+    def enqueue(cls, uuid, newest_time, received_at):
+        table = cls._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                INSERT INTO {table} (uuid, newest_time, received_at, queued_at)
+                    VALUES (%(uuid)s, %(newest_time)s, %(received_at)s, %(now)s)
+                ON CONFLICT (uuid) DO UPDATE SET
+                    newest_time = GREATEST({table}.newest_time, EXCLUDED.newest_time),
+                    received_at = GREATEST({table}.received_at, EXCLUDED.received_at)
+            """, dict(uuid=uuid, newest_time=newest_time, received_at=received_at, now=timezone.now()))
+
+    @classmethod
+    def queued_uuids(cls, queued_before, uuid=None) -> list:
+        """Return the uuids of the devices queued before `queued_before`, oldest first."""
+        qs = cls.objects.filter(queued_at__lte=queued_before)
+        if uuid is not None:
+            qs = qs.filter(uuid=uuid)
+        return list(qs.order_by('queued_at').values_list('uuid', flat=True))
+
+    @classmethod
+    def claim(cls, queued_before, uuids=None, exclude=()):
+        """Lock and return the longest-queued device not locked by another generator.
+
+        Must be called in a transaction; the row stays locked until the
+        transaction ends and the device stays queued until dequeue() is
+        called. Returns None if there are no devices queued before
+        `queued_before` (optionally only the ones in `uuids`) other than
+        the ones in `exclude`.
+        """
+        qs = cls.objects.select_for_update(skip_locked=True).filter(queued_at__lte=queued_before)
+        if uuids is not None:
+            qs = qs.filter(uuid__in=uuids)
+        if exclude:
+            qs = qs.exclude(uuid__in=exclude)
+        return qs.order_by('queued_at').first()
+
+    def dequeue(self) -> bool:
+        """Remove the device from the queue unless newer samples have been queued since it was claimed.
+
+        Returns True if the device was removed.
+        """
+        deleted, _ = DirtyDevice.objects.filter(uuid=self.uuid, received_at__lte=self.received_at).delete()
+        return bool(deleted)
+
+
 class DeviceHeartbeat(models.Model):
     time = models.DateTimeField()
     uuid = models.UUIDField()
@@ -10,8 +10,9 @@ from django.utils import timezone
 from django.contrib.gis.geos import Point
 from django.contrib.gis.gdal import SpatialReference, CoordTransform
 from calc.trips import LOCAL_2D_CRS
-from trips.models import Device
-from .models import ReceiveData, Location, DeviceHeartbeat, ActivityTypeChoices, SensorSample
+from trips.models import Device, DeviceFilterState
+from .models import ReceiveData, DirtyDevice, Location, DeviceHeartbeat, ActivityTypeChoices, SensorSample
+from .ways import set_closest_ways
 
 
 logger = logging.getLogger(__name__)
@@ -59,6 +60,17 @@ class EventProcessor:
         event.imported_at = timezone.now()
         event.save(update_fields=['import_failed', 'imported_at'])
 
+    def invalidate_filter_states(self, oldest_sample_times):
+        # Samples older than the filter state checkpoint of a device
+        # arrived late, so the checkpoint is no longer valid.
+        for uid, oldest_time in oldest_sample_times.items():
+            DeviceFilterState.objects.filter(device__uuid=uid, time__gte=oldest_time).delete()
+
+    def enqueue_devices(self, newest_sample_times, received_at):
+        # Let the trip generator know which devices have new samples
+        for uid, newest_time in newest_sample_times.items():
+            DirtyDevice.enqueue(uid, newest_time, received_at)
+
     def process_location_event(self, event):
         logger.info('Processing location event')
         locs = event.data.get('location')
@@ -67,6 +79,9 @@ class EventProcessor:
 
         DICT_KEYS = ['activity', 'coords', 'extras']
         last_uuid = None
+        oldest_sample_times = {}
+        newest_sample_times = {}
+        saved_samples = []
         for loc in locs:
             for key in DICT_KEYS:
                 if not isinstance(loc.get(key), dict):
@@ -93,6 +108,9 @@ class EventProcessor:
                 uuid=obj.uuid
             ).exists():
                 logger.warning('Location for %s at %s already exists' % (obj.uuid, obj.time))
+                set_closest_ways(saved_samples)
+                self.invalidate_filter_states(oldest_sample_times)
+                self.enqueue_devices(newest_sample_times, event.received_at)
                 return
 
             last_uuid = obj.uuid
@@ -125,7 +143,15 @@ class EventProcessor:
             obj.is_moving = loc.get('is_moving')
             obj.battery_charging = loc.get('battery', {}).get('is_charging')
             obj.save(force_insert=True)
-
+            saved_samples.append((obj.uuid, obj.time))
+            if obj.uuid not in oldest_sample_times or obj.time < oldest_sample_times[obj.uuid]:
+                oldest_sample_times[obj.uuid] = obj.time
+            if obj.uuid not in newest_sample_times or obj.time > newest_sample_times[obj.uuid]:
+                newest_sample_times[obj.uuid] = obj.time
+
+        set_closest_ways(saved_samples)
+        self.invalidate_filter_states(oldest_sample_times)
+        self.enqueue_devices(newest_sample_times, event.received_at)
         logger.info('%d location samples saved for %s' % (len(locs), last_uuid))
 
     def process_device_info_event(self, event):
@@ -0,0 +1,101 @@
+from django.db import connection
+
+from .models import Location
+
+
+LOCATION_TABLE = Location._meta.db_table
+
+# Ways further away than this (in meters) are not looked up
+CLOSEST_WAY_MAX_DISTANCE = 50
+
+CLOSEST_WAYS_JOINS = f"""
+    LEFT JOIN LATERAL (
+        SELECT
+            osm_id,
+            ST_Distance(cw.way, p.loc) AS dist
+        FROM planet_osm_car_ways AS cw
+        WHERE
+            cw.way && ST_Expand(p.loc, {CLOSEST_WAY_MAX_DISTANCE})
+        ORDER BY ST_Distance(cw.way, p.loc) ASC
+        LIMIT 1
+    ) AS ccw ON true
+    LEFT JOIN LATERAL (
+        SELECT
+            osm_id,
+            ST_Distance(rw.way, p.loc) AS dist
+        FROM planet_osm_rail_ways AS rw
+        WHERE
+            rw.way && ST_Expand(p.loc, {CLOSEST_WAY_MAX_DISTANCE})
+        ORDER BY ST_Distance(rw.way, p.loc) ASC
+        LIMIT 1
+    ) AS crw ON true
+"""
+
+BACKFILL_CLOSEST_WAYS_QUERY = f"""
+    UPDATE {LOCATION_TABLE} AS l SET
+        closest_car_way_id = w.car_way_id,
+        closest_car_way_dist = w.car_way_dist,
+        closest_rail_way_id = w.rail_way_id,
+        closest_rail_way_dist = w.rail_way_dist,
+        closest_ways_computed = true
+    FROM (
+        SELECT
+            p.uuid, p.time,
+            ccw.osm_id AS car_way_id, ccw.dist AS car_way_dist,
+            crw.osm_id AS rail_way_id, crw.dist AS rail_way_dist
+        FROM {LOCATION_TABLE} AS p
+        {CLOSEST_WAYS_JOINS}
+        WHERE
+            p.uuid = %(uuid)s
+            AND p.time >= %(start_time)s
+            AND p.time < %(end_time)s
+            AND p.closest_ways_computed IS NOT TRUE
+    ) AS w
+    WHERE
+        l.uuid = w.uuid AND l.time = w.time
+"""
+
+SAMPLE_CLOSEST_WAYS_QUERY = f"""
+    UPDATE {LOCATION_TABLE} AS l SET
+        closest_car_way_id = w.car_way_id,
+        closest_car_way_dist = w.car_way_dist,
+        closest_rail_way_id = w.rail_way_id,
+        closest_rail_way_dist = w.rail_way_dist,
+        closest_ways_computed = true
+    FROM (
+        SELECT
+            p.uuid, p.time,
+            ccw.osm_id AS car_way_id, ccw.dist AS car_way_dist,
+            crw.osm_id AS rail_way_id, crw.dist AS rail_way_dist
+        FROM {LOCATION_TABLE} AS p
+        JOIN unnest(%(uuids)s::uuid[], %(times)s::timestamptz[]) AS s(uuid, time)
+            ON p.uuid = s.uuid AND p.time = s.time
+        {CLOSEST_WAYS_JOINS}
+    ) AS w
+    WHERE
+        l.uuid = w.uuid AND l.time = w.time
+"""
+
+
+def set_closest_ways(samples) -> int:
+    """Look up the nearest car and rail ways of stored samples, given as (uuid, time) pairs.
+
+    All the samples are looked up in one query. Returns the number of updated rows.
+    """
+    if not samples:
+        return 0
+    uuids = [str(uuid) for uuid, _ in samples]
+    times = [time for _, time in samples]
+    with connection.cursor() as cursor:
+        cursor.execute(SAMPLE_CLOSEST_WAYS_QUERY, dict(uuids=uuids, times=times))
+        return cursor.rowcount
+
+
+def backfill_closest_ways(uuid, start_time, end_time) -> int:
+    """Fill in the nearest ways for the samples of a device that don't have them yet.
+
+    Returns the number of updated rows.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(BACKFILL_CLOSEST_WAYS_QUERY, dict(uuid=uuid, start_time=start_time, end_time=end_time))
+        return cursor.rowcount